@@ -21,13 +21,14 @@ setuptools.setup(
     },
     package_dir={'': 'src'},
     license=license,
-    install_requires=[],
-    python_requires='>=3.6',
+    install_requires=['numpy'],
+    python_requires='>=3.8',
     entry_points = {
         'console_scripts': [
             'Crackling=crackling.utils.Crackling_cli:main',
             'countHitTranscripts=crackling.utils.countHitTranscripts:main',
             'extractOfftargets=crackling.utils.extractOfftargets:main',
+            'buildIsslIndex=crackling.utils.buildIsslIndex:main',
             'trainModel=crackling.utils.trainModel:main'
         ],
     },
@@ -0,0 +1,87 @@
+/*
+
+ISSL index format, version 2
+
+Written by `isslCreateIndex`, read by `loadIndex` (see isslScoring.h). Unlike
+version 1, which must be read into memory, a version 2 index can be mapped
+read-only with `mmap` and used as is.
+
+The file is structured as:
+    - a fixed-size header (IsslIndexHeader), holding a magic number, the format
+      version, the index dimensions and a table of section offsets and sizes
+    - the sections, each starting at a multiple of ISSL_SECTION_ALIGNMENT:
+        - precalculated local MIT scores, as (uint64 mask, double score) pairs
+        - the binary encoded off-target sites (uint64)
+        - the slice list sizes (uint64)
+        - the slice contents (uint64, <occurrences 32-bit><off-target-id 32-bit>)
+
+Version 1 files start directly with the dimensions (6 x size_t) and have no
+magic number.
+
+isslCreateIndex also reads binary off-target sites: ISSL_SITES_MAGIC followed by
+IsslSite records, sorted and distinct, holding the binary encoded site (see
+`sequenceToSignature`) and how often it occurs in the genome.
+
+*/
+
+#ifndef ISSL_INDEX_FORMAT_H
+#define ISSL_INDEX_FORMAT_H
+
+#include <cstdint>
+#include <cstdio>
+#include <vector>
+
+/** The first bytes of a version 2 (or later) index */
+const char ISSL_INDEX_MAGIC[8] = {'I', 'S', 'S', 'L', 'I', 'D', 'X', '\0'};
+const uint64_t ISSL_INDEX_VERSION = 2;
+
+/** The first bytes of a file of binary off-target sites */
+const char ISSL_SITES_MAGIC[8] = {'I', 'S', 'S', 'L', 'S', 'I', 'T', 'E'};
+
+struct IsslSite
+{
+    uint64_t signature;
+    uint64_t occurrences;
+};
+
+/** Sections are page-aligned so that they can be mapped and advised separately */
+const uint64_t ISSL_SECTION_ALIGNMENT = 4096;
+
+enum IsslSection {
+    sectionScores = 0,
+    sectionOfftargets = 1,
+    sectionSliceListSizes = 2,
+    sectionSliceContents = 3,
+    sectionCount = 4
+};
+
+struct IsslIndexHeader
+{
+    char magic[8];
+    uint64_t version;
+    uint64_t offtargetsCount;
+    uint64_t seqLength;
+    uint64_t seqCount;
+    uint64_t sliceWidth;
+    uint64_t sliceCount;
+    uint64_t scoresCount;
+    /** Byte offset (from the start of the file) and size of each section */
+    uint64_t sectionOffsets[sectionCount];
+    uint64_t sectionSizes[sectionCount];
+};
+
+/// Rounds `offset` up to the next section boundary
+inline uint64_t alignSection(uint64_t offset)
+{
+    return (offset + ISSL_SECTION_ALIGNMENT - 1) / ISSL_SECTION_ALIGNMENT * ISSL_SECTION_ALIGNMENT;
+}
+
+/// Writes zeroes to `fp` until its position is on a section boundary
+inline void padToSection(FILE *fp)
+{
+    static const std::vector<char> zeroes(ISSL_SECTION_ALIGNMENT, 0);
+    uint64_t position = ftell(fp);
+    fwrite(zeroes.data(), 1, alignSection(position) - position, fp);
+}
+
+#endif
@@ -0,0 +1,932 @@
+/*
+
+ISSL scoring engine, shared by the `isslScoreOfftargets` executable and the
+`libissl` shared library (used by crackling.Issl through ctypes)
+
+- `loadIndex` maps a version 2 ISSL index (see isslIndexFormat.h), or reads a
+  version 1 index into memory
+- `scoreQueries` calculates the MIT and CFD scores of binary encoded queries,
+  one at a time or in blocks which share slice list scans
+
+Both must be compiled with the same flags, see the Makefile.
+
+*/
+
+#ifndef ISSL_SCORING_H
+#define ISSL_SCORING_H
+
+#include "cfdPenalties.h"
+#include "isslIndexFormat.h"
+
+#include <cstdio>
+#include <cstdlib>
+#include <cstdint>
+#include <vector>
+#include <string>
+#include <unordered_set>
+#include <unordered_map>
+#include <sys/types.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <stdint.h>
+#include <sys/time.h>
+#include <chrono>
+#include <bitset>
+#include <iostream>
+#include <climits>
+#include <stdio.h>
+#include <cstring>
+#include <omp.h>
+#include <phmap.h>
+#include <map>
+#include <algorithm>
+
+using namespace std;
+
+size_t seqLength, seqCount, sliceWidth, sliceCount, offtargetsCount, scoresCount, sliceLimit;
+
+vector<uint8_t> nucleotideIndex(256);
+vector<char> signatureIndex(4);
+enum ScoreMethod { unknown = 0, mit = 1, cfd = 2, mitAndCfd = 3, mitOrCfd = 4, avgMitCfd = 5 };
+
+/** Char to binary encoding */
+void initEncoding()
+{
+    nucleotideIndex['A'] = 0;
+    nucleotideIndex['C'] = 1;
+    nucleotideIndex['G'] = 2;
+    nucleotideIndex['T'] = 3;
+    signatureIndex[0] = 'A';
+    signatureIndex[1] = 'C';
+    signatureIndex[2] = 'G';
+    signatureIndex[3] = 'T';
+}
+
+/**
+ * Binary encode genetic string `ptr`
+ *
+ * For example, 
+ *   ATCG becomes
+ *   00 11 01 10  (buffer with leading zeroes to encode as 64-bit unsigned int)
+ *
+ * @param[in] ptr the string containing ATCG to binary encode
+ */
+uint64_t sequenceToSignature(const char *ptr)
+{
+    uint64_t signature = 0;
+    for (size_t j = 0; j < seqLength; j++) {
+        signature |= (uint64_t)(nucleotideIndex[*ptr]) << (j * 2);
+        ptr++;
+    }
+    return signature;
+}
+
+/**
+ * Binary encode genetic string `ptr`
+ *
+ * For example, 
+ *   00 11 01 10 becomes (as 64-bit unsigned int)
+ *    A  T  C  G  (without spaces)
+ *
+ * @param[in] signature the binary encoded genetic string
+ */
+string signatureToSequence(uint64_t signature)
+{
+    string sequence = string(seqLength, ' ');
+    for (size_t j = 0; j < seqLength; j++) {
+        sequence[j] = signatureIndex[(signature >> (j * 2)) & 0x3];
+    }
+    return sequence;
+}
+/** The ISSL index, as loaded by `loadIndex` */
+struct IsslIndex
+{
+    phmap::flat_hash_map<uint64_t, double> precalculatedScores;
+
+    /** The off-targets, slice list sizes and slice contents. These point into
+     *  the mapped file (version 2) or into the vectors below (version 1). */
+    const uint64_t *offtargets = nullptr;
+    const size_t *allSlicelistSizes = nullptr;
+    const uint64_t *allSignatures = nullptr;
+
+    vector<vector<const uint64_t *>> sliceLists;
+    uint64_t numOfftargetToggles;
+    size_t offtargetsCount, seqLength, sliceWidth, sliceCount, sliceLimit;
+
+    /** Storage of a version 1 index, which is read into memory */
+    vector<uint64_t> offtargetsData;
+    vector<size_t> allSlicelistSizesData;
+    vector<uint64_t> allSignaturesData;
+
+    /** The read-only mapping of a version 2 index */
+    void *mapping = nullptr;
+    size_t mappingSize = 0;
+
+    IsslIndex() {}
+    IsslIndex(const IsslIndex &) = delete;
+    IsslIndex &operator=(const IsslIndex &) = delete;
+
+    ~IsslIndex()
+    {
+        if (mapping != nullptr) {
+            munmap(mapping, mappingSize);
+        }
+    }
+};
+
+/**
+ * Returns the precalculated local MIT score of a mismatch combination
+ *
+ * Unlike `operator[]`, this does not insert missing masks, so the scores can be
+ * shared by threads.
+ */
+double getPrecalculatedScore(const phmap::flat_hash_map<uint64_t, double> &precalculatedScores, uint64_t mismatches)
+{
+    auto score = precalculatedScores.find(mismatches);
+    return score == precalculatedScores.end() ? 0.0 : score->second;
+}
+
+/// Records the dimensions of a loaded index, in `index` and the globals
+void setIndexDimensions(IsslIndex &index, size_t offtargets, size_t length, size_t count, size_t width, size_t slices, size_t scores)
+{
+    offtargetsCount = offtargets;
+    seqLength       = length;
+    seqCount        = count;
+    sliceWidth      = width;
+    sliceCount      = slices;
+    scoresCount     = scores;
+
+    /** The maximum number of possibly slice identities
+     *      4 chars per slice * each of A,T,C,G = limit of 16
+     */
+    sliceLimit = 1 << sliceWidth;
+
+    index.offtargetsCount = offtargetsCount;
+    index.seqLength = seqLength;
+    index.sliceWidth = sliceWidth;
+    index.sliceCount = sliceCount;
+    index.sliceLimit = sliceLimit;
+
+    /** Prevent assessing an off-target site for multiple slices
+     *
+     *      Create enough 1-bit "seen" flags for the off-targets
+     *      We only want to score a candidate guide against an off-target once.
+     *      The least-significant bit represents the first off-target
+     *      0 0 0 1   0 1 0 0   would indicate that the 3rd and 5th off-target have been seen.
+     *      The CHAR_BIT macro tells us how many bits are in a byte (C++ >= 8 bits per byte)
+     */
+    index.numOfftargetToggles = (offtargetsCount / ((size_t)sizeof(uint64_t) * (size_t)CHAR_BIT)) + 1;
+}
+
+/**
+ * Reads a version 1 index (without a magic number) into memory
+ *
+ * @param[in] fp the index, positioned at its start
+ */
+bool loadIndexV1(FILE *fp, IsslIndex &index)
+{
+    /** Begin reading the binary encoded ISSL, structured as:
+     *      - a header (6 items)
+     *      - precalcuated local MIT scores
+     *      - all binary-encoded off-target sites
+     *      - slice list sizes
+     *      - slice contents
+     */
+    
+    /** The index contains a fixed-sized header 
+     *      - the number of off-targets in the index
+     *      - the length of an off-target
+     *      - 
+     *      - chars per slice
+     *      - the number of slices per sequence
+     *      - the number of precalculated MIT scores
+     */
+    vector<size_t> slicelistHeader(6);
+    
+    if (fread(slicelistHeader.data(), sizeof(size_t), slicelistHeader.size(), fp) == 0) {
+        fprintf(stderr, "Error reading index: header invalid\n");
+        return false;
+    }
+    
+    setIndexDimensions(index, slicelistHeader[0], slicelistHeader[1], slicelistHeader[2], slicelistHeader[3], slicelistHeader[4], slicelistHeader[5]);
+    
+    /** Read in the precalculated MIT scores 
+     *      - `mask` is a 2-bit encoding of mismatch positions
+     *          For example,
+     *              00 01 01 00 01  indicates mismatches in positions 1, 3 and 4
+     *  
+     *      - `score` is the local MIT score for this mismatch combination
+     */
+
+    for (int i = 0; i < scoresCount; i++) {
+        uint64_t mask = 0;
+        double score = 0.0;
+        fread(&mask, sizeof(uint64_t), 1, fp);
+        fread(&score, sizeof(double), 1, fp);
+        
+        index.precalculatedScores.insert(pair<uint64_t, double>(mask, score));
+    }
+    
+    /** Load in all of the off-target sites */
+    index.offtargetsData.assign(offtargetsCount, 0);
+    if (fread(index.offtargetsData.data(), sizeof(uint64_t), offtargetsCount, fp) == 0) {
+        fprintf(stderr, "Error reading index: loading off-target sequences failed\n");
+        return false;
+    }
+
+    /** The number of signatures embedded per slice
+     *
+     *      These counts are stored contiguously
+     *
+     */
+    index.allSlicelistSizesData.assign(sliceCount * sliceLimit, 0);
+    
+    if (fread(index.allSlicelistSizesData.data(), sizeof(size_t), index.allSlicelistSizesData.size(), fp) == 0) {
+        fprintf(stderr, "Error reading index: reading slice list sizes failed\n");
+        return false;
+    }
+    
+    /** The contents of the slices
+     *
+     *      Stored contiguously
+     *
+     *      Each signature (64-bit) is structured as:
+     *          <occurrences 32-bit><off-target-id 32-bit>
+     */
+    index.allSignaturesData.assign(seqCount * sliceCount, 0);
+    
+    if (fread(index.allSignaturesData.data(), sizeof(uint64_t), index.allSignaturesData.size(), fp) == 0) {
+        fprintf(stderr, "Error reading index: reading slice contents failed\n");
+        return false;
+    }
+
+    index.offtargets = index.offtargetsData.data();
+    index.allSlicelistSizes = index.allSlicelistSizesData.data();
+    index.allSignatures = index.allSignaturesData.data();
+
+    return true;
+}
+
+/// Applies `advice` to the pages holding [start, start + length) of a mapping
+void adviseRange(const IsslIndex &index, uint64_t start, uint64_t length, int advice)
+{
+    uint64_t pageSize = sysconf(_SC_PAGESIZE);
+    uint64_t first = start / pageSize * pageSize;
+    madvise((char *)index.mapping + first, start + length - first, advice);
+}
+
+/**
+ * Maps a version 2 index read-only, see isslIndexFormat.h
+ *
+ * The pages are shared with every other process mapping the same index. Set
+ * the environment variable ISSL_HUGEPAGES to 1 to ask for transparent huge
+ * pages, where the kernel supports them for file mappings.
+ */
+bool loadIndexV2(const char *path, IsslIndex &index)
+{
+    int fd = open(path, O_RDONLY);
+    if (fd < 0) {
+        fprintf(stderr, "Error reading index: cannot open %s\n", path);
+        return false;
+    }
+
+    struct stat statBuf;
+    if (fstat(fd, &statBuf) != 0 || (size_t)statBuf.st_size < sizeof(IsslIndexHeader)) {
+        fprintf(stderr, "Error reading index: header invalid\n");
+        close(fd);
+        return false;
+    }
+
+    index.mappingSize = statBuf.st_size;
+    void *mapping = mmap(NULL, index.mappingSize, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+
+    if (mapping == MAP_FAILED) {
+        fprintf(stderr, "Error reading index: cannot map %s\n", path);
+        return false;
+    }
+    index.mapping = mapping;
+
+    const char *base = (const char *)mapping;
+
+    IsslIndexHeader header;
+    memcpy(&header, base, sizeof(header));
+
+    if (header.version != ISSL_INDEX_VERSION) {
+        fprintf(stderr, "Error reading index: version %llu is not supported\n", (unsigned long long)header.version);
+        return false;
+    }
+
+    for (int section = 0; section < sectionCount; section++) {
+        if (header.sectionOffsets[section] % sizeof(uint64_t) != 0 ||
+            header.sectionOffsets[section] + header.sectionSizes[section] > index.mappingSize) {
+            fprintf(stderr, "Error reading index: section %d is out of bounds\n", section);
+            return false;
+        }
+    }
+
+    setIndexDimensions(index, header.offtargetsCount, header.seqLength, header.seqCount, header.sliceWidth, header.sliceCount, header.scoresCount);
+
+    if (header.sectionSizes[sectionScores] != scoresCount * 2 * sizeof(uint64_t) ||
+        header.sectionSizes[sectionOfftargets] != offtargetsCount * sizeof(uint64_t) ||
+        header.sectionSizes[sectionSliceListSizes] != sliceCount * sliceLimit * sizeof(uint64_t)) {
+        fprintf(stderr, "Error reading index: section sizes do not match the header\n");
+        return false;
+    }
+
+    /** Start reading ahead in the background, so that scoring can start straight away */
+    madvise(mapping, index.mappingSize, MADV_WILLNEED);
+
+    /** The off-targets are looked up at random */
+    adviseRange(index, header.sectionOffsets[sectionOfftargets], header.sectionSizes[sectionOfftargets], MADV_RANDOM);
+
+#ifdef MADV_HUGEPAGE
+    const char *hugePages = getenv("ISSL_HUGEPAGES");
+    if (hugePages != NULL && !strcmp(hugePages, "1")) {
+        madvise(mapping, index.mappingSize, MADV_HUGEPAGE);
+    }
+#endif
+
+    /** The precalculated MIT scores are stored as (mask, score) pairs */
+    const char *scores = base + header.sectionOffsets[sectionScores];
+    for (size_t i = 0; i < scoresCount; i++) {
+        uint64_t mask;
+        double score;
+        memcpy(&mask, scores + i * 16, sizeof(uint64_t));
+        memcpy(&score, scores + i * 16 + 8, sizeof(double));
+
+        index.precalculatedScores.insert(pair<uint64_t, double>(mask, score));
+    }
+
+    index.offtargets = (const uint64_t *)(base + header.sectionOffsets[sectionOfftargets]);
+    index.allSlicelistSizes = (const size_t *)(base + header.sectionOffsets[sectionSliceListSizes]);
+    index.allSignatures = (const uint64_t *)(base + header.sectionOffsets[sectionSliceContents]);
+
+    return true;
+}
+
+/**
+ * Loads the ISSL index at `path`. A version 2 index is mapped, a version 1
+ * index is read into memory.
+ *
+ * @param[in] path the ISSL index
+ * @param[out] index the loaded index
+ * @return false if the index cannot be read
+ */
+bool loadIndex(const char *path, IsslIndex &index)
+{
+    FILE *fp = fopen(path, "rb");
+    if (fp == NULL) {
+        fprintf(stderr, "Error reading index: cannot open %s\n", path);
+        return false;
+    }
+
+    char magic[sizeof(ISSL_INDEX_MAGIC)] = {0};
+    size_t magicLength = fread(magic, 1, sizeof(magic), fp);
+
+    bool loaded;
+    if (magicLength == sizeof(magic) && !memcmp(magic, ISSL_INDEX_MAGIC, sizeof(magic))) {
+        fclose(fp);
+        loaded = loadIndexV2(path, index);
+    } else {
+        rewind(fp);
+        loaded = loadIndexV1(fp, index);
+        /** End reading the index */
+        fclose(fp);
+    }
+
+    if (!loaded) {
+        return false;
+    }
+    
+    /** Start constructing index in memory
+     *
+     *      To begin, reverse the contiguous storage of the slices,
+     *         into the following:
+     *
+     *         + Slice 0 :
+     *         |---- AAAA : <slice contents>
+     *         |---- AAAC : <slice contents>
+     *         |----  ...
+     *         | 
+     *         + Slice 1 :
+     *         |---- AAAA : <slice contents>
+     *         |---- AAAC : <slice contents>
+     *         |---- ...
+     *         | ...
+     */
+    index.sliceLists.assign(sliceCount, vector<const uint64_t *>(sliceLimit));
+
+    const uint64_t *offset = index.allSignatures;
+    for (size_t i = 0; i < sliceCount; i++) {
+        for (size_t j = 0; j < sliceLimit; j++) {
+            size_t idx = i * sliceLimit + j;
+            index.sliceLists[i][j] = offset;
+            offset += index.allSlicelistSizes[idx];
+        }
+    }
+
+    return true;
+}
+
+/**
+ * The off-targets scored so far for a query, one "seen" bit per off-target
+ *
+ * The words set while scoring a query are listed, and only those are cleared
+ * by `reset`. Its cost depends on how many off-targets the query reached, not
+ * on the size of the index, which clearing the whole bitmap would. Once a
+ * query has set more than 1/16 of the words, the list is dropped and the whole
+ * bitmap is cleared, which is then as fast.
+ */
+class OfftargetToggles
+{
+public:
+    explicit OfftargetToggles(uint64_t numOfftargetToggles) :
+        toggles(numOfftargetToggles, 0),
+        touched(numOfftargetToggles / 16 + 1),
+        touchedCount(0)
+    {
+    }
+
+    /// Returns true if the off-target has been seen since the last reset
+    inline bool seen(uint64_t signatureId) const
+    {
+        return (toggles[signatureId / 64] >> (signatureId % 64)) & 1ULL;
+    }
+
+    /// Marks the off-target as seen
+    inline void mark(uint64_t signatureId)
+    {
+        uint64_t &word = toggles[signatureId / 64];
+
+        /** List the word if it was clear, without branching. Once the list
+         *  is full, the last slot is overwritten and the count stays put. */
+        touched[touchedCount] = signatureId / 64;
+        touchedCount += (word == 0) & (touchedCount < touched.size() - 1);
+
+        word |= (1ULL << (signatureId % 64));
+    }
+
+    /// Forgets every off-target seen since the last reset
+    inline void reset()
+    {
+        if (touchedCount == touched.size() - 1) {
+            memset(toggles.data(), 0, sizeof(uint64_t) * toggles.size());
+        } else {
+            for (size_t i = 0; i < touchedCount; i++) {
+                toggles[touched[i]] = 0;
+            }
+        }
+        touchedCount = 0;
+    }
+
+private:
+    vector<uint64_t> toggles;
+    vector<uint64_t> touched;
+    size_t touchedCount;
+};
+
+/**
+ * Returns the CFD score of an off-target site, for a query at distance `dist`
+ */
+inline double calculateCfd(uint64_t searchSignature, uint64_t offtarget, int dist, int maxDist)
+{
+    /** "In other words, for the CFD score, a value of 0 
+     *      indicates no predicted off-target activity whereas 
+     *      a value of 1 indicates a perfect match"
+     *      John Doench, 2016. 
+     *      https://www.nature.com/articles/nbt.3437
+    */
+    double cfdScore = 0;
+    if (dist == 0) {
+        cfdScore = 1;
+    }
+    else if (dist > 0 && dist <= maxDist) {
+        cfdScore = cfdPamPenalties[0b1010]; // PAM: NGG, TODO: do not hard-code the PAM
+        
+        for (size_t pos = 0; pos < 20; pos++) {
+            size_t mask = pos << 4;
+            
+            /** Create the mask to look up the position-identity score
+             *      In Python... c2b is char to bit
+             *       mask = pos << 4
+             *       mask |= c2b[sgRNA[pos]] << 2
+             *       mask |= c2b[revcom(offTaret[pos])]
+             *      
+             *      Find identity at `pos` for search signature
+             *      example: find identity in pos=2
+             *       Recall ISSL is inverted, hence:
+             *                   3'-  T  G  C  C  G  A -5'
+             *       start           11 10 01 01 10 00   
+             *       3UL << pos*2    00 00 00 11 00 00 
+             *       and             00 00 00 01 00 00
+             *       shift           00 00 00 00 01 00
+             */
+            uint64_t searchSigIdentityPos = searchSignature;
+            searchSigIdentityPos &= (3UL << (pos * 2));
+            searchSigIdentityPos = searchSigIdentityPos >> (pos * 2); 
+            searchSigIdentityPos = searchSigIdentityPos << 2;
+
+            /** Find identity at `pos` for offtarget
+             *      Example: find identity in pos=2
+             *      Recall ISSL is inverted, hence:
+             *                  3'-  T  G  C  C  G  A -5'
+             *      start           11 10 01 01 10 00   
+             *      3UL<<pos*2      00 00 00 11 00 00 
+             *      and             00 00 00 01 00 00
+             *      shift           00 00 00 00 00 01
+             *      rev comp 3UL    00 00 00 00 00 10 (done below)
+             */
+            uint64_t offtargetIdentityPos = offtarget;
+            offtargetIdentityPos &= (3UL << (pos * 2));
+            offtargetIdentityPos = offtargetIdentityPos >> (pos * 2); 
+
+            /** Complete the mask
+             *      reverse complement (^3UL) `offtargetIdentityPos` here
+             */
+            mask = (mask | searchSigIdentityPos | (offtargetIdentityPos ^ 3UL));
+
+            if (searchSigIdentityPos >> 2 != offtargetIdentityPos) {
+                cfdScore *= cfdPosPenalties[mask];
+            }
+        }
+    }
+    return cfdScore;
+}
+
+/** Returns true once the global scores are past the point of dropping below the threshold */
+inline bool exceedsMaximumSum(ScoreMethod scoreMethod, double totScoreMit, double totScoreCfd, double maximum_sum)
+{
+    switch (scoreMethod) {
+        case ScoreMethod::mitAndCfd:
+            return totScoreMit > maximum_sum && totScoreCfd > maximum_sum;
+        case ScoreMethod::mitOrCfd:
+            return totScoreMit > maximum_sum || totScoreCfd > maximum_sum;
+        case ScoreMethod::avgMitCfd:
+            return ((totScoreMit + totScoreCfd) / 2.0) > maximum_sum;
+        case ScoreMethod::mit:
+            return totScoreMit > maximum_sum;
+        case ScoreMethod::cfd:
+            return totScoreCfd > maximum_sum;
+        default:
+            return false;
+    }
+}
+
+/**
+ * Returns true if the query matches an off-target in one of the slices before
+ * slice `slice`, i.e. the off-target was in one of the query's earlier slice
+ * lists, and was scored (if it is within the maximum distance) there
+ */
+inline bool matchedInEarlierSlice(uint64_t xoredSignatures, size_t slice, size_t sliceWidth, uint64_t sliceMask)
+{
+    for (size_t i = 0; i < slice; i++) {
+        if (((xoredSignatures >> (sliceWidth * i)) & sliceMask) == 0) {
+            return true;
+        }
+    }
+    return false;
+}
+
+/**
+ * Scores queries as `scoreQueries` does, but in blocks of `blockSize`
+ *
+ * The queries are sorted, so that the queries of a block share slice values,
+ * and each block is scored slice by slice. The queries of a block with the
+ * same value in a slice are scored together, while their slice list is
+ * scanned once. Each query keeps its own scores and early-exit state, and
+ * sees its off-targets in the same order as when scored alone, so the scores
+ * are the same.
+ *
+ * Rather than a bitmap per query, an off-target is known to have been scored
+ * already if it matched the query in an earlier slice.
+ */
+void scoreQueriesBlocked(
+    const IsslIndex &index,
+    const uint64_t *querySignatures,
+    size_t queryCount,
+    int maxDist,
+    double threshold,
+    ScoreMethod scoreMethod,
+    bool calcMit,
+    bool calcCfd,
+    double *querySignatureMitScores,
+    double *querySignatureCfdScores,
+    size_t blockSize
+)
+{
+    const auto &precalculatedScores = index.precalculatedScores;
+    const auto &offtargets = index.offtargets;
+    const auto &allSlicelistSizes = index.allSlicelistSizes;
+    const auto &sliceLists = index.sliceLists;
+    size_t sliceWidth = index.sliceWidth;
+    size_t sliceCount = index.sliceCount;
+    size_t sliceLimit = index.sliceLimit;
+    uint64_t sliceMask = sliceLimit - 1;
+    double maximum_sum = (10000.0 - threshold*100) / threshold;
+
+    /** The order the queries are scored in. Results are written by query index. */
+    vector<size_t> order(queryCount);
+    for (size_t searchIdx = 0; searchIdx < queryCount; searchIdx++) {
+        order[searchIdx] = searchIdx;
+    }
+    sort(order.begin(), order.end(), [&](size_t a, size_t b) {
+        return querySignatures[a] < querySignatures[b];
+    });
+
+    size_t blockCount = (queryCount + blockSize - 1) / blockSize;
+
+    #pragma omp parallel
+    {
+        vector<double> totScoreMit(blockSize);
+        vector<double> totScoreCfd(blockSize);
+        vector<char> done(blockSize);
+
+        /** (slice value, position in block) of the queries still being scored */
+        vector<pair<uint64_t, size_t>> groups;
+        vector<uint64_t> activeSignatures(blockSize);
+        vector<size_t> activePositions(blockSize);
+
+        #pragma omp for schedule(dynamic)
+        for (size_t block = 0; block < blockCount; block++) {
+            const size_t *blockQueries = &order[block * blockSize];
+            size_t blockQueryCount = min(blockSize, queryCount - block * blockSize);
+
+            fill(totScoreMit.begin(), totScoreMit.end(), 0.0);
+            fill(totScoreCfd.begin(), totScoreCfd.end(), 0.0);
+            fill(done.begin(), done.end(), 0);
+
+            /** For each ISSL slice */
+            for (size_t i = 0; i < sliceCount; i++) {
+                int sliceShift = sliceWidth * i;
+
+                groups.clear();
+                for (size_t q = 0; q < blockQueryCount; q++) {
+                    if (!done[q]) {
+                        groups.push_back(make_pair((querySignatures[blockQueries[q]] >> sliceShift) & sliceMask, q));
+                    }
+                }
+                if (groups.empty()) {
+                    break;
+                }
+                sort(groups.begin(), groups.end());
+
+                /** For each group of queries with the same slice value */
+                for (size_t groupStart = 0, groupEnd = 0; groupStart < groups.size(); groupStart = groupEnd) {
+                    uint64_t searchSlice = groups[groupStart].first;
+                    while (groupEnd < groups.size() && groups[groupEnd].first == searchSlice) {
+                        groupEnd++;
+                    }
+
+                    /** The queries of the group still being scored, as (signature, position in block) */
+                    size_t activeQueries = 0;
+                    for (size_t k = groupStart; k < groupEnd; k++) {
+                        activeSignatures[activeQueries] = querySignatures[blockQueries[groups[k].second]];
+                        activePositions[activeQueries] = groups[k].second;
+                        activeQueries++;
+                    }
+
+                    size_t signaturesInSlice = allSlicelistSizes[i * sliceLimit + searchSlice];
+                    const uint64_t *sliceOffset = sliceLists[i][searchSlice];
+
+                    /** For each off-target signature in slice, while any query of the group is being scored */
+                    for (size_t j = 0; j < signaturesInSlice && activeQueries > 0; j++) {
+                        auto signatureWithOccurrencesAndId = sliceOffset[j];
+                        auto signatureId = signatureWithOccurrencesAndId & 0xFFFFFFFFull;
+                        uint32_t occurrences = (signatureWithOccurrencesAndId >> (32));
+                        uint64_t offtarget = offtargets[signatureId];
+
+                        for (size_t k = 0; k < activeQueries; k++) {
+                            /** Find the positions of mismatches, see `scoreQueries` */
+                            uint64_t searchSignature = activeSignatures[k];
+                            uint64_t xoredSignatures = searchSignature ^ offtarget;
+                            uint64_t evenBits = xoredSignatures & 0xAAAAAAAAAAAAAAAAull;
+                            uint64_t oddBits = xoredSignatures & 0x5555555555555555ull;
+                            uint64_t mismatches = (evenBits >> 1) | oddBits;
+                            int dist = __builtin_popcountll(mismatches);
+
+                            if (dist > maxDist || matchedInEarlierSlice(xoredSignatures, i, sliceWidth, sliceMask)) {
+                                continue;
+                            }
+
+                            size_t q = activePositions[k];
+                            if (calcMit && dist > 0) {
+                                totScoreMit[q] += getPrecalculatedScore(precalculatedScores, mismatches) * (double)occurrences;
+                            }
+                            if (calcCfd) {
+                                totScoreCfd[q] += calculateCfd(searchSignature, offtarget, dist, maxDist) * (double)occurrences;
+                            }
+
+                            /** Stop calculating global score early if possible, replacing the query with the last active one */
+                            if (exceedsMaximumSum(scoreMethod, totScoreMit[q], totScoreCfd[q], maximum_sum)) {
+                                done[q] = 1;
+                                activeQueries--;
+                                activeSignatures[k] = activeSignatures[activeQueries];
+                                activePositions[k] = activePositions[activeQueries];
+                                k--;
+                            }
+                        }
+                    }
+                }
+            }
+
+            for (size_t q = 0; q < blockQueryCount; q++) {
+                querySignatureMitScores[blockQueries[q]] = 10000.0 / (100.0 + totScoreMit[q]);
+                querySignatureCfdScores[blockQueries[q]] = 10000.0 / (100.0 + totScoreCfd[q]);
+            }
+        }
+    }
+}
+
+/**
+ * Scores the `queryCount` binary encoded candidate guides `querySignatures`
+ * against the index
+ *
+ * @param[out] querySignatureMitScores the MIT score of each query
+ * @param[out] querySignatureCfdScores the CFD score of each query
+ * @param[in] blockSize if not 0, score the queries in blocks, see `scoreQueriesBlocked`
+ */
+void scoreQueries(
+    const IsslIndex &index,
+    const uint64_t *querySignatures,
+    size_t queryCount,
+    int maxDist,
+    double threshold,
+    ScoreMethod scoreMethod,
+    bool calcMit,
+    bool calcCfd,
+    double *querySignatureMitScores,
+    double *querySignatureCfdScores,
+    size_t blockSize = 0
+)
+{
+    if (blockSize > 0) {
+        scoreQueriesBlocked(index, querySignatures, queryCount, maxDist, threshold, scoreMethod, calcMit, calcCfd, querySignatureMitScores, querySignatureCfdScores, blockSize);
+        return;
+    }
+
+    const auto &precalculatedScores = index.precalculatedScores;
+    const auto &offtargets = index.offtargets;
+    const auto &allSlicelistSizes = index.allSlicelistSizes;
+    const auto &sliceLists = index.sliceLists;
+    uint64_t numOfftargetToggles = index.numOfftargetToggles;
+    size_t sliceWidth = index.sliceWidth;
+    size_t sliceCount = index.sliceCount;
+    size_t sliceLimit = index.sliceLimit;
+
+    /** Begin scoring */
+    #pragma omp parallel
+    {
+        unordered_map<uint64_t, unordered_set<uint64_t>> searchResults;
+        OfftargetToggles offtargetToggles(numOfftargetToggles);
+
+        /** For each candidate guide */
+        #pragma omp for
+        for (size_t searchIdx = 0; searchIdx < queryCount; searchIdx++) {
+
+            auto searchSignature = querySignatures[searchIdx];
+
+            /** Global scores */
+            double totScoreMit = 0.0;
+            double totScoreCfd = 0.0;
+            
+            int numOffTargetSitesScored = 0;
+            double maximum_sum = (10000.0 - threshold*100) / threshold;
+            bool checkNextSlice = true;
+            
+            /** For each ISSL slice */
+            for (size_t i = 0; i < sliceCount; i++) {
+                uint64_t sliceMask = sliceLimit - 1;
+                int sliceShift = sliceWidth * i;
+                sliceMask = sliceMask << sliceShift;
+                auto &sliceList = sliceLists[i];
+                
+                uint64_t searchSlice = (searchSignature & sliceMask) >> sliceShift;
+                
+                size_t idx = i * sliceLimit + searchSlice;
+                
+                size_t signaturesInSlice = allSlicelistSizes[idx];
+                const uint64_t *sliceOffset = sliceList[searchSlice];
+                
+                /** For each off-target signature in slice */
+                for (size_t j = 0; j < signaturesInSlice; j++) {
+                    
+                    auto signatureWithOccurrencesAndId = sliceOffset[j];
+                    auto signatureId = signatureWithOccurrencesAndId & 0xFFFFFFFFull;
+                    uint32_t occurrences = (signatureWithOccurrencesAndId >> (32));
+
+                    /** Find the positions of mismatches 
+                     *
+                     *  Search signature (SS):    A  A  T  T    G  C  A  T
+                     *                           00 00 11 11   10 01 00 11
+                     *              
+                     *        Off-target (OT):    A  T  A  T    C  G  A  T
+                     *                           00 11 00 11   01 10 00 11
+                     *                           
+                     *                SS ^ OT:   00 00 11 11   10 01 00 11
+                     *                         ^ 00 11 00 11   01 10 00 11
+                     *                  (XORd) = 00 11 11 00   11 11 00 00
+                     *
+                     *        XORd & evenBits:   00 11 11 00   11 11 00 00
+                     *                         & 10 10 10 10   10 10 10 10
+                     *                   (eX)  = 00 10 10 00   10 10 00 00
+                     *
+                     *         XORd & oddBits:   00 11 11 00   11 11 00 00
+                     *                         & 01 01 01 01   01 01 01 01
+                     *                   (oX)  = 00 01 01 00   01 01 00 00
+                     *
+                     *         (eX >> 1) | oX:   00 01 01 00   01 01 00 00 (>>1)
+                     *                         | 00 01 01 00   01 01 00 00
+                     *            mismatches   = 00 01 01 00   01 01 00 00
+                     *
+                     *   popcount(mismatches):   4
+                     */
+                    uint64_t xoredSignatures = searchSignature ^ offtargets[signatureId];
+                    uint64_t evenBits = xoredSignatures & 0xAAAAAAAAAAAAAAAAull;
+                    uint64_t oddBits = xoredSignatures & 0x5555555555555555ull;
+                    uint64_t mismatches = (evenBits >> 1) | oddBits;
+                    int dist = __builtin_popcountll(mismatches);
+					
+					if (dist >= 0 && dist <= maxDist) {
+
+						/** Prevent assessing the same off-target for multiple slices */
+						if (!offtargetToggles.seen(signatureId)) {
+							// Begin calculating MIT score
+							if (calcMit) {
+								if (dist > 0) {
+									totScoreMit += getPrecalculatedScore(precalculatedScores, mismatches) * (double)occurrences;
+								}
+							} 
+							
+							// Begin calculating CFD score
+							if (calcCfd) {
+								double cfdScore = calculateCfd(searchSignature, offtargets[signatureId], dist, maxDist);
+								totScoreCfd += cfdScore * (double)occurrences;
+							}
+					
+							offtargetToggles.mark(signatureId);
+							numOffTargetSitesScored += occurrences;
+
+							/** Stop calculating global score early if possible */
+							if (exceedsMaximumSum(scoreMethod, totScoreMit, totScoreCfd, maximum_sum)) {
+								checkNextSlice = false;
+								break;
+							}
+						}
+					}
+                }
+
+                if (!checkNextSlice)
+                    break;
+            }
+
+            querySignatureMitScores[searchIdx] = 10000.0 / (100.0 + totScoreMit);
+            querySignatureCfdScores[searchIdx] = 10000.0 / (100.0 + totScoreCfd);
+
+            offtargetToggles.reset();
+        }
+
+    }
+}
+
+/** Scoring methods. To exit early: 
+ *      - only CFD must drop below `threshold`
+ *      - only MIT must drop below `threshold`
+ *      - both CFD and MIT must drop below `threshold`
+ *      - CFD or MIT must drop below `threshold`
+ *      - the average of CFD and MIT must below `threshold`
+ *
+ * @param[in] argScoreMethod one of and, or, avg, mit or cfd
+ * @param[out] scoreMethod the method, ScoreMethod::unknown if it is not known
+ * @param[out] calcMit whether the method needs the MIT score
+ * @param[out] calcCfd whether the method needs the CFD score
+ */
+void parseScoreMethod(const string &argScoreMethod, ScoreMethod &scoreMethod, bool &calcMit, bool &calcCfd)
+{
+    scoreMethod = ScoreMethod::unknown;
+	calcCfd = false;
+	calcMit = false;
+    if (!argScoreMethod.compare("and")) {
+		scoreMethod = ScoreMethod::mitAndCfd;
+		calcCfd = true;
+		calcMit = true;
+	} else if (!argScoreMethod.compare("or")) {
+		scoreMethod = ScoreMethod::mitOrCfd;
+		calcCfd = true;
+		calcMit = true;
+	} else if (!argScoreMethod.compare("avg")) {
+		scoreMethod = ScoreMethod::avgMitCfd;
+		calcCfd = true;
+		calcMit = true;
+	} else if (!argScoreMethod.compare("mit")) {
+		scoreMethod = ScoreMethod::mit;
+		calcMit = true;
+	} else if (!argScoreMethod.compare("cfd")) {
+		scoreMethod = ScoreMethod::cfd;
+		calcCfd = true;
+	}
+}
+
+#endif
@@ -7,7 +7,18 @@ bioRxiv 2020.02.14.950261; doi: https://doi.org/10.1101/2020.02.14.950261
 
 To compile:
 
-g++ -o isslCreateIndex isslCreateIndex.cpp -O3 -std=c++11 -fopenmp -mpopcnt
+g++ -o isslCreateIndex isslCreateIndex.cpp -O3 -std=c++11 -fopenmp -mpopcnt -Iinclude
+
+The index is written in the version 2 format (see include/isslIndexFormat.h),
+which isslScoreOfftargets maps into memory rather than reading.
+
+Given a memory budget (in MiB) as a fifth argument, the off-target sites are
+streamed twice instead of being read into memory, and the index is written
+with buffers of about that size (see `createIndexExternal`).
+
+The off-target sites can also be given as sorted, distinct binary sites with
+their occurrences (see include/isslIndexFormat.h), as written by
+buildIsslIndex, and read from stdin by passing `-` as the file.
 
 */
 
@@ -22,6 +33,10 @@ g++ -o isslCreateIndex isslCreateIndex.cpp -O3 -std=c++11 -fopenmp -mpopcnt
 #include <sys/stat.h>
 #include <unistd.h>
 #include <map>
+#include <algorithm>
+#include <fcntl.h>
+
+#include "isslIndexFormat.h"
 
 using namespace std;
 
@@ -129,31 +144,306 @@ double sscore(uint64_t xoredSignatures)
     return single_score(mismatch_array, m);
 }
 
+/// Precalculates the local MIT score of every mismatch combination an index can be searched with
+map<uint64_t, double> precalculateScores(size_t sliceWidth)
+{
+	map<uint64_t, double> precalculatedScores;
+	int maxDist = seqLength * 2 / sliceWidth - 1;
+	
+	for (int i = 1; i <= maxDist; i++) {
+		vector<uint64_t> tempMasks;
+		tempMasks = computeMasksTwoBit(20, i);
+		for (auto mask : tempMasks) {
+			double score = sscore(mask);
+			precalculatedScores.insert(pair<uint64_t, double>(mask, score));
+		}
+	}
+	return precalculatedScores;
+}
+
+/// Fills in the version 2 header of an index, and lays out its sections (see isslIndexFormat.h)
+IsslIndexHeader makeIndexHeader(size_t offtargetsCount, size_t seqCount, size_t sliceWidth, size_t scoresCount, uint64_t sliceContentsSize)
+{
+	size_t sliceLimit = 1 << sliceWidth;
+	size_t sliceCount = (seqLength * 2) / sliceWidth;
+
+	IsslIndexHeader header;
+	memset(&header, 0, sizeof(header));
+	memcpy(header.magic, ISSL_INDEX_MAGIC, sizeof(header.magic));
+	header.version = ISSL_INDEX_VERSION;
+	header.offtargetsCount = offtargetsCount;
+	header.seqLength = seqLength;
+	header.seqCount = seqCount;
+	header.sliceWidth = sliceWidth;
+	header.sliceCount = sliceCount;
+	header.scoresCount = scoresCount;
+
+	header.sectionSizes[sectionScores] = scoresCount * (sizeof(uint64_t) + sizeof(double));
+	header.sectionSizes[sectionOfftargets] = offtargetsCount * sizeof(uint64_t);
+	header.sectionSizes[sectionSliceListSizes] = sliceCount * sliceLimit * sizeof(uint64_t);
+	header.sectionSizes[sectionSliceContents] = sliceContentsSize;
+
+	uint64_t sectionOffset = alignSection(sizeof(header));
+	for (int section = 0; section < sectionCount; section++) {
+		header.sectionOffsets[section] = sectionOffset;
+		sectionOffset = alignSection(sectionOffset + header.sectionSizes[section]);
+	}
+	return header;
+}
+
+/// Writes `size` bytes to `fd` at `offset`, exiting on failure
+void writeAt(int fd, const void *data, size_t size, uint64_t offset)
+{
+	const char *ptr = (const char *)data;
+	while (size > 0) {
+		ssize_t written = pwrite(fd, ptr, size, offset);
+		if (written <= 0) {
+			fprintf(stderr, "Failed to write the index.\n");
+			exit(1);
+		}
+		ptr += written;
+		offset += written;
+		size -= written;
+	}
+}
+
+/// Buffers sequential writes to one region of the index
+struct RegionWriter
+{
+	int fd;
+	uint64_t offset;
+	size_t capacity;
+	vector<uint64_t> buffer;
+
+	void push(uint64_t value)
+	{
+		buffer.push_back(value);
+		if (buffer.size() >= capacity) {
+			flush();
+		}
+	}
+
+	void flush()
+	{
+		writeAt(fd, buffer.data(), buffer.size() * sizeof(uint64_t), offset);
+		offset += buffer.size() * sizeof(uint64_t);
+		buffer.clear();
+	}
+};
+
+/// An open file of off-target sites, see `openSites`
+struct SitesInput
+{
+	FILE *fp;
+	// sorted, distinct sites with their occurrences (see isslIndexFormat.h), rather than text
+	bool binary;
+};
+
+/**
+ * Opens a file of off-target sites, `-` being stdin. Text files are lines of
+ * `seqLength` bases, sorted. Binary files start with ISSL_SITES_MAGIC, and can
+ * also be read from stdin.
+ */
+SitesInput openSites(const char *path)
+{
+	SitesInput input;
+	input.fp = strcmp(path, "-") ? fopen(path, "rb") : stdin;
+	if (input.fp == NULL) {
+		fprintf(stderr, "Failed to read in file.\n");
+		exit(1);
+	}
+
+	char magic[sizeof(ISSL_SITES_MAGIC)] = {0};
+	size_t magicLength = fread(magic, 1, sizeof(magic), input.fp);
+	input.binary = magicLength == sizeof(magic) && !memcmp(magic, ISSL_SITES_MAGIC, sizeof(magic));
+	if (input.binary) {
+		return input;
+	}
+
+	if (input.fp == stdin) {
+		fprintf(stderr, "Error: off-target sites read from stdin must be binary (see isslIndexFormat.h)\n");
+		exit(1);
+	}
+	rewind(input.fp);
+
+	size_t fileSize = getFileSize(path);
+	size_t seqLineLength = seqLength + 1; // '\n'
+	if (fileSize % seqLineLength != 0) {
+		fprintf(stderr, "fileSize: %zu\n", fileSize);
+		fprintf(stderr, "Error: file does is not a multiple of the expected line length (%zu)\n", seqLineLength);
+		fprintf(stderr, "The sequence length may be incorrect; alternatively, the line endings\n");
+		fprintf(stderr, "may be something other than LF, or there may be junk at the end of the file.\n");
+		exit(1);
+	}
+	return input;
+}
+
+/**
+ * Streams a file of off-target sites (see `openSites`), `bufferSites` sites at
+ * a time, and calls `visit(signature, occurrences)` once for each distinct
+ * site, in order
+ *
+ * @param[out] seqCount the number of sites, counting repeats
+ * @return the number of distinct sites
+ */
+template <typename Visitor>
+size_t forEachDistinctSite(const char *path, size_t bufferSites, size_t &seqCount, Visitor visit)
+{
+	SitesInput input = openSites(path);
+
+	size_t seqLineLength = seqLength + 1; // '\n'
+	size_t siteSize = input.binary ? sizeof(IsslSite) : seqLineLength;
+	vector<char> buffer(bufferSites * siteSize);
+	size_t distinctSites = 0;
+	uint64_t previous = 0;
+	uint64_t occurrences = 0;
+	seqCount = 0;
+
+	while (true) {
+		size_t sites = fread(buffer.data(), siteSize, bufferSites, input.fp);
+		if (sites == 0) {
+			break;
+		}
+
+		// the sites are sorted, so repeats of an off-target are adjacent
+		for (size_t k = 0; k < sites; k++) {
+			uint64_t signature, count = 1;
+			if (input.binary) {
+				IsslSite site;
+				memcpy(&site, &buffer[k * siteSize], sizeof(site));
+				signature = site.signature;
+				count = site.occurrences;
+			} else {
+				signature = sequenceToSignature(&buffer[k * siteSize]);
+			}
+			seqCount += count;
+
+			if (occurrences > 0 && signature == previous) {
+				occurrences += count;
+				continue;
+			}
+			if (occurrences > 0) {
+				visit(previous, (uint32_t)occurrences);
+				distinctSites++;
+			}
+			previous = signature;
+			occurrences = count;
+		}
+
+		fprintf(stderr, "%zu : %zu\n", seqCount, distinctSites);
+	}
+
+	if (occurrences > 0) {
+		visit(previous, (uint32_t)occurrences);
+		distinctSites++;
+	}
+
+	if (input.fp != stdin) {
+		fclose(input.fp);
+	}
+	return distinctSites;
+}
+
+/**
+ * Builds an index in two streaming passes over the off-target file, using
+ * about `memoryBudget` bytes of buffers rather than holding the off-targets
+ * and slice lists in memory
+ *
+ *      - pass 1 counts the distinct sites and the size of every slice list,
+ *        which fixes the offset of every section and slice list in the file
+ *      - pass 2 writes each distinct site to the off-target section, and
+ *        scatters its id into its slice lists at their final offsets
+ */
+void createIndexExternal(const char *inputPath, const char *outputPath, size_t sliceWidth, size_t memoryBudget)
+{
+	size_t sliceLimit = 1 << sliceWidth;
+	size_t sliceCount = (seqLength * 2) / sliceWidth;
+	uint64_t sliceMask = sliceLimit - 1;
+	size_t listCount = sliceCount * sliceLimit;
+
+	// 1/8 of the budget for reading, 1/8 for the off-targets and the rest for the slice lists
+	size_t bufferSites = max((size_t)1, memoryBudget / 8 / max(seqLength + 1, sizeof(IsslSite)));
+	size_t offtargetsCapacity = max((size_t)1, memoryBudget / 8 / sizeof(uint64_t));
+	size_t listCapacity = max((size_t)1, memoryBudget / 4 * 3 / sizeof(uint64_t) / listCount);
+
+	fprintf(stderr, "Counting slice list sizes (pass 1 of 2)...\n");
+
+	vector<uint64_t> slicelistSizes(listCount, 0);
+	size_t seqCount;
+	size_t offtargetsCount = forEachDistinctSite(inputPath, bufferSites, seqCount,
+		[&](uint64_t signature, uint32_t occurrences) {
+			for (size_t i = 0; i < sliceCount; i++) {
+				slicelistSizes[i * sliceLimit + ((signature >> (sliceWidth * i)) & sliceMask)]++;
+			}
+		}
+	);
+
+	map<uint64_t, double> precalculatedScores = precalculateScores(sliceWidth);
+	IsslIndexHeader header = makeIndexHeader(offtargetsCount, seqCount, sliceWidth, precalculatedScores.size(), offtargetsCount * sliceCount * sizeof(uint64_t));
+
+	int fd = open(outputPath, O_WRONLY | O_CREAT | O_TRUNC, 0644);
+	if (fd < 0) {
+		fprintf(stderr, "Failed to open %s for writing.\n", outputPath);
+		exit(1);
+	}
+
+	// write the header, the precalculated scores and the slice list sizes
+	writeAt(fd, &header, sizeof(header), 0);
+
+	vector<uint64_t> scores;
+	for (auto const& x : precalculatedScores) {
+		uint64_t score;
+		memcpy(&score, &x.second, sizeof(double));
+		scores.push_back(x.first);
+		scores.push_back(score);
+	}
+	writeAt(fd, scores.data(), scores.size() * sizeof(uint64_t), header.sectionOffsets[sectionScores]);
+	writeAt(fd, slicelistSizes.data(), slicelistSizes.size() * sizeof(uint64_t), header.sectionOffsets[sectionSliceListSizes]);
+
+	// each slice list starts where the previous one ends
+	RegionWriter offtargets = {fd, header.sectionOffsets[sectionOfftargets], offtargetsCapacity};
+	vector<RegionWriter> sliceLists(listCount);
+	uint64_t offset = header.sectionOffsets[sectionSliceContents];
+	for (size_t idx = 0; idx < listCount; idx++) {
+		sliceLists[idx] = {fd, offset, listCapacity};
+		offset += slicelistSizes[idx] * sizeof(uint64_t);
+	}
+
+	fprintf(stderr, "Writing the index (pass 2 of 2)...\n");
+
+	uint32_t signatureId = 0;
+	forEachDistinctSite(inputPath, bufferSites, seqCount,
+		[&](uint64_t signature, uint32_t occurrences) {
+			offtargets.push(signature);
+
+			uint64_t seqSigIdVal = (((uint64_t)occurrences) << 32) | (uint64_t)signatureId;
+			for (size_t i = 0; i < sliceCount; i++) {
+				sliceLists[i * sliceLimit + ((signature >> (sliceWidth * i)) & sliceMask)].push(seqSigIdVal);
+			}
+			signatureId++;
+		}
+	);
+
+	offtargets.flush();
+	for (auto &sliceList : sliceLists) {
+		sliceList.flush();
+	}
+
+	close(fd);
+}
+
 int main(int argc, char **argv)
 {
     if (argc < 5) {
-        fprintf(stderr, "Usage: %s [offtargetSites.txt] [sequence length] [slice width (bits)] [sissltable]\n", argv[0]);
+        fprintf(stderr, "Usage: %s [offtargetSites.txt] [sequence length] [slice width (bits)] [sissltable] [memory budget (MiB), optional]\n", argv[0]);
+        fprintf(stderr, "The off-target sites may be a sorted text file, or binary sites (see isslIndexFormat.h), '-' reading binary sites from stdin\n");
         exit(1);
     }
-    size_t fileSize = getFileSize(argv[1]);
-    
-    FILE *fp = fopen(argv[1], "rb");
     seqLength = atoi(argv[2]);
     if (seqLength > 32) {
         fprintf(stderr, "Sequence length is greater than 32, which is the maximum supported currently\n");
         exit(1);
     }
-    size_t seqLineLength = seqLength + 1; // '\n'
-    if (fileSize % seqLineLength != 0) {
-        fprintf(stderr, "fileSize: %zu\n", fileSize);
-        fprintf(stderr, "Error: file does is not a multiple of the expected line length (%zu)\n", seqLineLength);
-        fprintf(stderr, "The sequence length may be incorrect; alternatively, the line endings\n");
-        fprintf(stderr, "may be something other than LF, or there may be junk at the end of the file.\n");
-        exit(1);
-    }
-    size_t seqCount = fileSize / seqLineLength;
-    fprintf(stderr, "Number of sequences: %zu\n", seqCount);
-    
     
     nucleotideIndex['A'] = 0;
     nucleotideIndex['C'] = 1;
@@ -164,49 +454,30 @@ int main(int argc, char **argv)
     signatureIndex[2] = 'G';
     signatureIndex[3] = 'T';
     
-    size_t globalCount = 0;
+    // with a memory budget, the index is built by streaming the off-targets twice
+    if (argc > 5) {
+        if (!strcmp(argv[1], "-")) {
+            fprintf(stderr, "Error: a memory budget needs the off-target sites in a file, not stdin\n");
+            exit(1);
+        }
+        size_t memoryBudget = (size_t)atol(argv[5]) << 20;
+        createIndexExternal(argv[1], argv[4], atoi(argv[3]), memoryBudget);
+        printf("Done.\n");
+        return 0;
+    }
     
     vector<uint64_t> seqSignatures;
     vector<uint32_t> seqSignaturesOccurrences;
     
-	size_t distinctSites = 0;
-    {
-        vector<char> entireDataSet(fileSize);
-
-        if (fread(entireDataSet.data(), fileSize, 1, fp) < 1) {
-            fprintf(stderr, "Failed to read in file.\n");
-            exit(1);
+    size_t seqCount;
+    size_t distinctSites = forEachDistinctSite(argv[1], 1 << 20, seqCount,
+        [&](uint64_t signature, uint32_t occurrences) {
+            seqSignatures.push_back(signature);
+            seqSignaturesOccurrences.push_back(occurrences);
         }
-        fclose(fp);
-
-		size_t progressCount = 0;
-		size_t offtargetId = 0;
-		while (progressCount < seqCount) {
-			char *ptr = &entireDataSet[progressCount * seqLineLength];
-			
-			uint64_t signature = sequenceToSignature(ptr);
-
-			// check how many times the off-target appears
-			// (assumed the list is sorted)
-			uint32_t occurrences = 1;
-			while (memcmp(ptr, ptr + (seqLineLength * occurrences), seqLength) == 0) {
-				occurrences++;
-				if ((seqCount - progressCount - occurrences) < 100)
-					fprintf(stderr, "%zu/%zu : %zu\n", (progressCount+occurrences), seqCount, distinctSites);
-					
-			}
-
-			seqSignatures.push_back(signature);
-			seqSignaturesOccurrences.push_back(occurrences);
-			
-			distinctSites++;
-			if (progressCount % 10000 == 0)
-				fprintf(stderr, "%zu/%zu : %zu\n", progressCount, seqCount, distinctSites);
-			
-			progressCount += occurrences;
-		}
+    );
+    fprintf(stderr, "Number of sequences: %zu\n", seqCount);
     
-    }
 	printf("Finished counting occurrences, now constructing index...\n");
     size_t sliceWidth = atoi(argv[3]);
     size_t sliceLimit = 1 << sliceWidth;
@@ -236,51 +507,42 @@ int main(int argc, char **argv)
 	printf("Finished constructing index, now precalculating scores...\n");
 	
 	// Precalculate all the scores
-	map<uint64_t, double> precalculatedScores;
+	map<uint64_t, double> precalculatedScores = precalculateScores(sliceWidth);
 	
-	int maxDist = seqLength * 2 / sliceWidth - 1;
-	size_t scoresCount = 0;
+	printf("Finished calculating scores, now preparing to write to disk...\n");
 	
-	for (int i = 1; i <= maxDist; i++) {
-		vector<uint64_t> tempMasks;
-		tempMasks = computeMasksTwoBit(20, i);
-		for (auto mask : tempMasks) {
-			double score = sscore(mask);
-			precalculatedScores.insert(pair<uint64_t, double>(mask, score));
-			scoresCount++;
+    FILE *fp = fopen(argv[4], "wb");
+
+	uint64_t sliceContentsSize = 0;
+	for (size_t i = 0; i < sliceCount; i++) {
+		for (size_t j = 0; j < sliceLimit; j++) {
+			sliceContentsSize += sliceLists[i][j].size() * sizeof(uint64_t);
 		}
 	}
-	
-	printf("Finished calculating scores, now preparing to write to disk...\n");
-	
-    fp = fopen(argv[4], "wb");
-    vector<size_t> slicelistHeader;
-    slicelistHeader.push_back(offtargetsCount);
-    slicelistHeader.push_back(seqLength);
-    slicelistHeader.push_back(seqCount);
-    slicelistHeader.push_back(sliceWidth);
-    slicelistHeader.push_back(sliceCount);
-    slicelistHeader.push_back(scoresCount);
-	
-	
+	IsslIndexHeader header = makeIndexHeader(offtargetsCount, seqCount, sliceWidth, precalculatedScores.size(), sliceContentsSize);
+
 	// write the header
-    fwrite(slicelistHeader.data(), sizeof(size_t), slicelistHeader.size(), fp);
+	fwrite(&header, sizeof(header), 1, fp);
+	padToSection(fp);
 
 	// write the precalculated scores
 	for (auto const& x : precalculatedScores) {
 		fwrite(&x.first, sizeof(uint64_t), 1, fp);
 		fwrite(&x.second, sizeof(double), 1, fp);
 	}
+	padToSection(fp);
 
 	// write the offtargets
 	fwrite(seqSignatures.data(), sizeof(uint64_t), seqSignatures.size(), fp);
+	padToSection(fp);
 	
     for (size_t i = 0; i < sliceCount; i++) { // 5
         for (size_t j = 0; j < sliceLimit; j++) { // 256
-            size_t sz = sliceLists[i][j].size(); 
-            fwrite(&sz, sizeof(size_t), 1, fp);
+            uint64_t sz = sliceLists[i][j].size(); 
+            fwrite(&sz, sizeof(uint64_t), 1, fp);
         }
     }
+	padToSection(fp);
 
     for (size_t i = 0; i < sliceCount; i++) { // 5
         for (size_t j = 0; j < sliceLimit; j++) { // 256
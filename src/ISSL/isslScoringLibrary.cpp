@@ -0,0 +1,103 @@
+/*
+
+C interface to the ISSL scoring engine, built as a shared library so that
+off-target scoring can run in-process (see crackling.Issl)
+
+To compile:
+
+g++ -shared -fPIC -o libissl.so isslScoringLibrary.cpp -O3 -std=c++11 -fopenmp -mpopcnt -Iinclude
+
+Queries are binary encoded (see `sequenceToSignature`) and the scores are
+written to caller-provided arrays, so no data is copied or converted.
+
+*/
+
+#include "isslScoring.h"
+
+extern "C" {
+
+/**
+ * Loads the ISSL index at `path`
+ *
+ * @return a handle to the index, or NULL if it cannot be read
+ */
+void *issl_load_index(const char *path)
+{
+    initEncoding();
+
+    IsslIndex *index = new IsslIndex();
+    if (!loadIndex(path, *index)) {
+        delete index;
+        return NULL;
+    }
+    return index;
+}
+
+/// Returns the length of the off-targets of a loaded index
+size_t issl_seq_length(void *index)
+{
+    return static_cast<IsslIndex *>(index)->seqLength;
+}
+
+/// Frees an index returned by `issl_load_index`
+void issl_free_index(void *index)
+{
+    delete static_cast<IsslIndex *>(index);
+}
+
+/**
+ * Scores `queryCount` binary encoded queries
+ *
+ * @param[in] scoreMethod one of and, or, avg, mit or cfd
+ * @param[out] mitScores the MIT score of each query, -1 if not calculated
+ * @param[out] cfdScores the CFD score of each query, -1 if not calculated
+ * @param[in] blockSize if not 0, score the queries in blocks, see `scoreQueriesBlocked`
+ * @return 0 on success, 1 if the score method is not known
+ */
+int issl_score_blocked(
+    void *index,
+    const uint64_t *querySignatures,
+    size_t queryCount,
+    const char *scoreMethod,
+    double threshold,
+    int maxDist,
+    double *mitScores,
+    double *cfdScores,
+    size_t blockSize
+)
+{
+    ScoreMethod method;
+    bool calcMit, calcCfd;
+    parseScoreMethod(scoreMethod, method, calcMit, calcCfd);
+
+    if (method == ScoreMethod::unknown) {
+        return 1;
+    }
+
+    scoreQueries(*static_cast<IsslIndex *>(index), querySignatures, queryCount, maxDist, threshold, method, calcMit, calcCfd, mitScores, cfdScores, blockSize);
+
+    /** Scores which are not calculated are reported as -1, as by isslScoreOfftargets */
+    for (size_t i = 0; i < queryCount; i++) {
+        if (!calcMit) mitScores[i] = -1.0;
+        if (!calcCfd) cfdScores[i] = -1.0;
+    }
+
+    return 0;
+}
+
+/// Scores `queryCount` binary encoded queries one at a time, see `issl_score_blocked`
+int issl_score(
+    void *index,
+    const uint64_t *querySignatures,
+    size_t queryCount,
+    const char *scoreMethod,
+    double threshold,
+    int maxDist,
+    double *mitScores,
+    double *cfdScores
+)
+{
+    return issl_score_blocked(index, querySignatures, queryCount, scoreMethod, threshold, maxDist, mitScores, cfdScores, 0);
+}
+
+}
@@ -0,0 +1,98 @@
+/*
+
+Benchmarks the per-query cost of tracking the off-targets already scored by a
+query (see `OfftargetToggles` in isslScoring.h), against the size of the index.
+
+For each index size, `queries` queries each mark `touched` random off-targets
+as seen and then reset the flags, either by clearing the whole bitmap (as
+scoring used to) or by clearing only the words that were set.
+
+To compile:
+
+g++ -o isslTogglesBenchmark isslTogglesBenchmark.cpp -O3 -std=c++11 -fopenmp -mpopcnt -Iinclude
+
+To run:
+
+isslTogglesBenchmark [touched off-targets per query] [queries]
+
+*/
+
+#include "isslScoring.h"
+
+#include <cerrno>
+#include <random>
+
+/// Parses a positive count, returns 0 if `arg` is not one
+size_t parseCount(const char *arg)
+{
+    char *end;
+    errno = 0;
+    long long count = strtoll(arg, &end, 10);
+    if (end == arg || *end != '\0' || errno == ERANGE || count <= 0) {
+        return 0;
+    }
+    return (size_t)count;
+}
+
+/// Returns the mean time per query (microseconds) of marking `ids` and resetting
+template <typename Mark, typename Reset>
+double timeQueries(const vector<vector<uint64_t>> &ids, Mark mark, Reset reset)
+{
+    auto start = chrono::steady_clock::now();
+    for (const auto &queryIds : ids) {
+        for (uint64_t id : queryIds) {
+            mark(id);
+        }
+        reset();
+    }
+    chrono::duration<double, micro> elapsed = chrono::steady_clock::now() - start;
+    return elapsed.count() / ids.size();
+}
+
+int main(int argc, char **argv)
+{
+    size_t touched = argc > 1 ? parseCount(argv[1]) : 5000;
+    size_t queries = argc > 2 ? parseCount(argv[2]) : 200;
+
+    if (argc > 3 || touched == 0 || queries == 0) {
+        fprintf(stderr, "Usage: %s [touched off-targets per query, default 5000] [queries, default 200]\n", argv[0]);
+        fprintf(stderr, "Both are positive integers\n");
+        return 1;
+    }
+
+    mt19937_64 random(82);
+
+    printf("off-targets\tbitmap (MiB)\tfull clear (us/query)\tsparse reset (us/query)\n");
+
+    for (uint64_t offtargets = 1000000; offtargets <= 1000000000; offtargets *= 10) {
+        uint64_t numOfftargetToggles = offtargets / 64 + 1;
+
+        uniform_int_distribution<uint64_t> offtargetIds(0, offtargets - 1);
+        vector<vector<uint64_t>> ids(queries, vector<uint64_t>(touched));
+        for (auto &queryIds : ids) {
+            for (auto &id : queryIds) {
+                id = offtargetIds(random);
+            }
+        }
+
+        /** Clear the whole bitmap after each query */
+        vector<uint64_t> bitmap(numOfftargetToggles, 0);
+        double fullClear = timeQueries(ids,
+            [&](uint64_t id) { bitmap[id / 64] |= (1ULL << (id % 64)); },
+            [&]() { memset(bitmap.data(), 0, sizeof(uint64_t) * bitmap.size()); }
+        );
+        bitmap = vector<uint64_t>();
+
+        /** Clear the words set by each query */
+        OfftargetToggles toggles(numOfftargetToggles);
+        double sparseReset = timeQueries(ids,
+            [&](uint64_t id) { toggles.mark(id); },
+            [&]() { toggles.reset(); }
+        );
+
+        printf("%llu\t%.1f\t%.1f\t%.1f\n", (unsigned long long)offtargets, numOfftargetToggles * 8.0 / (1 << 20), fullClear, sparseReset);
+        fflush(stdout);
+    }
+
+    return 0;
+}
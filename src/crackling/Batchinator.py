@@ -1,43 +1,125 @@
-import tempfile, csv
+import tempfile
+
+import numpy as np
+
+from crackling.FileProcessor.guide_encoding import encode_guides
+
+# One candidate guide, as written to a batch file. Headers are stored once per
+# run, in `Batchinator.headers`, and referred to by their position.
+BATCH_DTYPE = np.dtype([
+    ('signature',   '<u8'),
+    ('header',      '<u4'),
+    ('start',       '<i8'),
+    ('end',         '<i8'),
+    ('strand',      'S1'),
+])
+
+# Entries are buffered in memory and written in blocks of this many
+BUFFER_SIZE = 1 << 16
 
 class Batchinator:
-    def __init__(self, batchSize:int):
-        self.workingDir = tempfile.TemporaryDirectory()
-        self.currentFile = tempfile.NamedTemporaryFile(mode='w',delete=False,dir=self.workingDir.name)
-        self.csvWriter = csv.writer(self.currentFile, delimiter=',', quotechar='"', dialect='unix', quoting=csv.QUOTE_MINIMAL)
+    def __init__(self, batchSize:int, dir:str=None):
+        self.workingDir = tempfile.TemporaryDirectory(dir=dir)
+        self.currentFile = tempfile.NamedTemporaryFile(mode='wb',delete=False,dir=self.workingDir.name)
         self.batchFiles = []
         self.currentBatch = 0
-        self.batchSize = batchSize
+        # A batch holds at least one entry
+        self.batchSize = max(batchSize, 1)
         self.entryCount = 0
+        # Header table, shared by every batch file
+        self.headers = []
+        self.headerIds = {}
+        # Entries not yet written to the current file
+        self.buffer = []
 
     def __len__(self):
         return len(self.batchFiles)
 
     def __iter__(self):
-        # Close current file
-        self.currentFile.close()
-        # Record file
-        self.batchFiles.append(self.currentFile)
         # yeild the file names
-        for file in self.batchFiles:
+        for name in self.close():
             self.currentBatch += 1
-            yield file.name
+            yield name
 
-    def recordEntry(self, entry:list):
-        # Increase the entry count
-        self.entryCount += 1
+    def close(self):
+        '''Finishes writing and returns the name of every batch file, in order'''
+        if not self.currentFile.closed:
+            # Close current file
+            self._closeCurrentFile()
+            # Record file
+            self.batchFiles.append(self.currentFile)
+        return [file.name for file in self.batchFiles]
+
+    def _headerId(self, header):
+        if header not in self.headerIds:
+            self.headerIds[header] = len(self.headers)
+            self.headers.append(header)
+        return self.headerIds[header]
+
+    def _flush(self):
+        if self.buffer:
+            np.concatenate(self.buffer).tofile(self.currentFile)
+            self.buffer = []
+
+    def _closeCurrentFile(self):
+        self._flush()
+        self.currentFile.close()
+
+    def _newFileIfFull(self):
         # Check if a new file is needed
-        if self.entryCount > self.batchSize:
+        if self.entryCount >= self.batchSize:
             # Close current file
-            self.currentFile.close()
+            self._closeCurrentFile()
             # Record file
             self.batchFiles.append(self.currentFile)
             # Create new file
-            self.currentFile = tempfile.NamedTemporaryFile(mode='w',delete=False,dir=self.workingDir.name)
-            # Update csv writer
-            self.csvWriter = csv.writer(self.currentFile, delimiter=',', quotechar='"', dialect='unix', quoting=csv.QUOTE_MINIMAL)
+            self.currentFile = tempfile.NamedTemporaryFile(mode='wb',delete=False,dir=self.workingDir.name)
             # Reset entry count
-            self.entryCount = 1
-        # Write entry
-        self.csvWriter.writerow(entry)
+            self.entryCount = 0
+
+    def recordEntry(self, entry:list):
+        '''
+        Records one guide as [guide, header, start, end, strand], where guide is
+        its signature or its sequence
+        '''
+        guide, header, start, end, strand = entry
+
+        if isinstance(guide, (str, bytes)):
+            guide = encode_guides([guide])[0]
+
+        self.recordEntries([guide], [header], [start], [end], [strand])
+
+    def recordEntries(self, signatures, headers, starts, ends, strands):
+        '''Records many guides at once, see `recordEntry`'''
+        headerIds = np.array([self._headerId(header) for header in headers], dtype=np.uint32)
+
+        entries = np.zeros(len(signatures), dtype=BATCH_DTYPE)
+        entries['signature'] = signatures
+        entries['header'] = headerIds
+        entries['start'] = starts
+        entries['end'] = ends
+        entries['strand'] = np.asarray(strands, dtype='S1')
+
+        written = 0
+        while written < len(entries):
+            self._newFileIfFull()
+
+            count = min(len(entries) - written, self.batchSize - self.entryCount)
+            self.buffer.append(entries[written:written + count])
+            self.entryCount += count
+            written += count
+
+            if sum(len(b) for b in self.buffer) >= BUFFER_SIZE:
+                self._flush()
+
+    @staticmethod
+    def loadBatch(batchFile:str):
+        '''Maps a batch file into memory, as a (read-only) array of BATCH_DTYPE'''
+        with open(batchFile, 'rb') as file:
+            if file.seek(0, 2) == 0:
+                return np.zeros(0, dtype=BATCH_DTYPE)
+        return np.memmap(batchFile, dtype=BATCH_DTYPE, mode='r')
 
+    def batchHeaders(self, batch):
+        '''Returns the header of every entry of a batch, as an object array'''
+        return np.array(self.headers, dtype=object)[batch['header']]
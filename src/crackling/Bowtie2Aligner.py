@@ -0,0 +1,110 @@
+'''
+Bowtie2Aligner
+
+- Aligns the PAM variants of guides with bowtie2, over pipes, so that no input
+  or SAM file is written
+- `align(targets)` starts bowtie2 for a page of targets (23-mers). The eight
+  variants of each target (its first 20 bases followed by each of
+  PAM_VARIANTS) are written to its stdin by a writer thread, while the SAM
+  records are read from its stdout.
+- bowtie2 runs with `--reorder`, so it writes one record per read in the order
+  of the reads. Records are consumed in groups of eight, the group of a target
+  being found by its position rather than by its sequence.
+- For each target, (chr, pos, occurrences) is yielded: the position of its
+  first variant and how many perfect alignments its variants have (a variant
+  with no mismatches counts once, twice if it also aligns perfectly
+  elsewhere)
+- Only the fields that are needed are parsed: RNAME, POS, SEQ and the XM and
+  XS tags
+'''
+
+import subprocess, threading
+
+from crackling.Helpers import printer, rc
+
+PAM_VARIANTS = ['AGG', 'CGG', 'GGG', 'TGG', 'AAG', 'CAG', 'GAG', 'TAG']
+
+
+class Bowtie2Aligner:
+    def __init__(self, binary:str, index:str, threads):
+        self.args = [binary, '-x', index, '-p', str(threads), '--reorder', '--no-hd', '-t', '-r', '-U', '-']
+
+    def _feed(self, process, targets, errors):
+        '''Writes the variants of `targets` to the stdin of `process`, then closes it'''
+        try:
+            for target23 in targets:
+                process.stdin.write(''.join(f'{target23[0:20]}{pam}\n' for pam in PAM_VARIANTS))
+        except (BrokenPipeError, OSError) as e:
+            # bowtie2 has stopped, which the reader will find out
+            errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except (BrokenPipeError, OSError):
+                pass
+
+    def align(self, targets):
+        '''Yields (chr, pos, occurrences) for each target, in order'''
+        targets = list(targets)
+
+        printer(f'| Calling: {self.args}')
+        process = subprocess.Popen(
+            self.args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+
+        errors = []
+        feeder = threading.Thread(target=self._feed, args=(process, targets, errors), daemon=True)
+        feeder.start()
+
+        try:
+            for target23 in targets:
+                chr, pos = None, None
+                occurrences = 0
+
+                for variantIdx, pam in enumerate(PAM_VARIANTS):
+                    line = process.stdout.readline()
+                    if not line:
+                        raise RuntimeError(f'bowtie2 stopped unexpectedly: {self.args} {errors}')
+
+                    # QNAME FLAG RNAME POS MAPQ CIGAR RNEXT PNEXT TLEN SEQ QUAL [TAG...]
+                    fields = line.rstrip('\n').split('\t', 11)
+
+                    # SEQ is reverse complemented when the read aligns to the reverse strand
+                    read = f'{target23[0:20]}{pam}'
+                    if fields[9] != read and fields[9] != rc(read):
+                        raise RuntimeError(f'Unexpected output from bowtie2 for {read}: {line!r}')
+
+                    if variantIdx == 0:
+                        chr = fields[2]
+                        pos = int(fields[3])
+
+                    # http://bowtie-bio.sourceforge.net/bowtie2/manual.shtml#sam-output
+                    # XM:i:<N>    The number of mismatches in the alignment. Only present if SAM record is for an aligned read.
+                    # XS:i:<N>    Alignment score for the best-scoring alignment found other than the alignment reported.
+                    tags = f'\t{fields[11]}\t' if len(fields) > 11 else ''
+                    if '\tXM:i:0\t' in tags:
+                        occurrences += 1
+
+                        # a perfect alignment which also happens elsewhere
+                        if '\tXS:i:0\t' in tags:
+                            occurrences += 1
+
+                yield chr, pos, occurrences
+
+            feeder.join()
+
+            if process.stdout.readline():
+                raise RuntimeError(f'Unexpected output from bowtie2, after the last read: {self.args}')
+
+            if process.wait() != 0:
+                raise RuntimeError(f'bowtie2 failed ({process.returncode}): {self.args}')
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+
+        printer('| Finished')
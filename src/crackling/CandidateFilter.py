@@ -0,0 +1,83 @@
+'''
+CandidateFilter
+
+- Decides which guides each module (CHOPCHOP, mm10db, sgRNAScorer2,
+  specificity) assesses, given the optimisation level (see config.ini)
+- `compileFilter` reads the policy of the optimisation level once, and returns
+  `filterCandidateGuides(candidateGuides, module)`. It evaluates the policy on
+  whole status columns of a GuideTable and returns the index array of the
+  guides to assess, in table order.
+- The policies are those of the per-guide filter this replaces:
+    - ultralow: every guide
+    - low: unique guides
+    - medium: unique guides. mm10db skips guides that failed an mm10db test,
+      specificity skips guides that failed consensus or Bowtie2.
+    - high: as medium. In addition, the efficiency modules skip guides that
+      already passed consensus, or that cannot pass it with the tools that
+      have not assessed them yet.
+'''
+
+import numpy as np
+
+from crackling.Constants import *
+
+EFFICIENCY_MODULES = [MODULE_CHOPCHOP, MODULE_MM10DB, MODULE_SGRNASCORER2]
+
+# The result of each tool in the consensus
+CONSENSUS_COLUMNS = ['acceptedByMm10db', 'passedG20', 'acceptedBySgRnaScorer']
+
+# The tests of mm10db, a guide which failed one is not assessed by the others
+MM10DB_COLUMNS = [
+    'passedAvoidLeadingT',
+    'passedATPercent',
+    'passedTTTT',
+    'passedSecondaryStructure',
+    'acceptedByMm10db',
+]
+
+
+def compileFilter(optimisation:str, consensusN:int, toolsInConsensus:int):
+    '''Returns `filterCandidateGuides(candidateGuides, module)` for an optimisation level, see above'''
+    skipDuplicates = optimisation in ['low', 'medium', 'high']
+    skipFailed = optimisation in ['medium', 'high']
+    skipDecided = optimisation == 'high'
+
+    def filterCandidateGuides(candidateGuides, module):
+        module = module.lower()
+
+        assess = np.ones(len(candidateGuides), dtype=bool)
+
+        # Never assess guides that appear twice
+        if skipDuplicates:
+            assess &= candidateGuides['isUnique'] != STATUS_REJECTED
+
+        # For efficiency
+        if skipDecided and module in EFFICIENCY_MODULES:
+            # `consensusCount` cannot be used yet as it may not have been
+            # calculated. Instead, count the tools that accepted, or assessed,
+            # each guide so far.
+            accepted = np.zeros(len(candidateGuides), dtype=np.int64)
+            assessed = np.zeros(len(candidateGuides), dtype=np.int64)
+            for column in CONSENSUS_COLUMNS:
+                accepted += candidateGuides[column] == STATUS_ACCEPTED
+                assessed += np.isin(candidateGuides[column], [STATUS_ACCEPTED, STATUS_REJECTED])
+
+            # Do not assess if passed consensus already
+            assess &= accepted < consensusN
+
+            # Do not assess if there are not enough remaining tests to pass consensus
+            assess &= toolsInConsensus - assessed >= consensusN - accepted
+
+        # For mm10db: if any of the mm10db tests have failed, then fail them all
+        if skipFailed and module == MODULE_MM10DB:
+            for column in MM10DB_COLUMNS:
+                assess &= candidateGuides[column] != STATUS_REJECTED
+
+        # For specificity: don't assess if they failed consensus, or Bowtie
+        if skipFailed and module == MODULE_SPECIFICITY:
+            assess &= candidateGuides['consensusCount'] >= consensusN
+            assess &= candidateGuides['passedBowtie'] != STATUS_REJECTED
+
+        return np.flatnonzero(assess)
+
+    return filterCandidateGuides
@@ -3,10 +3,13 @@ import configparser, os, shutil
 import glob
 
 class ConfigManager():
-    def __init__(self, filePath, messenger):
+    def __init__(self, filePath, messenger, resume=False):
         # The configuration
         self._configFilePath = filePath
 
+        # Whether to resume an interrupted run, see RunCheckpoint
+        self._resume = resume
+
         # The name of the current configuration
         self._fallbackName = strftime("%Y%m%d%H%M%S", localtime())
 
@@ -157,6 +160,12 @@ class ConfigManager():
                 passed = False
                 self._sendMsg(f'This binary cannot be executed: {x}')
 
+        # check the ISSL library exists, if one is used
+        library = c['offtargetscore'].get('library', fallback='')
+        if library and not os.path.isfile(library):
+            passed = False
+            self._sendMsg(f'This library cannot be found: {library}')
+
         # check that the 'n' value for the consensus is less than or equal to
         # the number of tools being used
         numToolsInConsensus = self.getNumberToolsInConsensus()
@@ -169,10 +178,25 @@ class ConfigManager():
 
         c['output']['file'] = os.path.join(c['output']['dir'], f"{self.getConfigName()}-{c['output']['fileName']}")
 
-        if os.path.exists(c['output']['file']):
+        # a resumed run continues the output file of the interrupted run
+        if self._resume and not c['output'].getboolean('checkpoint', fallback=False):
+            passed = False
+            self._sendMsg("Only a run with checkpoints can be resumed. Set checkpoint = True in the output section.")
+
+        # an incremental run replaces the results file of the previous run,
+        # which is kept in the incremental directory (see IncrementalRun)
+        previousResults = os.path.join(self.getIncrementalDir(), 'guides.txt')
+        isPreviousResults = (
+            c['output'].getboolean('incremental', fallback=False) and
+            os.path.exists(c['output']['file']) and
+            os.path.exists(previousResults) and
+            os.path.samefile(c['output']['file'], previousResults)
+        )
+
+        if os.path.exists(c['output']['file']) and not self._resume and not isPreviousResults:
             passed = False
             self._sendMsg(f"The output file already exists: {c['output']['file']}")
-            self._sendMsg(f"To avoid loosing data, please rename your output file.")
+            self._sendMsg("To avoid loosing data, please rename your output file, or resume the run (--resume).")
 
         return passed
 
@@ -191,6 +215,10 @@ class ConfigManager():
         else:
             self._filesToProcess = glob.glob(self._ConfigParser['input']['exon-sequences'])
 
+        # .fai indexes next to the input files (e.g. from `samtools faidx`, see
+        # FileProcessor.fasta_index) are not input
+        self._filesToProcess = [x for x in self._filesToProcess if not x.endswith('.fai')]
+
     def _duplicateCracklingCodeAndConfig(self):
         pass
 
@@ -216,25 +244,19 @@ class ConfigManager():
     def isConfigured(self):
         return self._isConfigured
 
-    def getIterFilesToProcess(self):
-        fileId = 0
-        for file in self._filesToProcess:
+    def isResuming(self):
+        return self._resume
 
-            c = self._ConfigParser
+    def getRunDir(self):
+        # where the progress of the run is recorded, see RunCheckpoint
+        return os.path.join(self._ConfigParser['output']['dir'], f'{self.getConfigName()}-run')
 
-            name = self.getConfigName()
-
-            c['rnafold']['input'] = os.path.join(c['output']['dir'], f'{name}-rnafold-input.txt')
-            c['rnafold']['output'] = os.path.join(c['output']['dir'], f'{name}-rnafold-output.txt')
-
-            c['offtargetscore']['input'] = os.path.join(c['output']['dir'], f'{name}-{fileId}-offtargetscore-input.txt')
-            c['offtargetscore']['output'] = os.path.join(c['output']['dir'], f'{name}-{fileId}-offtargetscore-output.txt')
-
-            c['bowtie2']['input'] = os.path.join(c['output']['dir'], f'{name}-bowtie-input.txt')
-            c['bowtie2']['output'] = os.path.join(c['output']['dir'], f'{name}-bowtie-output.txt')
-
-            fileId += 1
+    def getIncrementalDir(self):
+        # where the results of the previous run are kept, see IncrementalRun
+        return os.path.join(self._ConfigParser['output']['dir'], f'{self.getConfigName()}-incremental')
 
+    def getIterFilesToProcess(self):
+        for file in self._filesToProcess:
             yield file
 
     def getLogMethod(self):
@@ -244,7 +266,8 @@ class ConfigManager():
             '{}-{}.log'.format(
                 self._ConfigParser['general']['name'],
                 self.getConfigName())
-            )
+            ),
+            'a' if self._resume else 'w+'
         )
 
     def getErrLogMethod(self):
@@ -254,7 +277,8 @@ class ConfigManager():
             '{}-{}.errlog'.format(
                 self._ConfigParser['general']['name'],
                 self.getConfigName())
-            )
+            ),
+            'a' if self._resume else 'w+'
         )
 
 
@@ -4,6 +4,16 @@ CODE_UNTESTED = "?"
 CODE_AMBIGUOUS = "-"
 CODE_ERROR = "!"
 
+# Compact integer encodings of the codes above, as stored in a GuideTable.
+# STATUS_VALUE marks a cell of a value column (e.g. `AT`) that holds a value
+# rather than a code.
+STATUS_REJECTED = 0
+STATUS_ACCEPTED = 1
+STATUS_UNTESTED = -1
+STATUS_AMBIGUOUS = -2
+STATUS_ERROR = -3
+STATUS_VALUE = 2
+
 MODULE_MM10DB = 'mm10db'
 MODULE_SGRNASCORER2 = 'sgrnascorer2'
 MODULE_CHOPCHOP = 'chopchop'
@@ -7,50 +7,32 @@ Config:
     - See config.ini
 '''
 
-import ast, csv, joblib, os, re, sys, time, tempfile
+import csv, sys, time
 
 from datetime import datetime
 import multiprocessing as mp
+import numpy as np
 
-from crackling.Paginator import Paginator
 from crackling.Batchinator import Batchinator
+from crackling.GuidePartitioner import GuidePartitioner, resolveSpillFile
+from crackling.GuideTable import GuideTable
+from crackling.IncrementalRun import IncrementalRun
+from crackling.RunCheckpoint import RunCheckpoint
+from crackling.SgRNAScorer2 import scoreGuides, acceptGuides
+from crackling.WorkerPool import WorkerPool
 from crackling.Constants import *
 from crackling.Helpers import *
-from crackling.FileProcessor import find_candidates_in_file
+from crackling.FileProcessor import find_candidates_in_file, partition_candidates_in_file, SIGNATURE_DTYPE
 
 
-def sgRNAScorer(key, lproxy, sgrnascorer_model):
-    d = lproxy[key]
+# Identifies the results of this pipeline, see IncrementalRun
+PIPELINE = 'Crackling'
 
-    # binary encoding
-    encoding = {
-        'A': '0001',    'C': '0010',    'T': '0100',    'G': '1000',
-        'K': '1100',    'M': '0011',    'R': '1001',    'Y': '0110',
-        'S': '1010',    'W': '0101',    'B': '1110',    'V': '1011',
-        'H': '0111',    'D': '1101',    'N': '1111'
-    }
-
-    clfLinear = joblib.load(sgrnascorer_model)
-
-    sequence = d.upper()
-    entryList = []
-
-    for x in range(0, 20):
-        for y in range(0, 4):
-            entryList.append(int(encoding[sequence[x]][y]))
-
-        # predict based on the entry
-        prediction = clfLinear.predict([entryList])
-        score = clfLinear.decision_function([entryList])[0]
-
-        d['sgrnascorer2score'] = score
-
-        if float(score) < float(float(configMngr['sgrnascorer2']['score-threshold'])):
-            d['acceptedBySgRnaScorer'] = CODE_REJECTED
-        else:
-            d['acceptedBySgRnaScorer'] = CODE_ACCEPTED
-    lproxy[key] = d
 
+def sgRNAScorer(guides, sgrnascorer_model):
+    # The model is loaded once per worker process, then the whole chunk of
+    # guides is scored at once
+    return scoreGuides(guides, sgrnascorer_model)
 
 
 def Crackling(configMngr):
@@ -69,196 +51,163 @@ def Crackling(configMngr):
 
     startTime = time.time()
 
-    ####################################
-    ###     Run-time Optimisation     ##
-    ####################################
-    def filterCandidateGuides(dictCandidateGuides, module):
-        nonlocal configMngr
-
-        module = module.lower()
-
-        optimisation = configMngr['general']['optimisation']
-
-        consensusN = int(configMngr['consensus']['n'])
-
-        for target23 in dictCandidateGuides:
-            doAssess = True
-
-            if optimisation == 'ultralow':
-                doAssess = True
-
-            if optimisation == 'low':
-                # Never assess guides that appear twice
-                if (candidateGuides[target23]['isUnique'] == CODE_REJECTED):
-                    doAssess = False
-
-            if optimisation == 'medium':
-                # Never assess guides that appear twice
-                if (candidateGuides[target23]['isUnique'] == CODE_REJECTED):
-                    doAssess = False
-
-                # For mm10db:
-                if (module == MODULE_MM10DB):
-                    # if any of the mm10db tests have failed, then fail them all
-                    if (CODE_REJECTED in [
-                        candidateGuides[target23]['passedAvoidLeadingT'],
-                        candidateGuides[target23]['passedATPercent'],
-                        candidateGuides[target23]['passedTTTT'],
-                        candidateGuides[target23]['passedSecondaryStructure'],
-                        candidateGuides[target23]['acceptedByMm10db'],
-                    ]):
-                        doAssess = False
-
-                # For CHOPCHOP:
-                # Always assess, unless the guide is seen multiple times
-
-                # For sgRNAScorer2:
-                # Always assess, unless the guide is seen multiple times
-
-                # For specificity:
-                if (module == MODULE_SPECIFICITY):
-                    # don't assess if they failed consensus
-                    if (int(candidateGuides[target23]['consensusCount']) < consensusN):
-                        doAssess = False
-
-                    # don't assess if they failed Bowtie
-                    if (candidateGuides[target23]['passedBowtie'] == CODE_REJECTED):
-                        doAssess = False
-
-            if optimisation == 'high':
-                # Never assess guides that appear twice
-                if (candidateGuides[target23]['isUnique'] == CODE_REJECTED):
-                    doAssess = False
-
-                # For efficiency
-                if module in [MODULE_CHOPCHOP, MODULE_MM10DB, MODULE_SGRNASCORER2]:
-
-                    # `consensusCount` cannot be used yet as it may not have been
-                    # calculated. instead, calculate it on-the-go.
-                    countAlreadyAccepted = sum([
-                        candidateGuides[target23]['acceptedByMm10db'] == CODE_ACCEPTED,
-                        candidateGuides[target23]['passedG20'] == CODE_ACCEPTED,
-                        candidateGuides[target23]['acceptedBySgRnaScorer'] == CODE_ACCEPTED,
-                    ])
-
-                    countAlreadyAssessed = sum([
-                        candidateGuides[target23]['acceptedByMm10db'] in [CODE_ACCEPTED, CODE_REJECTED],
-                        candidateGuides[target23]['passedG20'] in [CODE_ACCEPTED, CODE_REJECTED],
-                        candidateGuides[target23]['acceptedBySgRnaScorer'] in [CODE_ACCEPTED, CODE_REJECTED],
-                    ])
-
-                    countToolsInConsensus = sum([
-                        configMngr['consensus'].getboolean('mm10db'),
-                        configMngr['consensus'].getboolean('chopchop'),
-                        configMngr['consensus'].getboolean('sgRNAScorer2'),
-                    ])
-
-                    # Do not assess if passed consensus already
-                    if countAlreadyAccepted >= consensusN:
-                        doAssess = False
-
-                    # Do not assess if there are not enough remaining tests to pass consensus
-                    #   i.e. if the number of remaining tests is less than what is needed to pass then do not assess
-                    if countToolsInConsensus - countAlreadyAssessed < consensusN - countAlreadyAccepted:
-                        doAssess = False
-
-                    # For mm10db:
-                    if module == MODULE_MM10DB:
-                        # if any of the mm10db tests have failed, then fail them all
-                        if (CODE_REJECTED in [
-                            candidateGuides[target23]['passedAvoidLeadingT'],
-                            candidateGuides[target23]['passedATPercent'],
-                            candidateGuides[target23]['passedTTTT'],
-                            candidateGuides[target23]['passedSecondaryStructure'],
-                            candidateGuides[target23]['acceptedByMm10db'],
-                        ]):
-                            doAssess = False
-
-                # For specificity:
-                if (module == MODULE_SPECIFICITY):
-                    # don't assess if they failed consensus
-                    if (int(candidateGuides[target23]['consensusCount']) < consensusN):
-                        doAssess = False
-
-                    # don't assess if they failed Bowtie
-                    if (candidateGuides[target23]['passedBowtie'] == CODE_REJECTED):
-                        doAssess = False
-
-            if doAssess:
-                yield target23
-
-
     ###################################
     ##   Processing the input file   ##
     ###################################
 
-    printer('Analysing files...')
+    # With duplicate-partitions > 0, guides are spilled to disk and duplicates
+    # are resolved one partition at a time, instead of in memory
+    duplicatePartitions = configMngr['input'].getint('duplicate-partitions', fallback=0)
+
+    # With incremental runs, the results of the previous run are reused for
+    # the guides that have not changed since (see IncrementalRun)
+    incremental = None
+    if configMngr['output'].getboolean('incremental', fallback=False):
+        incremental = IncrementalRun(configMngr.getIncrementalDir(), configMngr, PIPELINE)
+        if not configMngr.isResuming():
+            incremental.releaseOutput(configMngr['output']['file'])
+
+    # With checkpoints, the progress of the run is recorded in a run directory
+    # so that it can be resumed once interrupted (see RunCheckpoint)
+    checkpoint = None
+    if configMngr['output'].getboolean('checkpoint', fallback=False):
+        checkpoint = RunCheckpoint(configMngr.getRunDir(), configMngr.isResuming())
+        checkpoint.truncateOutput(configMngr['output']['file'])
+
+    extractionMode = 'partitions' if duplicatePartitions > 0 else 'batches'
+
+    if checkpoint is not None and checkpoint.isExtracted():
+        if checkpoint.extractionMode() != extractionMode:
+            raise ValueError(f'The run to resume was extracted into {checkpoint.extractionMode()}, not {extractionMode}. Check duplicate-partitions.')
+
+        printer('Extraction is complete, the guides will be read from the run directory.')
+
+        batchSources = checkpoint.sources()
+        sequenceHeaders = checkpoint.headers()
+        duplicateGuides = checkpoint.duplicateGuides()
+    else:
+        printer('Analysing files...')
+
+        # With checkpoints, the guides are extracted into the run directory
+        workingDir = checkpoint.extractionDir() if checkpoint is not None else None
+
+        # Guides (as sorted 2-bit signatures) and sequences seen before
+        candidateGuides = np.zeros(0, dtype=SIGNATURE_DTYPE)
+        duplicateGuides = np.zeros(0, dtype=SIGNATURE_DTYPE)
+        recordedSequences = set()
+
+        if duplicatePartitions > 0:
+            guideBatchinator = GuidePartitioner(duplicatePartitions, workingDir)
+
+            printer(f'GuidePartitioner is writing to: {guideBatchinator.workingDir.name}')
+        else:
+            guideBatchinator = Batchinator(int(configMngr['input']['batch-size']), workingDir)
+
+            printer(f'Batchinator is writing to: {guideBatchinator.workingDir.name}')
+
+        for seqFilePath in configMngr.getIterFilesToProcess():
 
-    # Sets to keep track of Guides and sequences seen before
-    candidateGuides = set()
-    duplicateGuides = set()
-    recordedSequences = set()
+            # The guides of an unchanged file are read from the incremental directory
+            results = incremental.findGuides(seqFilePath) if incremental is not None else None
 
-    guideBatchinator = Batchinator(int(configMngr['input']['batch-size']))
+            if duplicatePartitions > 0:
+                recordedSequences, fileSize, numIdentifiedGuides = partition_candidates_in_file(guideBatchinator, seqFilePath, recordedSequences, results)
+                completedSizeBytes += fileSize
 
-    printer(f'Batchinator is writing to: {guideBatchinator.workingDir.name}')
+                printer(f'\tIdentified {numIdentifiedGuides:,} possible target sites in this file.')
+                printer('\tDuplicates will be removed once every file has been processed.')
 
-    for seqFilePath in configMngr.getIterFilesToProcess():
+                completedPercent = round(completedSizeBytes / totalSizeBytes * 100.0, 3)
+                printer(f'\tExtracted from {completedPercent}% of input')
+                continue
 
-        start_time = time.time()
+            candidateGuides, duplicateGuides, recordedSequences, fileSize, numIdentifiedGuides, numDuplicateGuides = find_candidates_in_file(guideBatchinator, seqFilePath, candidateGuides, duplicateGuides, recordedSequences, results)
+            completedSizeBytes += fileSize
 
-        candidateGuides, duplicateGuides, recordedSequences, fileSize, numIdentifiedGuides, numDuplicateGuides = find_candidates_in_file(guideBatchinator, seqFilePath, candidateGuides, duplicateGuides, recordedSequences)
-        completedSizeBytes += fileSize
+            duplicatePercent = round(numDuplicateGuides / numIdentifiedGuides * 100.0, 3)
+            printer(f'\tIdentified {numIdentifiedGuides:,} possible target sites in this file.')
+            printer(f'\tOf these, {len(duplicateGuides):,} are not unique. These sites occur a total of {numDuplicateGuides} times.')
+            printer(f'\tRemoving {numDuplicateGuides:,} of {numIdentifiedGuides:,} ({duplicatePercent}%) guides.')
+            printer(f'\t{len(candidateGuides):,} distinct guides have been discovered so far.')
 
-        duplicatePercent = round(numDuplicateGuides / numIdentifiedGuides * 100.0, 3)
-        printer(f'\tIdentified {numIdentifiedGuides:,} possible target sites in this file.')
-        printer(f'\tOf these, {len(duplicateGuides):,} are not unique. These sites occur a total of {numDuplicateGuides} times.')
-        printer(f'\tRemoving {numDuplicateGuides:,} of {numIdentifiedGuides:,} ({duplicatePercent}%) guides.')
-        printer(f'\t{len(candidateGuides):,} distinct guides have been discovered so far.')
+            completedPercent = round(completedSizeBytes / totalSizeBytes * 100.0, 3)
+            printer(f'\tExtracted from {completedPercent}% of input')
 
-        completedPercent = round(completedSizeBytes / totalSizeBytes * 100.0, 3)
-        printer(f'\tExtracted from {completedPercent}% of input')
+        # The source of each batch: a batch file, or the spill file of a partition
+        batchSources = guideBatchinator.close()
+        sequenceHeaders = guideBatchinator.headers
 
-    # Write header line for output file
-    with open(configMngr['output']['file'], 'a+') as fOpen:
-        csvWriter = csv.writer(fOpen, delimiter=configMngr['output']['delimiter'],
-                        quotechar='"',dialect='unix', quoting=csv.QUOTE_MINIMAL)
+        if checkpoint is not None:
+            batchSources = checkpoint.saveExtraction(extractionMode, batchSources, sequenceHeaders, duplicateGuides)
 
-        csvWriter.writerow(DEFAULT_GUIDE_PROPERTIES_ORDER)
+        # Clean up unused variables
+        del candidateGuides
+        del recordedSequences
 
-    # Clean up unused variables
-    del candidateGuides
-    del recordedSequences
+    # Write header line for output file, unless it was before the run was interrupted
+    if checkpoint is None or checkpoint.outputSize() == 0:
+        with open(configMngr['output']['file'], 'a+') as fOpen:
+            csvWriter = csv.writer(fOpen, delimiter=configMngr['output']['delimiter'],
+                            quotechar='"',dialect='unix', quoting=csv.QUOTE_MINIMAL)
+
+            csvWriter.writerow(DEFAULT_GUIDE_PROPERTIES_ORDER)
+
+        if checkpoint is not None:
+            checkpoint.saveOutput(configMngr['output']['file'])
+
+    sequenceHeaders = np.array(sequenceHeaders, dtype=object)
+
+    def loadBatch(batchFileId):
+        source = batchSources[batchFileId]
+
+        # A partition is resolved into a guide table. With checkpoints, its
+        # spill file is kept until the batch has been written.
+        if duplicatePartitions > 0:
+            return resolveSpillFile(source, sequenceHeaders, remove=checkpoint is None)[0]
+
+        # Map the (binary) batch file into memory
+        batch = Batchinator.loadBatch(source)
+        # Rebuild the guide table from the batch
+        return GuideTable.fromColumns(
+            batch['signature'],
+            sequenceHeaders[batch['header']],
+            batch['start'],
+            batch['end'],
+            batch['strand'].astype('U1'),
+            duplicateGuides
+        )
+
+
+    # One pool of workers is shared by every batch
+    workerPool = WorkerPool(mp.cpu_count())
+
+    for batchFileId in range(len(batchSources)):
+        candidateGuides = None
+        completedStages = []
 
+        if checkpoint is not None:
+            if checkpoint.isOutput(batchFileId):
+                printer(f'Batch file {(batchFileId+1):,} is complete, skipping it.')
+                continue
+
+            # The guide table after the last completed stage, if any
+            candidateGuides = checkpoint.loadBatch(batchFileId)
+            completedStages = checkpoint.completedStages(batchFileId)
+
+        # With incremental runs, only the guides without a reusable row are scored
+        reusedRows = None
+        if incremental is not None:
+            batchGuides = loadBatch(batchFileId)
+            reusedRows = incremental.reusedRows(batchGuides)
+            if candidateGuides is None:
+                candidateGuides = batchGuides.take(reusedRows.newIdx())
+
+        if candidateGuides is None:
+            candidateGuides = loadBatch(batchFileId)
 
-    batchFileId = 0
-    for batchFile in guideBatchinator:
         batchStartTime = time.time()
 
-        printer(f'Processing batch file {(batchFileId+1):,} of {len(guideBatchinator)}')
-
-        # Create new candidate guide dictionary
-        candidateGuides = {}
-        # Load guides from temp file
-        with open(batchFile, 'r') as inputFp:
-            # Create csv reader to parse temp file
-            csvReader = csv.reader(inputFp, delimiter=configMngr['output']['delimiter'],
-                quotechar='"',dialect='unix', quoting=csv.QUOTE_MINIMAL)
-            # Rebuild dictonary from temp file
-            for row in csvReader:
-                candidateGuides[row[0]] = DEFAULT_GUIDE_PROPERTIES.copy()
-                candidateGuides[row[0]]['seq'] = row[0]
-                if row[0] in duplicateGuides:
-                    candidateGuides[row[0]]['header'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['start'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['end'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['strand'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['isUnique'] = CODE_REJECTED
-                else:
-                    candidateGuides[row[0]]['header'] = row[1]
-                    candidateGuides[row[0]]['start'] = row[2]
-                    candidateGuides[row[0]]['end'] = row[3]
-                    candidateGuides[row[0]]['strand'] = row[4]
+        printer(f'Processing batch file {(batchFileId+1):,} of {len(batchSources)}')
 
         printer(f'\tLoaded {len(candidateGuides):,} guides')
 
@@ -266,22 +215,24 @@ def Crackling(configMngr):
         ##        Multiprocessing        ##
         ###################################
 
-        manager = mp.Manager()
-        mpd = manager.dict(candidateGuides)
-        pool = mp.Pool(mp.cpu_count())
-
         # Start timing
         start = datetime.now()
         printer('Starting process sequence')
 
-        # Call function using starmap and shared result dict
-        # this is where the multiprocessing is implemented, however it tends to add to runtime
-        pool.starmap(sgRNAScorer, [(key, mpd, configMngr['sgrnascorer2']['model'])
-                     for key in mpd])
-        pool.close()
+        if 'sgrnascorer2' in completedStages:
+            printer(f'Batch file {(batchFileId+1):,}: sgrnascorer2 is complete, skipping it.')
+        else:
+            # Each worker scores a contiguous chunk of the batch, read from shared
+            # memory. The results are written to the table in bulk.
+            scores = workerPool.map(sgRNAScorer, candidateGuides.seqMatrix(), configMngr['sgrnascorer2']['model'])
+            candidateGuides.setValues('sgrnascorer2score', slice(None), scores)
+            candidateGuides['acceptedBySgRnaScorer'][:] = acceptGuides(scores, configMngr['sgrnascorer2']['score-threshold'])
+
+            if checkpoint is not None:
+                checkpoint.saveStage(batchFileId, 'sgrnascorer2', candidateGuides)
 
-        print({mpd[c]['passedATPercent']
-              for c in mpd})
+        failedCount = int(np.count_nonzero(candidateGuides['acceptedBySgRnaScorer'] == STATUS_REJECTED))
+        printer(f'\t{failedCount:,} of {len(candidateGuides):,} failed here.')
 
         # Stop timing
         end = datetime.now()
@@ -301,28 +252,13 @@ def Crackling(configMngr):
             csvWriter = csv.writer(fOpen, delimiter=configMngr['output']['delimiter'],
                                    quotechar='"', dialect='unix', quoting=csv.QUOTE_MINIMAL)
 
-            for target23 in mpd:
-                output = [mpd[target23][x]
-                          for x in DEFAULT_GUIDE_PROPERTIES_ORDER]
+            if reusedRows is not None:
+                incremental.writeRows(fOpen, csvWriter, candidateGuides.rows(), reusedRows)
+            else:
+                csvWriter.writerows(candidateGuides.rows())
 
-                csvWriter.writerow(output)
-
-        #########################################
-        ##              Clean up               ##
-        #########################################
-        printer('Cleaning auxiliary files')
-        for f in [
-            configMngr['rnafold']['input'],
-            configMngr['rnafold']['output'],
-            configMngr['offtargetscore']['input'],
-            configMngr['offtargetscore']['output'],
-            configMngr['bowtie2']['input'],
-            configMngr['bowtie2']['output'],
-        ]:
-            try:
-                os.remove(f)
-            except:
-                pass
+        if checkpoint is not None:
+            checkpoint.saveOutput(configMngr['output']['file'], batchFileId, batchSources[batchFileId])
 
         #########################################
         ##               Done                  ##
@@ -333,13 +269,18 @@ def Crackling(configMngr):
 
         printer('Ran in {} (dd hh:mm:ss) or {} seconds'.format(
             time.strftime('%d %H:%M:%S', time.gmtime(
-                (time.time() - start_time))),
-            (time.time() - start_time)
+                (time.time() - batchStartTime))),
+            (time.time() - batchStartTime)
         ))
 
-        lastRunTimeSec = time.time() - start_time
+        lastRunTimeSec = time.time() - batchStartTime
         totalRunTimeSec += lastRunTimeSec
 
+    workerPool.close()
+
+    if incremental is not None:
+        incremental.commit(configMngr['output']['file'], configMngr['output']['delimiter'])
+
     printer('Total run time (dd hh:mm:ss) {} or {} seconds'.format(
         time.strftime('%d %H:%M:%S', time.gmtime(totalRunTimeSec)),
         totalRunTimeSec
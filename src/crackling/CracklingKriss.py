@@ -10,12 +10,10 @@ Config:
 import argparse
 import ast
 import csv
-import joblib
 import os
 import re
 import sys
 import time
-import tempfile
 import psutil
 
 from datetime import datetime
@@ -25,7 +23,8 @@ from Paginator import Paginator
 from Batchinator import Batchinator
 from Constants import *
 from Helpers import *
-import multiprocessing as mp
+from SgRNAScorer2 import scoreGuides, acceptGuides
+from FileProcessor import read_fasta_records, decode_guides
 
 #########################################
 ##   Removing targets with leading T   ##
@@ -68,43 +67,6 @@ def remove_TTTT(key, lproxy):
         d['passedTTTT'] = CODE_ACCEPTED
     lproxy[key] = d
 
-    #########################################
-    ##         sgRNAScorer 2.0 model       ##
-    #########################################
-
-
-def sgRNAScorer(key, lproxy):
-    d = lproxy[key]
-
-    # binary encoding
-    encoding = {
-        'A': '0001',    'C': '0010',    'T': '0100',    'G': '1000',
-        'K': '1100',    'M': '0011',    'R': '1001',    'Y': '0110',
-        'S': '1010',    'W': '0101',    'B': '1110',    'V': '1011',
-        'H': '0111',    'D': '1101',    'N': '1111'
-    }
-
-    clfLinear = joblib.load(configMngr['sgrnascorer2']['model'])
-
-    sequence = d.upper()
-    entryList = []
-
-    for x in range(0, 20):
-        for y in range(0, 4):
-            entryList.append(int(encoding[sequence[x]][y]))
-
-        # predict based on the entry
-        prediction = clfLinear.predict([entryList])
-        score = clfLinear.decision_function([entryList])[0]
-
-        d['sgrnascorer2score'] = score
-
-        if float(score) < float(float(configMngr['sgrnascorer2']['score-threshold'])):
-            d['acceptedBySgRnaScorer'] = CODE_REJECTED
-        else:
-            d['acceptedBySgRnaScorer'] = CODE_ACCEPTED
-    lproxy[key] = d
-
 
 def SecondsConversion(list):
     totalTime = 0
@@ -274,64 +236,29 @@ def Crackling(configMngr):
 
         completedSizeBytes += lastScaffoldSizeBytes
 
-        # We first remove all the line breaks within a given sequence (FASTA format)
-        with open(seqFilePath, 'r') as inFile, tempfile.NamedTemporaryFile(mode='w', delete=False) as parsedFile:
-            for line in inFile:
-                line = line.strip()
-                if line[0] == '>':
-                    # this is the header line for a new sequence, so we break the previous line and write the header as a new line
-                    parsedFile.write('\n'+line+'\n')
-                else:
-                    # this is (part of) the sequence; we write it without line break
-                    parsedFile.write(line.strip())
-
         guideBatchinator = Batchinator(int(configMngr['input']['batch-size']))
 
-        with open(parsedFile.name, 'r') as inFile:
-            seqHeader = ''
-            seq = ''
-            for line in inFile:
-                # Remove garbage from line
-                line = line.strip()
-                # Some lines (e.g., first line in file) can be just a line break, move to next line
-                if line == '':
-                    continue
-                # Header line, start of a new sequence
-                elif line[0] == '>':
-                    # If we haven't seen the sequence OR we have found a sequence without header
-                    if (seqHeader not in recordedSequences) or (seqHeader == '' and seq != ''):
-                        # Record header
-                        recordedSequences.add(seqHeader)
-                        # Process the sequence
-                        for guide in processSequence(seq):
-                            # Check if guide has been seen before
-                            if guide[0] not in candidateGuides:
-                                # Record guide
-                                candidateGuides.add(guide[0])
-                                # Record candidate guide to temp file
-                                guideBatchinator.recordEntry(guide)
-                            else:
-                                # Record duplicate guide
-                                duplicateGuides.add(guide[0])
-                    # Update sequence and sequence header
-                    seqHeader = line[1:]
-                    seq = ''
-                # Sequence line, section of existing sequence
-                else:
-                    # Append section to total sequence
-                    seq += line.strip()
-
-            # Process the last sequence
-            for guide in processSequence(seq):
-                # Check if guide has been seen before
-                if guide[0] not in candidateGuides:
-                    # Record guide
-                    candidateGuides.add(guide[0])
-                    # Record candidate guide to temp file
-                    guideBatchinator.recordEntry(guide)
-                else:
-                    # Record duplicate guide
-                    duplicateGuides.add(guide[0])
+        # Each sequence is read straight from the (plain or gzip) FASTA file,
+        # without line breaks
+        for seqHeader, seq in read_fasta_records(seqFilePath):
+            seqHeader = seqHeader or ''
+            seq = seq.decode()
+
+            # If we haven't seen the sequence OR we have found a sequence without header
+            if (seqHeader not in recordedSequences) or (seqHeader == '' and seq != ''):
+                # Record header
+                recordedSequences.add(seqHeader)
+                # Process the sequence
+                for guide in processSequence(seq):
+                    # Check if guide has been seen before
+                    if guide[0] not in candidateGuides:
+                        # Record guide
+                        candidateGuides.add(guide[0])
+                        # Record candidate guide to temp file
+                        guideBatchinator.recordEntry(guide)
+                    else:
+                        # Record duplicate guide
+                        duplicateGuides.add(guide[0])
 
         printer(f'Identified {len(candidateGuides)} possible target sites.')
 
@@ -350,7 +277,6 @@ def Crackling(configMngr):
         csvWriter.writerow(DEFAULT_GUIDE_PROPERTIES_ORDER)
 
     # Clean up unused variables
-    os.unlink(parsedFile.name)
     del candidateGuides
     del recordedSequences
 
@@ -362,26 +288,29 @@ def Crackling(configMngr):
 
         # Create new candidate guide dictionary
         candidateGuides = {}
-        # Load guides from temp file
-        with open(batchFile, 'r') as inputFp:
-            # Create csv reader to parse temp file
-            csvReader = csv.reader(inputFp, delimiter=configMngr['output']['delimiter'],
-                                   quotechar='"', dialect='unix', quoting=csv.QUOTE_MINIMAL)
-            # Rebuild dictonary from temp file
-            for row in csvReader:
-                candidateGuides[row[0]] = DEFAULT_GUIDE_PROPERTIES.copy()
-                candidateGuides[row[0]]['seq'] = row[0]
-                if row[0] in duplicateGuides:
-                    candidateGuides[row[0]]['header'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['start'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['end'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['strand'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['seenDuplicate'] = CODE_REJECTED
-                else:
-                    candidateGuides[row[0]]['header'] = row[1]
-                    candidateGuides[row[0]]['start'] = row[2]
-                    candidateGuides[row[0]]['end'] = row[3]
-                    candidateGuides[row[0]]['strand'] = row[4]
+        # Map the (binary) batch file into memory
+        batch = guideBatchinator.loadBatch(batchFile)
+        # Rebuild dictonary from the batch
+        for seq, header, start, end, strand in zip(
+            decode_guides(batch['signature']).astype('U23').tolist(),
+            guideBatchinator.batchHeaders(batch).tolist(),
+            batch['start'].tolist(),
+            batch['end'].tolist(),
+            batch['strand'].astype('U1').tolist()
+        ):
+            candidateGuides[seq] = DEFAULT_GUIDE_PROPERTIES.copy()
+            candidateGuides[seq]['seq'] = seq
+            if seq in duplicateGuides:
+                candidateGuides[seq]['header'] = CODE_AMBIGUOUS
+                candidateGuides[seq]['start'] = CODE_AMBIGUOUS
+                candidateGuides[seq]['end'] = CODE_AMBIGUOUS
+                candidateGuides[seq]['strand'] = CODE_AMBIGUOUS
+                candidateGuides[seq]['seenDuplicate'] = CODE_REJECTED
+            else:
+                candidateGuides[seq]['header'] = header
+                candidateGuides[seq]['start'] = start
+                candidateGuides[seq]['end'] = end
+                candidateGuides[seq]['strand'] = strand
 
         printer(
             f'Loaded batch {guideBatchinator.currentBatch} of {len(guideBatchinator.batchFiles)}')
@@ -390,22 +319,20 @@ def Crackling(configMngr):
         ##        Multiprocessing        ##
         ###################################
 
-        manager = mp.Manager()
-        mpd = manager.dict(candidateGuides)
-        pool = mp.Pool(mp.cpu_count())
-
         # Start timing
         start = datetime.now()
         printer('Starting process sequence')
 
-        # Call function using starmap and shared result dict
-        # this is where the multiprocessing is implemented, however it tends to add to runtime
-        pool.starmap(sgRNAScorer, [(key, mpd)
-                     for key in mpd])
-        pool.close()
+        # Score the whole batch in one call, rather than one worker call per guide
+        scores = scoreGuides(list(candidateGuides), configMngr['sgrnascorer2']['model'])
+        statuses = acceptGuides(scores, configMngr['sgrnascorer2']['score-threshold'])
 
-        print({mpd[c]['passedATPercent']
-              for c in mpd})
+        for target23, score, status in zip(candidateGuides, scores, statuses):
+            candidateGuides[target23]['sgrnascorer2score'] = score
+            if status == STATUS_REJECTED:
+                candidateGuides[target23]['acceptedBySgRnaScorer'] = CODE_REJECTED
+            else:
+                candidateGuides[target23]['acceptedBySgRnaScorer'] = CODE_ACCEPTED
 
         # Stop timing
         end = datetime.now()
@@ -425,29 +352,12 @@ def Crackling(configMngr):
             csvWriter = csv.writer(fOpen, delimiter=configMngr['output']['delimiter'],
                                    quotechar='"', dialect='unix', quoting=csv.QUOTE_MINIMAL)
 
-            for target23 in mpd:
-                output = [mpd[target23][x]
+            for target23 in candidateGuides:
+                output = [candidateGuides[target23][x]
                           for x in DEFAULT_GUIDE_PROPERTIES_ORDER]
 
                 csvWriter.writerow(output)
 
-        #########################################
-        ##              Clean up               ##
-        #########################################
-        printer('Cleaning auxiliary files')
-        for f in [
-            configMngr['rnafold']['input'],
-            configMngr['rnafold']['output'],
-            configMngr['offtargetscore']['input'],
-            configMngr['offtargetscore']['output'],
-            configMngr['bowtie2']['input'],
-            configMngr['bowtie2']['output'],
-        ]:
-            try:
-                os.remove(f)
-            except:
-                pass
-
         #########################################
         ##               Done                  ##
         #########################################
@@ -7,13 +7,41 @@ Config:
     - See config.ini
 '''
 
-import ast, csv, joblib, os, re, sys, time, tempfile
+import ast, csv, re, sys, time
+import multiprocessing as mp
+import numpy as np
 
 from crackling.Paginator import Paginator
 from crackling.Batchinator import Batchinator
+from crackling.Bowtie2Aligner import Bowtie2Aligner
+from crackling.GuidePartitioner import GuidePartitioner, resolveSpillFile
+from crackling.CandidateFilter import compileFilter
+from crackling.EfficiencyRules import evaluateRules
+from crackling.GuideTable import GuideTable
+from crackling.IncrementalRun import IncrementalRun
+from crackling.Issl import load_index, targetSignatures
+from crackling.IsslServer import IsslServer
+from crackling.RnaFoldPool import RnaFoldPool
+from crackling.RunCheckpoint import RunCheckpoint
+from crackling.SgRNAScorer2 import scoreGuides, acceptGuides
+from crackling.StagePipeline import StagePipeline
+from crackling.WorkerPool import WorkerPool
 from crackling.Constants import *
 from crackling.Helpers import *
-from crackling.FileProcessor import find_candidates_in_file
+from crackling.FileProcessor import find_candidates_in_file, partition_candidates_in_file, SIGNATURE_DTYPE
+
+
+# Identifies the results of this pipeline, see IncrementalRun
+PIPELINE = 'CracklingOriginal'
+
+
+#########################################
+##  Per-chunk workers (see WorkerPool)  ##
+#########################################
+
+def sgRNAScorer(guides, sgrnascorer_model):
+    # The model is loaded once per worker process
+    return scoreGuides(guides, sgrnascorer_model)
 
 
 def Crackling(configMngr):
@@ -35,209 +63,214 @@ def Crackling(configMngr):
     ####################################
     ###     Run-time Optimisation     ##
     ####################################
-    def filterCandidateGuides(dictCandidateGuides, module):
-        nonlocal configMngr
-
-        module = module.lower()
-
-        optimisation = configMngr['general']['optimisation']
-
-        consensusN = int(configMngr['consensus']['n'])
-
-        for target23 in dictCandidateGuides:
-            doAssess = True
-
-            if optimisation == 'ultralow':
-                doAssess = True
-
-            if optimisation == 'low':
-                # Never assess guides that appear twice
-                if (candidateGuides[target23]['isUnique'] == CODE_REJECTED):
-                    doAssess = False
-
-            if optimisation == 'medium':
-                # Never assess guides that appear twice
-                if (candidateGuides[target23]['isUnique'] == CODE_REJECTED):
-                    doAssess = False
-
-                # For mm10db:
-                if (module == MODULE_MM10DB):
-                    # if any of the mm10db tests have failed, then fail them all
-                    if (CODE_REJECTED in [
-                        candidateGuides[target23]['passedAvoidLeadingT'],
-                        candidateGuides[target23]['passedATPercent'],
-                        candidateGuides[target23]['passedTTTT'],
-                        candidateGuides[target23]['passedSecondaryStructure'],
-                        candidateGuides[target23]['acceptedByMm10db'],
-                    ]):
-                        doAssess = False
-
-                # For CHOPCHOP:
-                # Always assess, unless the guide is seen multiple times
-
-                # For sgRNAScorer2:
-                # Always assess, unless the guide is seen multiple times
-
-                # For specificity:
-                if (module == MODULE_SPECIFICITY):
-                    # don't assess if they failed consensus
-                    if (int(candidateGuides[target23]['consensusCount']) < consensusN):
-                        doAssess = False
-
-                    # don't assess if they failed Bowtie
-                    if (candidateGuides[target23]['passedBowtie'] == CODE_REJECTED):
-                        doAssess = False
-
-            if optimisation == 'high':
-                # Never assess guides that appear twice
-                if (candidateGuides[target23]['isUnique'] == CODE_REJECTED):
-                    doAssess = False
-
-                # For efficiency
-                if module in [MODULE_CHOPCHOP, MODULE_MM10DB, MODULE_SGRNASCORER2]:
-
-                    # `consensusCount` cannot be used yet as it may not have been
-                    # calculated. instead, calculate it on-the-go.
-                    countAlreadyAccepted = sum([
-                        candidateGuides[target23]['acceptedByMm10db'] == CODE_ACCEPTED,
-                        candidateGuides[target23]['passedG20'] == CODE_ACCEPTED,
-                        candidateGuides[target23]['acceptedBySgRnaScorer'] == CODE_ACCEPTED,
-                    ])
-
-                    countAlreadyAssessed = sum([
-                        candidateGuides[target23]['acceptedByMm10db'] in [CODE_ACCEPTED, CODE_REJECTED],
-                        candidateGuides[target23]['passedG20'] in [CODE_ACCEPTED, CODE_REJECTED],
-                        candidateGuides[target23]['acceptedBySgRnaScorer'] in [CODE_ACCEPTED, CODE_REJECTED],
-                    ])
-
-                    countToolsInConsensus = sum([
-                        configMngr['consensus'].getboolean('mm10db'),
-                        configMngr['consensus'].getboolean('chopchop'),
-                        configMngr['consensus'].getboolean('sgRNAScorer2'),
-                    ])
-
-                    # Do not assess if passed consensus already
-                    if countAlreadyAccepted >= consensusN:
-                        doAssess = False
-
-                    # Do not assess if there are not enough remaining tests to pass consensus
-                    #   i.e. if the number of remaining tests is less than what is needed to pass then do not assess
-                    if countToolsInConsensus - countAlreadyAssessed < consensusN - countAlreadyAccepted:
-                        doAssess = False
-
-                    # For mm10db:
-                    if module == MODULE_MM10DB:
-                        # if any of the mm10db tests have failed, then fail them all
-                        if (CODE_REJECTED in [
-                            candidateGuides[target23]['passedAvoidLeadingT'],
-                            candidateGuides[target23]['passedATPercent'],
-                            candidateGuides[target23]['passedTTTT'],
-                            candidateGuides[target23]['passedSecondaryStructure'],
-                            candidateGuides[target23]['acceptedByMm10db'],
-                        ]):
-                            doAssess = False
-
-                # For specificity:
-                if (module == MODULE_SPECIFICITY):
-                    # don't assess if they failed consensus
-                    if (int(candidateGuides[target23]['consensusCount']) < consensusN):
-                        doAssess = False
-
-                    # don't assess if they failed Bowtie
-                    if (candidateGuides[target23]['passedBowtie'] == CODE_REJECTED):
-                        doAssess = False
-
-            if doAssess:
-                yield target23
+    # The policy of the optimisation level is read once, and evaluated on whole
+    # status columns (see CandidateFilter)
+    filterCandidateGuides = compileFilter(
+        configMngr['general']['optimisation'],
+        int(configMngr['consensus']['n']),
+        sum([
+            configMngr['consensus'].getboolean('mm10db'),
+            configMngr['consensus'].getboolean('chopchop'),
+            configMngr['consensus'].getboolean('sgRNAScorer2'),
+        ]),
+    )
 
 
     ###################################
     ##   Processing the input file   ##
     ###################################
 
-    printer('Analysing files...')
+    # With duplicate-partitions > 0, guides are spilled to disk and duplicates
+    # are resolved one partition at a time, instead of in memory
+    duplicatePartitions = configMngr['input'].getint('duplicate-partitions', fallback=0)
 
-    # Sets to keep track of Guides and sequences seen before
-    candidateGuides = set()
-    duplicateGuides = set()
-    recordedSequences = set()
+    # With incremental runs, the results of the previous run are reused for
+    # the guides that have not changed since (see IncrementalRun)
+    incremental = None
+    if configMngr['output'].getboolean('incremental', fallback=False):
+        incremental = IncrementalRun(configMngr.getIncrementalDir(), configMngr, PIPELINE)
+        if not configMngr.isResuming():
+            incremental.releaseOutput(configMngr['output']['file'])
 
-    guideBatchinator = Batchinator(int(configMngr['input']['batch-size']))
+    # With checkpoints, the progress of the run is recorded in a run directory
+    # so that it can be resumed once interrupted (see RunCheckpoint)
+    checkpoint = None
+    if configMngr['output'].getboolean('checkpoint', fallback=False):
+        checkpoint = RunCheckpoint(configMngr.getRunDir(), configMngr.isResuming())
+        checkpoint.truncateOutput(configMngr['output']['file'])
 
-    printer(f'Batchinator is writing to: {guideBatchinator.workingDir.name}')
+    extractionMode = 'partitions' if duplicatePartitions > 0 else 'batches'
 
-    for seqFilePath in configMngr.getIterFilesToProcess():
+    if checkpoint is not None and checkpoint.isExtracted():
+        if checkpoint.extractionMode() != extractionMode:
+            raise ValueError(f'The run to resume was extracted into {checkpoint.extractionMode()}, not {extractionMode}. Check duplicate-partitions.')
 
-        candidateGuides, duplicateGuides, recordedSequences, fileSize, numIdentifiedGuides, numDuplicateGuides = find_candidates_in_file(guideBatchinator, seqFilePath, candidateGuides, duplicateGuides, recordedSequences)
-        completedSizeBytes += fileSize
+        printer('Extraction is complete, the guides will be read from the run directory.')
 
-        duplicatePercent = round(numDuplicateGuides / numIdentifiedGuides * 100.0, 3)
-        printer(f'\tIdentified {numIdentifiedGuides:,} possible target sites in this file.')
-        printer(f'\tOf these, {len(duplicateGuides):,} are not unique. These sites occur a total of {numDuplicateGuides} times.')
-        printer(f'\tRemoving {numDuplicateGuides:,} of {numIdentifiedGuides:,} ({duplicatePercent}%) guides.')
-        printer(f'\t{len(candidateGuides):,} distinct guides have been discovered so far.')
+        batchSources = checkpoint.sources()
+        sequenceHeaders = checkpoint.headers()
+        duplicateGuides = checkpoint.duplicateGuides()
+    else:
+        printer('Analysing files...')
 
-        completedPercent = round(completedSizeBytes / totalSizeBytes * 100.0, 3)
-        printer(f'\tExtracted from {completedPercent}% of input')
+        # With checkpoints, the guides are extracted into the run directory
+        workingDir = checkpoint.extractionDir() if checkpoint is not None else None
 
-    # Write header line for output file
-    with open(configMngr['output']['file'], 'a+') as fOpen:
-        csvWriter = csv.writer(fOpen, delimiter=configMngr['output']['delimiter'],
-                        quotechar='"',dialect='unix', quoting=csv.QUOTE_MINIMAL)
+        # Guides (as sorted 2-bit signatures) and sequences seen before
+        candidateGuides = np.zeros(0, dtype=SIGNATURE_DTYPE)
+        duplicateGuides = np.zeros(0, dtype=SIGNATURE_DTYPE)
+        recordedSequences = set()
 
-        csvWriter.writerow(DEFAULT_GUIDE_PROPERTIES_ORDER)
+        if duplicatePartitions > 0:
+            guideBatchinator = GuidePartitioner(duplicatePartitions, workingDir)
 
-    # Clean up unused variables
-    del candidateGuides
-    del recordedSequences
+            printer(f'GuidePartitioner is writing to: {guideBatchinator.workingDir.name}')
+        else:
+            guideBatchinator = Batchinator(int(configMngr['input']['batch-size']), workingDir)
 
+            printer(f'Batchinator is writing to: {guideBatchinator.workingDir.name}')
 
-    batchFileId = 0
-    for batchFile in guideBatchinator:
-        batchStartTime = time.time()
+        for seqFilePath in configMngr.getIterFilesToProcess():
 
-        printer(f'Processing batch file {(batchFileId+1):,} of {len(guideBatchinator)}')
+            # The guides of an unchanged file are read from the incremental directory
+            results = incremental.findGuides(seqFilePath) if incremental is not None else None
 
-        # Create new candidate guide dictionary
-        candidateGuides = {}
-        # Load guides from temp file
-        with open(batchFile, 'r') as inputFp:
-            # Create csv reader to parse temp file
-            csvReader = csv.reader(inputFp, delimiter=configMngr['output']['delimiter'],
-                quotechar='"',dialect='unix', quoting=csv.QUOTE_MINIMAL)
-            # Rebuild dictonary from temp file
-            for row in csvReader:
-                candidateGuides[row[0]] = DEFAULT_GUIDE_PROPERTIES.copy()
-                candidateGuides[row[0]]['seq'] = row[0]
-                if row[0] in duplicateGuides:
-                    candidateGuides[row[0]]['header'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['start'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['end'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['strand'] = CODE_AMBIGUOUS
-                    candidateGuides[row[0]]['isUnique'] = CODE_REJECTED
-                else:
-                    candidateGuides[row[0]]['header'] = row[1]
-                    candidateGuides[row[0]]['start'] = row[2]
-                    candidateGuides[row[0]]['end'] = row[3]
-                    candidateGuides[row[0]]['strand'] = row[4]
+            if duplicatePartitions > 0:
+                recordedSequences, fileSize, numIdentifiedGuides = partition_candidates_in_file(guideBatchinator, seqFilePath, recordedSequences, results)
+                completedSizeBytes += fileSize
+
+                printer(f'\tIdentified {numIdentifiedGuides:,} possible target sites in this file.')
+                printer('\tDuplicates will be removed once every file has been processed.')
+
+                completedPercent = round(completedSizeBytes / totalSizeBytes * 100.0, 3)
+                printer(f'\tExtracted from {completedPercent}% of input')
+                continue
+
+            candidateGuides, duplicateGuides, recordedSequences, fileSize, numIdentifiedGuides, numDuplicateGuides = find_candidates_in_file(guideBatchinator, seqFilePath, candidateGuides, duplicateGuides, recordedSequences, results)
+            completedSizeBytes += fileSize
+
+            duplicatePercent = round(numDuplicateGuides / numIdentifiedGuides * 100.0, 3)
+            printer(f'\tIdentified {numIdentifiedGuides:,} possible target sites in this file.')
+            printer(f'\tOf these, {len(duplicateGuides):,} are not unique. These sites occur a total of {numDuplicateGuides} times.')
+            printer(f'\tRemoving {numDuplicateGuides:,} of {numIdentifiedGuides:,} ({duplicatePercent}%) guides.')
+            printer(f'\t{len(candidateGuides):,} distinct guides have been discovered so far.')
+
+            completedPercent = round(completedSizeBytes / totalSizeBytes * 100.0, 3)
+            printer(f'\tExtracted from {completedPercent}% of input')
+
+        # The source of each batch: a batch file, or the spill file of a partition
+        batchSources = guideBatchinator.close()
+        sequenceHeaders = guideBatchinator.headers
+
+        if checkpoint is not None:
+            batchSources = checkpoint.saveExtraction(extractionMode, batchSources, sequenceHeaders, duplicateGuides)
+
+        # Clean up unused variables
+        del candidateGuides
+        del recordedSequences
+
+    # Write header line for output file, unless it was before the run was interrupted
+    if checkpoint is None or checkpoint.outputSize() == 0:
+        with open(configMngr['output']['file'], 'a+') as fOpen:
+            csvWriter = csv.writer(fOpen, delimiter=configMngr['output']['delimiter'],
+                            quotechar='"',dialect='unix', quoting=csv.QUOTE_MINIMAL)
+
+            csvWriter.writerow(DEFAULT_GUIDE_PROPERTIES_ORDER)
+
+        if checkpoint is not None:
+            checkpoint.saveOutput(configMngr['output']['file'])
+
+    sequenceHeaders = np.array(sequenceHeaders, dtype=object)
+
+    def loadBatch(batchFileId):
+        source = batchSources[batchFileId]
+
+        # A partition is resolved into a guide table. With checkpoints, its
+        # spill file is kept until the batch has been written.
+        if duplicatePartitions > 0:
+            return resolveSpillFile(source, sequenceHeaders, remove=checkpoint is None)[0]
+
+        # Map the (binary) batch file into memory
+        batch = Batchinator.loadBatch(source)
+        # Rebuild the guide table from the batch
+        return GuideTable.fromColumns(
+            batch['signature'],
+            sequenceHeaders[batch['header']],
+            batch['start'],
+            batch['end'],
+            batch['strand'].astype('U1'),
+            duplicateGuides
+        )
+
+
+    # One pool of workers is shared by every batch
+    workerPool = WorkerPool(mp.cpu_count())
+
+    # The ISSL index is loaded once and shared by every page of every batch.
+    # With the ISSL library, guides are scored in-process. Otherwise, they are
+    # scored by an ISSL server.
+    isslIndex = None
+    isslServer = None
+    isslBlockSize = configMngr['offtargetscore'].getint('block-size', fallback=0)
+    if (configMngr['offtargetscore'].getboolean('enabled')):
+        if configMngr['offtargetscore'].get('library', fallback=''):
+            isslIndex = load_index(
+                configMngr['input']['offtarget-sites'],
+                configMngr['offtargetscore']['library'],
+            )
+        else:
+            isslServer = IsslServer(
+                configMngr['offtargetscore']['binary'],
+                configMngr['input']['offtarget-sites'],
+                configMngr['offtargetscore']['max-distance'],
+                configMngr['offtargetscore']['score-threshold'],
+                configMngr['offtargetscore']['method'],
+                isslBlockSize,
+            )
+
+    # The RNAfold processes are started once and fed every page of every batch
+    rnaFoldPool = None
+    if (configMngr['consensus'].getboolean('mm10db')):
+        rnaFoldProcesses = configMngr['rnafold'].getint('processes', fallback=1)
+        rnaFoldPool = RnaFoldPool(
+            configMngr['rnafold']['binary'],
+            rnaFoldProcesses,
+            max(1, int(configMngr['rnafold']['threads']) // rnaFoldProcesses),
+        )
+
+    ####################################
+    ###     Stages of each batch      ##
+    ####################################
+    # A batch is (batchFileId, candidateGuides, batchStartTime). Each stage
+    # runs in its own thread (see StagePipeline), on one batch at a time.
+
+    def efficiencyStage(batch):
+        # CHOPCHOP G20, then the mm10db sequence rules (see EfficiencyRules)
+        batchFileId, candidateGuides, batchStartTime = batch
+
+        printer(f'Processing batch file {(batchFileId+1):,} of {len(batchSources)}')
 
         printer(f'\tLoaded {len(candidateGuides):,} guides')
 
+        # The CHOPCHOP and mm10db sequence rules are evaluated together, for
+        # every guide of the batch (see EfficiencyRules). The result of each
+        # rule is then kept for the guides that it assesses.
+        rules = evaluateRules(candidateGuides.seqMatrix())
+
         #########################################
         ##                 G20                 ##
         #########################################
         if (configMngr['consensus'].getboolean('CHOPCHOP')):
             printer('CHOPCHOP - remove those without G in position 20.')
 
-            failedCount = 0
-            testedCount = 0
-            for target23 in filterCandidateGuides(candidateGuides, MODULE_CHOPCHOP):
-                if target23[19] != 'G':
-                    candidateGuides[target23]['passedG20'] = CODE_REJECTED
-                    failedCount += 1
-                else:
-                    candidateGuides[target23]['passedG20'] = CODE_ACCEPTED
-                testedCount += 1
+            guideIdx = filterCandidateGuides(candidateGuides, MODULE_CHOPCHOP)
+
+            results = rules['passedG20'][guideIdx]
+
+            candidateGuides['passedG20'][guideIdx] = results
+
+            failedCount = int(np.count_nonzero(results == STATUS_REJECTED))
+            testedCount = len(results)
 
             printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
@@ -247,17 +280,14 @@ def Crackling(configMngr):
         if (configMngr['consensus'].getboolean('mm10db')):
             printer('mm10db - remove all targets with a leading T (+) or trailing A (-).')
 
-            failedCount = 0
-            testedCount = 0
-            for target23 in filterCandidateGuides(candidateGuides, MODULE_MM10DB):
-                if (target23[-2:] == 'GG' and target23[0] == 'T') or \
-                    (target23[:2] == 'CC' and target23[-1] == 'A'):
-                    candidateGuides[target23]['passedAvoidLeadingT'] = CODE_REJECTED
-                    failedCount += 1
-                else:
-                    candidateGuides[target23]['passedAvoidLeadingT'] = CODE_ACCEPTED
+            guideIdx = filterCandidateGuides(candidateGuides, MODULE_MM10DB)
+
+            results = rules['passedAvoidLeadingT'][guideIdx]
 
-                testedCount += 1
+            candidateGuides['passedAvoidLeadingT'][guideIdx] = results
+
+            failedCount = int(np.count_nonzero(results == STATUS_REJECTED))
+            testedCount = len(results)
 
             printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
@@ -267,20 +297,15 @@ def Crackling(configMngr):
         if (configMngr['consensus'].getboolean('mm10db')):
             printer('mm10db - remove based on AT percent.')
 
-            failedCount = 0
-            testedCount = 0
-            for target23 in filterCandidateGuides(candidateGuides, MODULE_MM10DB):
-                AT = AT_percentage(target23[0:20])
+            guideIdx = filterCandidateGuides(candidateGuides, MODULE_MM10DB)
 
-                if AT < 20 or AT > 65:
-                    candidateGuides[target23]['passedATPercent'] = CODE_REJECTED
-                    failedCount += 1
-                else:
-                    candidateGuides[target23]['passedATPercent'] = CODE_ACCEPTED
+            results = rules['passedATPercent'][guideIdx]
 
-                candidateGuides[target23]['AT'] = AT
+            candidateGuides['passedATPercent'][guideIdx] = results
+            candidateGuides.setValues('AT', guideIdx, rules['AT'][guideIdx])
 
-                testedCount += 1
+            failedCount = int(np.count_nonzero(results == STATUS_REJECTED))
+            testedCount = len(results)
 
             printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
@@ -290,26 +315,30 @@ def Crackling(configMngr):
         if (configMngr['consensus'].getboolean('mm10db')):
             printer('mm10db - remove all targets that contain TTTT.')
 
-            failedCount = 0
-            testedCount = 0
-            for target23 in filterCandidateGuides(candidateGuides, MODULE_MM10DB):
-                if 'TTTT' in target23:
-                    candidateGuides[target23]['passedTTTT'] = CODE_REJECTED
-                    failedCount += 1
-                else:
-                    candidateGuides[target23]['passedTTTT'] = CODE_ACCEPTED
-                testedCount += 1
+            guideIdx = filterCandidateGuides(candidateGuides, MODULE_MM10DB)
+
+            results = rules['passedTTTT'][guideIdx]
+
+            candidateGuides['passedTTTT'][guideIdx] = results
+
+            failedCount = int(np.count_nonzero(results == STATUS_REJECTED))
+            testedCount = len(results)
 
             printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
+
+    def secondaryStructureStage(batch):
+        # mm10db secondary structures, through the RNAfold pool, and the mm10db result
+        batchFileId, candidateGuides, batchStartTime = batch
+
         ##########################################
         ##   Calculating secondary structures   ##
         ##########################################
         if (configMngr['consensus'].getboolean('mm10db')):
             printer('mm10db - check secondary structure.')
 
-            # RNAFold is memory intensive for very large datasets.
-            # We will paginate in order not to overflow memory.
+            # The guides are paginated, and each page is streamed through the
+            # RNAfold pool. Records are parsed as they arrive.
 
             guide = 'GUUUUAGAGCUAGAAAUAGCAAGUUAAAAUAAGGCUAGUCCGUUAUCAACUUGAAAAAGUGGCACCGAGUCGGUGCUUUU'
             pattern_RNAstructure = r'.{28}\({4}\.{4}\){4}\.{3}\){4}.{21}\({4}\.{4}\){4}\({7}\.{3}\){7}\.{3}\s\((.+)\)'
@@ -318,82 +347,49 @@ def Crackling(configMngr):
             testedCount = 0
             failedCount = 0
             errorCount = 0
-            notFoundCount = 0
 
             pgLength = int(configMngr['rnafold']['page-length'])
 
-            for pgIdx, pageCandidateGuides in Paginator(
+            for pgIdx, pageGuideIdx in Paginator(
                 filterCandidateGuides(candidateGuides, MODULE_MM10DB),
                 pgLength
             ):
                 if pgLength > 0:
                     printer(f'\tProcessing page {(pgIdx+1)} ({pgLength:,} per page).')
 
-                if os.path.exists(configMngr['rnafold']['output']):
-                    os.remove(configMngr['rnafold']['output'])
-
-                printer('\t\tConstructing the RNAfold input file.')
-
-                guidesInPage = 0
-                with open(configMngr['rnafold']['input'], 'w+') as fRnaInput:
-                    for target23 in pageCandidateGuides:
-                        fRnaInput.write(f'G{target23[1:20]}{guide}\n')
-                        guidesInPage += 1
-
-                printer(f'\t\t{guidesInPage:,} guides in this page.')
-
-                runner('{} --noPS -j{} -i {} -o'.format(
-                        configMngr['rnafold']['binary'],
-                        configMngr['rnafold']['threads'],
-                        configMngr['rnafold']['input']
-                    ),
-                    shell=True,
-                    check=True
-                )
-
-                os.replace('RNAfold_output.fold' ,configMngr['rnafold']['output'])
-
-                printer('\t\tStarting to process the RNAfold results.')
-
-                RNAstructures = {}
-                with open(configMngr['rnafold']['output'], 'r') as fRnaOutput:
-                    i = 0
-                    L1, L2, target = None, None, None
-                    for line in fRnaOutput:
-                        if i % 2 == 0:
-                            # 0th, 2nd, 4th, etc.
-                            L1 = line.rstrip()
-                            target = L1[0:20]
-                        else:
-                            # 1st, 3rd, 5th, etc.
-                            L2 = line.rstrip()
-                            RNAstructures[transToDNA(target[1:20])] = [
-                                L1, L2, target
-                            ]
+                pageGuideIdx = np.asarray(pageGuideIdx, dtype=np.int64)
+                pageCandidateGuides = candidateGuides.sequences(pageGuideIdx)
 
-                        i += 1
+                printer(f'\t\t{len(pageGuideIdx):,} guides in this page.')
 
+                printer('\t\tFolding with RNAfold and processing the results.')
 
-                for target23 in pageCandidateGuides:
-                    key = target23[1:20]
-                    if key not in RNAstructures:
-                        print(f'Could not find: {target23[0:20]}')
-                        notFoundCount += 1
-                        continue
-                    else:
-                        L1 = RNAstructures[key][0]
-                        L2 = RNAstructures[key][1]
-                        target = RNAstructures[key][2]
+                foldedIdx = []
+                foldedL1 = []
+                foldedStructure = []
+                foldedEnergy = []
+                statusIdx = []
+                statuses = []
+
+                # The records are returned in the order of the guides
+                for (L1, L2), guideId, target23 in zip(
+                    rnaFoldPool.fold(f'G{target23[1:20]}{guide}' for target23 in pageCandidateGuides),
+                    pageGuideIdx,
+                    pageCandidateGuides
+                ):
+                    target = L1[0:20]
 
                     structure = L2.split(' ')[0]
                     energy = L2.split(' ')[1][1:-1]
 
-                    candidateGuides[target23]['ssL1'] = L1
-                    candidateGuides[target23]['ssStructure'] = structure
-                    candidateGuides[target23]['ssEnergy'] = energy
+                    foldedIdx.append(guideId)
+                    foldedL1.append(L1)
+                    foldedStructure.append(structure)
+                    foldedEnergy.append(energy)
 
                     if transToDNA(target) != target23[0:20] and transToDNA('C'+target[1:]) != target23[0:20] and transToDNA('A'+target[1:]) != target23[0:20]:
-                        candidateGuides[target23]['passedSecondaryStructure'] = CODE_ERROR
+                        statusIdx.append(guideId)
+                        statuses.append(STATUS_ERROR)
                         errorCount += 1
                         continue
 
@@ -401,52 +397,53 @@ def Crackling(configMngr):
                     if match_structure:
                         energy = ast.literal_eval(match_structure.group(1))
                         if energy < float(configMngr['rnafold']['low_energy_threshold']):
-                            candidateGuides[transToDNA(target23)]['passedSecondaryStructure'] = CODE_REJECTED
+                            statusIdx.append(guideId)
+                            statuses.append(STATUS_REJECTED)
                             failedCount += 1
                         else:
-                            candidateGuides[target23]['passedSecondaryStructure'] = CODE_ACCEPTED
+                            statusIdx.append(guideId)
+                            statuses.append(STATUS_ACCEPTED)
                     else:
                         match_energy = re.search(pattern_RNAenergy, L2)
                         if match_energy:
                             energy = ast.literal_eval(match_energy.group(1))
                             if energy <= float(configMngr['rnafold']['high_energy_threshold']):
-                                candidateGuides[transToDNA(target23)]['passedSecondaryStructure'] = CODE_REJECTED
+                                statusIdx.append(guideId)
+                                statuses.append(STATUS_REJECTED)
                                 failedCount += 1
                             else:
-                                candidateGuides[target23]['passedSecondaryStructure'] = CODE_ACCEPTED
+                                statusIdx.append(guideId)
+                                statuses.append(STATUS_ACCEPTED)
                     testedCount += 1
 
+                candidateGuides['ssL1'][foldedIdx] = foldedL1
+                candidateGuides['ssStructure'][foldedIdx] = foldedStructure
+                candidateGuides['ssEnergy'][foldedIdx] = foldedEnergy
+                candidateGuides['passedSecondaryStructure'][statusIdx] = statuses
+
 
             printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
             if errorCount > 0:
                 printer(f'\t{errorCount} of {testedCount} erred here.')
 
-            if notFoundCount > 0:
-                printer(f'\t{notFoundCount} of {testedCount} not found in RNAfold output.')
-
         #########################################
         ##         Calc mm10db result          ##
         #########################################
         if (configMngr['consensus'].getboolean('mm10db')):
             printer('Calculating mm10db final result.')
 
-            acceptedCount = 0
-            failedCount = 0
+            accepted = (
+                (candidateGuides['passedATPercent'] == STATUS_ACCEPTED) &
+                (candidateGuides['passedTTTT'] == STATUS_ACCEPTED) &
+                (candidateGuides['passedSecondaryStructure'] == STATUS_ACCEPTED) &
+                (candidateGuides['passedAvoidLeadingT'] == STATUS_ACCEPTED)
+            )
 
-            for target23 in candidateGuides:
-                if not all([
-                    candidateGuides[target23]['passedATPercent'] == CODE_ACCEPTED,
-                    candidateGuides[target23]['passedTTTT'] == CODE_ACCEPTED,
-                    candidateGuides[target23]['passedSecondaryStructure'] == CODE_ACCEPTED,
-                    candidateGuides[target23]['passedAvoidLeadingT'] == CODE_ACCEPTED,
-                ]):
-                    # mm10db rejected the guide
-                    candidateGuides[target23]['acceptedByMm10db'] = CODE_REJECTED
-                    failedCount += 1
-                else:
-                    candidateGuides[target23]['acceptedByMm10db'] = CODE_ACCEPTED
-                    acceptedCount += 1
+            candidateGuides['acceptedByMm10db'][:] = np.where(accepted, STATUS_ACCEPTED, STATUS_REJECTED)
+
+            acceptedCount = int(np.count_nonzero(accepted))
+            failedCount = len(candidateGuides) - acceptedCount
 
             printer(f'\t{acceptedCount} accepted.')
 
@@ -454,44 +451,27 @@ def Crackling(configMngr):
 
             del acceptedCount
 
+
+    def sgRnaScorerStage(batch):
+        # sgRNAScorer2, through the worker pool, and the efficiency consensus
+        batchFileId, candidateGuides, batchStartTime = batch
+
         #########################################
         ##         sgRNAScorer 2.0 model       ##
         #########################################
         if (configMngr['consensus'].getboolean('sgRNAScorer2')):
             printer('sgRNAScorer2 - score using model.')
 
-            # binary encoding
-            encoding = {
-                'A' : '0001',    'C' : '0010',    'T' : '0100',    'G' : '1000',
-                'K' : '1100',    'M' : '0011',    'R' : '1001',    'Y' : '0110',
-                'S' : '1010',    'W' : '0101',    'B' : '1110',    'V' : '1011',
-                'H' : '0111',    'D' : '1101',    'N' : '1111'
-            }
-
-            clfLinear = joblib.load(configMngr['sgrnascorer2']['model'])
-
-            failedCount = 0
-            testedCount = 0
-            for target23 in filterCandidateGuides(candidateGuides, MODULE_SGRNASCORER2):
-                sequence = target23.upper()
-                entryList = []
-                testedCount += 1
+            guideIdx = filterCandidateGuides(candidateGuides, MODULE_SGRNASCORER2)
 
-                for x in range(0, 20):
-                    for y in range(0, 4):
-                        entryList.append(int(encoding[sequence[x]][y]))
+            scores = workerPool.map(sgRNAScorer, candidateGuides.seqMatrix(guideIdx), configMngr['sgrnascorer2']['model'])
+            statuses = acceptGuides(scores, configMngr['sgrnascorer2']['score-threshold'])
 
-                # predict based on the entry
-                prediction = clfLinear.predict([entryList])
-                score = clfLinear.decision_function([entryList])[0]
+            candidateGuides.setValues('sgrnascorer2score', guideIdx, scores)
+            candidateGuides['acceptedBySgRnaScorer'][guideIdx] = statuses
 
-                candidateGuides[target23]['sgrnascorer2score'] = score
-
-                if float(score) < float(float(configMngr['sgrnascorer2']['score-threshold'])):
-                    candidateGuides[target23]['acceptedBySgRnaScorer'] = CODE_REJECTED
-                    failedCount += 1
-                else:
-                    candidateGuides[target23]['acceptedBySgRnaScorer'] = CODE_ACCEPTED
+            failedCount = int(np.count_nonzero(statuses == STATUS_REJECTED))
+            testedCount = len(guideIdx)
 
             printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
@@ -500,22 +480,24 @@ def Crackling(configMngr):
         #########################################
         printer('Evaluating efficiency via consensus approach.')
 
-        failedCount = 0
-        testedCount = 0
-        for target23 in candidateGuides:
-            candidateGuides[target23]['consensusCount'] = sum([
-                candidateGuides[target23]['acceptedByMm10db'] == CODE_ACCEPTED,
-                candidateGuides[target23]['acceptedBySgRnaScorer'] == CODE_ACCEPTED,
-                candidateGuides[target23]['passedG20'] == CODE_ACCEPTED,
-            ])
+        consensusCount = (
+            (candidateGuides['acceptedByMm10db'] == STATUS_ACCEPTED).astype(np.int8) +
+            (candidateGuides['acceptedBySgRnaScorer'] == STATUS_ACCEPTED) +
+            (candidateGuides['passedG20'] == STATUS_ACCEPTED)
+        )
 
-            if candidateGuides[target23]['consensusCount'] < int(configMngr['consensus']['n']):
-                failedCount += 1
+        candidateGuides.setValues('consensusCount', slice(None), consensusCount)
 
-            testedCount += 1
+        failedCount = int(np.count_nonzero(consensusCount < int(configMngr['consensus']['n'])))
+        testedCount = len(candidateGuides)
 
         printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
+
+    def bowtieStage(batch):
+        # Bowtie2 alignment of the efficient guides
+        batchFileId, candidateGuides, batchStartTime = batch
+
         if (configMngr['offtargetscore'].getboolean('enabled')):
             ###############################################
             ##         Using Bowtie for positioning      ##
@@ -527,7 +509,13 @@ def Crackling(configMngr):
 
             pgLength = int(configMngr['bowtie2']['page-length'])
 
-            for pgIdx, pageCandidateGuides in Paginator(
+            bowtieAligner = Bowtie2Aligner(
+                configMngr['bowtie2']['binary'],
+                configMngr['input']['bowtie2-index'],
+                configMngr['bowtie2']['threads'],
+            )
+
+            for pgIdx, pageGuideIdx in Paginator(
                 filterCandidateGuides(candidateGuides, MODULE_SPECIFICITY),
                 pgLength
             ):
@@ -535,114 +523,60 @@ def Crackling(configMngr):
                 if pgLength > 0:
                     printer(f'\tProcessing page {(pgIdx+1)} ({pgLength:,} per page).')
 
-                if os.path.exists(configMngr['bowtie2']['output']):
-                    os.remove(configMngr['bowtie2']['output'])
-
-                printer('\tConstructing the Bowtie input file.')
-
-                tempTargetDict_offset = {}
-                guidesInPage = 0
-                with open(configMngr['bowtie2']['input'], 'w') as fWriteBowtie:
-                    for target23 in pageCandidateGuides:
-                        similarTargets = [
-                            target23[0:20] + 'AGG',
-                            target23[0:20] + 'CGG',
-                            target23[0:20] + 'GGG',
-                            target23[0:20] + 'TGG',
-                            target23[0:20] + 'AAG',
-                            target23[0:20] + 'CAG',
-                            target23[0:20] + 'GAG',
-                            target23[0:20] + 'TAG'
-                        ]
-
-                        for seq in similarTargets:
-                            fWriteBowtie.write(seq + '\n')
-                            tempTargetDict_offset[seq] = target23
-
-                        testedCount += 1
-                        guidesInPage += 1
-
-                printer(f'\t\t{guidesInPage:,} guides in this page.')
-
-                runner('{} -x {} -p {} --reorder --no-hd -t -r -U {} -S {}'.format(
-                        configMngr['bowtie2']['binary'],
-                        configMngr['input']['bowtie2-index'],
-                        configMngr['bowtie2']['threads'],
-                        configMngr['bowtie2']['input'],
-                        configMngr['bowtie2']['output']
-                    ),
-                    shell=True,
-                    check=True
-                )
-
-                printer('\tStarting to process the Bowtie results.')
-
-                inFile = open(configMngr['bowtie2']['output'], 'r')
-                bowtieLines = inFile.readlines()
-                inFile.close()
-
-                i=0
-                while i<len(bowtieLines):
-                    nb_occurences = 0
-                    # we extract the read and use the dictionary to find the corresponding target
-                    line = bowtieLines[i].rstrip().split('\t')
-                    chr = line[2]
-                    pos = ast.literal_eval(line[3])
-                    read = line[9]
-                    seq = ''
-
-                    if read in tempTargetDict_offset:
-                        seq = tempTargetDict_offset[read]
-                    elif rc(read) in tempTargetDict_offset:
-                        seq = tempTargetDict_offset[rc(read)]
-                    else:
-                        print('Problem? '+read)
-
-                    if seq[:-2] == 'GG':
-                        candidateGuides[seq]['bowtieChr'] = chr
-                        candidateGuides[seq]['bowtieStart'] = pos
-                        candidateGuides[seq]['bowtieEnd'] = pos + 22
-                    elif rc(seq)[:2] == 'CC':
-                        candidateGuides[seq]['bowtieChr'] = chr
-                        candidateGuides[seq]['bowtieStart'] = pos
-                        candidateGuides[seq]['bowtieEnd'] = pos + 22
-                    else:
-                        print('Error? '+seq)
-                        quit()
+                pageGuideIdx = np.asarray(pageGuideIdx, dtype=np.int64)
+                pageCandidateGuides = candidateGuides.sequences(pageGuideIdx)
 
-                    # we count how many of the eight reads for this target have a perfect alignment
-                    for j in range(i,i+8):
+                printer(f'\t\t{len(pageGuideIdx):,} guides in this page.')
 
-                        # http://bowtie-bio.sourceforge.net/bowtie2/manual.shtml#sam-output
-                        # XM:i:<N>    The number of mismatches in the alignment. Only present if SAM record is for an aligned read.
-                        # XS:i:<N>    Alignment score for the best-scoring alignment found other than the alignment reported.
+                printer('\tAligning with Bowtie and processing the results.')
 
-                        if 'XM:i:0' in bowtieLines[j]:
-                            nb_occurences += 1
+                alignedIdx = []
+                alignedChr = []
+                alignedStart = []
+                bowtieStatuses = []
 
-                            # we also check whether this perfect alignment also happens elsewhere
-                            if 'XS:i:0'  in bowtieLines[j]:
-                                nb_occurences += 1
+                # The alignments are returned in the order of the guides
+                for (chr, pos, nb_occurences), guideId, seq in zip(
+                    bowtieAligner.align(pageCandidateGuides),
+                    pageGuideIdx,
+                    pageCandidateGuides
+                ):
+                    if seq[:-2] == 'GG' or rc(seq)[:2] == 'CC':
+                        alignedIdx.append(guideId)
+                        alignedChr.append(chr)
+                        alignedStart.append(pos)
+                    else:
+                        print('Error? '+seq)
+                        quit()
 
-                    # if that number is at least two, the target is removed
+                    # if at least two of the eight reads for this target have a perfect alignment, the target is removed
                     if nb_occurences > 1:
 
                         # increment the counter if this guide has not already been rejected by bowtie
-                        if candidateGuides[seq]['passedBowtie'] != CODE_REJECTED:
+                        if candidateGuides['passedBowtie'][guideId] != STATUS_REJECTED:
                             failedCount += 1
 
-                        candidateGuides[seq]['passedBowtie'] = CODE_REJECTED
+                        bowtieStatuses.append(STATUS_REJECTED)
                     else:
-                        candidateGuides[seq]['passedBowtie'] = CODE_ACCEPTED
+                        bowtieStatuses.append(STATUS_ACCEPTED)
 
-                    # we continue with the next target
-                    i+=8
+                    testedCount += 1
+
+                alignedStart = np.array(alignedStart, dtype=np.int64)
 
-                # we can remove the dictionary
-                del tempTargetDict_offset
+                candidateGuides['bowtieChr'][alignedIdx] = alignedChr
+                candidateGuides.setValues('bowtieStart', alignedIdx, alignedStart)
+                candidateGuides.setValues('bowtieEnd', alignedIdx, alignedStart + 22)
+                candidateGuides['passedBowtie'][alignedIdx] = bowtieStatuses
 
             printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
+
+    def offtargetScoringStage(batch):
+        # ISSL off-target scoring of the efficient guides
+        batchFileId, candidateGuides, batchStartTime = batch
+
+        if (configMngr['offtargetscore'].getboolean('enabled')):
             #########################################
             ##      Begin off-target scoring       ##
             #########################################
@@ -653,7 +587,10 @@ def Crackling(configMngr):
 
             pgLength = int(configMngr['offtargetscore']['page-length'])
 
-            for pgIdx, pageCandidateGuides in Paginator(
+            scoreThreshold = float(configMngr['offtargetscore']['score-threshold'])
+            scoreMethod = str(configMngr['offtargetscore']['method']).strip().lower()
+
+            for pgIdx, pageGuideIdx in Paginator(
                 filterCandidateGuides(candidateGuides, MODULE_SPECIFICITY),
                 pgLength
             ):
@@ -661,100 +598,70 @@ def Crackling(configMngr):
                 if pgLength > 0:
                     printer(f'\tProcessing page {(pgIdx+1)} ({pgLength:,} per page).')
 
-                # prepare the list of candidate guides to score
-                guidesInPage = 0
-                with open(configMngr['offtargetscore']['input'], 'w') as fTargetsToScore:
-                    for target23 in pageCandidateGuides:
-                        target = target23[0:20]
-                        fTargetsToScore.write(target+'\n')
-                        testedCount += 1
-                        guidesInPage += 1
+                pageGuideIdx = np.asarray(pageGuideIdx, dtype=np.int64)
+
+                guidesInPage = len(pageGuideIdx)
+                testedCount += guidesInPage
 
                 if guidesInPage != pgLength:
                     printer(f'\t\t{guidesInPage:,} guides in this page.')
 
-                # Convert line endings (Windows)
-                if os.name == 'nt':
-                    runner('dos2unix {}'.format(
-                            configMngr['offtargetscore']['input']
-                        ),
-                        shell=True,
-                        check=True
+                if isslIndex is not None:
+                    # score the binary encoded targets (first 20 bases) in-process
+                    mit, cfd = isslIndex.score(
+                        targetSignatures(candidateGuides.signature[pageGuideIdx]),
+                        scoreMethod,
+                        scoreThreshold,
+                        int(configMngr['offtargetscore']['max-distance']),
+                        isslBlockSize
                     )
+                else:
+                    # score the targets (first 20 bases) with the running ISSL server
+                    scores = isslServer.score([target23[0:20] for target23 in candidateGuides.sequences(pageGuideIdx)])
 
-                # call the scoring method
-                runner('{} {} {} {} {} {} > {}'.format(
-                        configMngr['offtargetscore']['binary'],
-                        configMngr['input']['offtarget-sites'],
-                        configMngr['offtargetscore']['input'],
-                        str(configMngr['offtargetscore']['max-distance']),
-                        str(configMngr['offtargetscore']['score-threshold']),
-                        str(configMngr['offtargetscore']['method']),
-                        configMngr['offtargetscore']['output'],
-                    ),
-                    shell=True,
-                    check=True
-                )
-
-                targetsScored = {}
-                with open(configMngr['offtargetscore']['output'], 'r') as fTargetsScored:
-                    for targetScored in [x.split('\t') for x in fTargetsScored.readlines()]:
-                        if len(targetScored) == 3:
-                            targetsScored[targetScored[0]] = {'MIT': -1.0, 'CFD': -1.0}
-                            targetsScored[targetScored[0]]['MIT'] = float(targetScored[1].strip())
-                            targetsScored[targetScored[0]]['CFD'] = float(targetScored[2].strip())
+                    mit = np.array([score[0] for score in scores], dtype=np.float64)
+                    cfd = np.array([score[1] for score in scores], dtype=np.float64)
 
-                failedCount = 0
-                for target23 in pageCandidateGuides:
-                    if target23[0:20] in targetsScored:
-                        score = targetsScored[target23[0:20]]
-                        candidateGuides[target23]['mitOfftargetscore'] = score['MIT']
-                        candidateGuides[target23]['cfdOfftargetscore'] = score['CFD']
-                        scoreThreshold = float(configMngr['offtargetscore']['score-threshold'])
-                        scoreMethod = str(configMngr['offtargetscore']['method']).strip().lower()
-
-                        # MIT
-                        if scoreMethod == 'mit':
-                            if score['MIT'] < scoreThreshold:
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_REJECTED
-                                failedCount += 1
-                            else:
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_ACCEPTED
+                scoredIdx = pageGuideIdx
 
-                        # CFD
-                        elif scoreMethod == 'cfd':
-                            if score['CFD'] < scoreThreshold:
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_REJECTED
-                                failedCount += 1
-                            else:
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_ACCEPTED
+                candidateGuides.setValues('mitOfftargetscore', scoredIdx, mit)
+                candidateGuides.setValues('cfdOfftargetscore', scoredIdx, cfd)
 
-                        # AND
-                        elif scoreMethod == 'and':
-                            if (score['MIT'] < scoreThreshold) and (score['CFD'] < scoreThreshold):
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_REJECTED
-                                failedCount += 1
-                            else:
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_ACCEPTED
+                # MIT
+                if scoreMethod == 'mit':
+                    failed = mit < scoreThreshold
 
-                        # OR
-                        elif scoreMethod == 'or':
-                            if (score['MIT'] < scoreThreshold) or (score['CFD'] < scoreThreshold):
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_REJECTED
-                                failedCount += 1
-                            else:
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_ACCEPTED
+                # CFD
+                elif scoreMethod == 'cfd':
+                    failed = cfd < scoreThreshold
 
-                        # AVERAGE
-                        elif scoreMethod == 'avg':
-                            if ((score['MIT'] + score['CFD'])/2) < scoreThreshold:
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_REJECTED
-                                failedCount += 1
-                            else:
-                                candidateGuides[target23]['passedOffTargetScore'] = CODE_ACCEPTED
+                # AND
+                elif scoreMethod == 'and':
+                    failed = (mit < scoreThreshold) & (cfd < scoreThreshold)
+
+                # OR
+                elif scoreMethod == 'or':
+                    failed = (mit < scoreThreshold) | (cfd < scoreThreshold)
+
+                # AVERAGE
+                elif scoreMethod == 'avg':
+                    failed = ((mit + cfd)/2) < scoreThreshold
+
+                else:
+                    failed = None
+
+                failedCount = 0
+                if failed is not None:
+                    candidateGuides['passedOffTargetScore'][scoredIdx] = np.where(failed, STATUS_REJECTED, STATUS_ACCEPTED)
+                    failedCount = int(np.count_nonzero(failed))
 
                 printer(f'\t{failedCount:,} of {testedCount:,} failed here.')
 
+
+    def outputStage(batch):
+        # Write the batch, in the order the batches were loaded
+        batchFileId, candidateGuides, batchStartTime = batch
+
         #########################################
         ##           Begin output              ##
         #########################################
@@ -765,27 +672,13 @@ def Crackling(configMngr):
             csvWriter = csv.writer(fOpen, delimiter=configMngr['output']['delimiter'],
                             quotechar='"',dialect='unix', quoting=csv.QUOTE_MINIMAL)
 
-            for target23 in candidateGuides:
-                output = [candidateGuides[target23][x] for x in DEFAULT_GUIDE_PROPERTIES_ORDER]
+            if incremental is not None:
+                incremental.writeRows(fOpen, csvWriter, candidateGuides.rows(), reusedRows.pop(batchFileId))
+            else:
+                csvWriter.writerows(candidateGuides.rows())
 
-                csvWriter.writerow(output)
-
-        #########################################
-        ##              Clean up               ##
-        #########################################
-        printer('Cleaning auxiliary files')
-        for f in [
-            configMngr['rnafold']['input'],
-            configMngr['rnafold']['output'],
-            configMngr['offtargetscore']['input'],
-            configMngr['offtargetscore']['output'],
-            configMngr['bowtie2']['input'],
-            configMngr['bowtie2']['output'],
-        ]:
-            try:
-                os.remove(f)
-            except:
-                pass
+        if checkpoint is not None:
+            checkpoint.saveOutput(configMngr['output']['file'], batchFileId, batchSources[batchFileId])
 
         #########################################
         ##               Done                  ##
@@ -799,7 +692,83 @@ def Crackling(configMngr):
             (time.time() - batchStartTime)
         ))
 
-        batchFileId += 1
+
+    def checkpointed(name, stage):
+        # Skips a stage that a checkpoint records as complete for the batch, and
+        # records the stage once it is
+        def runStage(batch):
+            batchFileId, candidateGuides, batchStartTime = batch
+
+            if checkpoint is not None and name in checkpoint.completedStages(batchFileId):
+                printer(f'Batch file {(batchFileId+1):,}: {name} is complete, skipping it.')
+                return
+
+            stage(batch)
+
+            if checkpoint is not None:
+                checkpoint.saveStage(batchFileId, name, candidateGuides)
+
+        return runStage
+
+    # With incremental runs, the rows of each batch that are reused, by batch
+    reusedRows = {}
+
+    def loadStagedBatches():
+        for batchFileId in range(len(batchSources)):
+            candidateGuides = None
+
+            if checkpoint is not None:
+                if checkpoint.isOutput(batchFileId):
+                    printer(f'Batch file {(batchFileId+1):,} is complete, skipping it.')
+                    continue
+
+                # The guide table after the last completed stage, if any
+                candidateGuides = checkpoint.loadBatch(batchFileId)
+
+            # With incremental runs, only the guides without a reusable row go
+            # through the stages
+            if incremental is not None:
+                batchGuides = loadBatch(batchFileId)
+                reusedRows[batchFileId] = incremental.reusedRows(batchGuides)
+                if candidateGuides is None:
+                    candidateGuides = batchGuides.take(reusedRows[batchFileId].newIdx())
+
+            if candidateGuides is None:
+                candidateGuides = loadBatch(batchFileId)
+
+            yield (batchFileId, candidateGuides, time.time())
+
+    # Batches wait between stages in bounded queues, so that only a few
+    # batches are held in memory at a time
+    pipeline = StagePipeline(
+        [
+            ('efficiency', checkpointed('efficiency', efficiencyStage)),
+            ('secondary-structure', checkpointed('secondary-structure', secondaryStructureStage)),
+            ('sgrnascorer2', checkpointed('sgrnascorer2', sgRnaScorerStage)),
+            ('bowtie2', checkpointed('bowtie2', bowtieStage)),
+            ('offtargetscore', checkpointed('offtargetscore', offtargetScoringStage)),
+            ('output', outputStage),
+        ],
+        configMngr['input'].getint('pipeline-queue-length', fallback=1),
+        configMngr['input'].getint('pipeline-queue-memory', fallback=0) << 20,
+        lambda batch: batch[1].nbytes(),
+    )
+
+    pipeline.run(loadStagedBatches())
+
+    if incremental is not None:
+        incremental.commit(configMngr['output']['file'], configMngr['output']['delimiter'])
+
+    workerPool.close()
+
+    if rnaFoldPool is not None:
+        rnaFoldPool.close()
+
+    if isslIndex is not None:
+        isslIndex.close()
+
+    if isslServer is not None:
+        isslServer.close()
 
     printer('Total run time (dd hh:mm:ss) or {} seconds'.format(
         time.strftime('%d %H:%M:%S', time.gmtime((time.time() - startTime))),
@@ -0,0 +1,54 @@
+'''
+EfficiencyRules
+
+- The sequence rules of CHOPCHOP (a G at position 20) and mm10db (no leading T
+  or trailing A, an AT% of the first 20 bases between 20 and 65, no TTTT)
+- The rules are evaluated together on an (n, 23) uint8 character matrix, as
+  returned by GuideTable.seqMatrix(..), with NumPy comparisons, sums and
+  sliding windows rather than one guide at a time. The results are the same.
+- `evaluateRules` returns a status column (STATUS_ACCEPTED or STATUS_REJECTED)
+  for every rule, and the AT% of every guide. The caller keeps the results of
+  the guides that a rule is meant to assess (see CandidateFilter).
+'''
+
+import numpy as np
+
+from crackling.Constants import *
+
+SPACER_LENGTH = 20
+
+# The AT% of the spacer must be within [AT_MIN, AT_MAX]
+AT_MIN = 20
+AT_MAX = 65
+
+A, C, G, T = (ord(base) for base in 'ACGT')
+
+
+def _status(passed):
+    return np.where(passed, STATUS_ACCEPTED, STATUS_REJECTED).astype(np.int8)
+
+
+def evaluateRules(guides):
+    '''Evaluates every rule for an (n, 23) uint8 matrix of guides, returns {column : values}'''
+    guides = np.asarray(guides, dtype=np.uint8)
+
+    isT = guides == T
+
+    # A leading T on the + strand, or a trailing A on the - strand
+    leadingT = (
+        (isT[:, 0] & (guides[:, -2] == G) & (guides[:, -1] == G)) |
+        ((guides[:, 0] == C) & (guides[:, 1] == C) & (guides[:, -1] == A))
+    )
+
+    AT = 100.0 * np.count_nonzero(isT[:, :SPACER_LENGTH] | (guides[:, :SPACER_LENGTH] == A), axis=1) / SPACER_LENGTH
+
+    # Four consecutive Ts, anywhere in the guide
+    TTTT = (isT[:, :-3] & isT[:, 1:-2] & isT[:, 2:-1] & isT[:, 3:]).any(axis=1)
+
+    return {
+        'passedG20'             : _status(guides[:, 19] == G),
+        'passedAvoidLeadingT'   : _status(~leadingT),
+        'passedATPercent'       : _status((AT >= AT_MIN) & (AT <= AT_MAX)),
+        'AT'                    : AT,
+        'passedTTTT'            : _status(~TTTT),
+    }
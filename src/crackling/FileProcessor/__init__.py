@@ -1 +1,4 @@
-from .file_processor import find_candidates_in_file
\ No newline at end of file
+from .file_processor import find_candidates_in_file, partition_candidates_in_file
+from .guide_encoding import encode_guides, decode_guides, SIGNATURE_DTYPE
+from .fasta_reader import read_fasta_records
+from .pam_scanner import scan_pam_sites
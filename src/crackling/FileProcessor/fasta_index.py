@@ -0,0 +1,298 @@
+import getpass
+import hashlib
+import mmap
+import os
+import stat
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+
+from crackling.FileProcessor.fasta_reader import is_gzip_file, LINE_BREAKS
+
+
+# One line of a `.fai` index (see `samtools faidx`), plus the full header line
+# of the record, which is what is written to the output
+FastaIndexEntry = namedtuple('FastaIndexEntry', ['name', 'length', 'offset', 'line_bases', 'line_width', 'header'])
+
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+
+
+# The indexes built here are cached in a temporary directory of the user, not
+# next to the FASTA files: their directory may be read-only, or be the input
+# directory of a run, where an index would be taken for another input file
+CACHE_DIR = os.path.join(
+    tempfile.gettempdir(),
+    f'crackling-fai-{os.getuid() if hasattr(os, "getuid") else getpass.getuser()}'
+)
+
+# The first line of a cached index, followed by the size, mtime (ns) and inode
+# of the FASTA file when it was indexed
+CACHE_HEADER = '#crackling-fai'
+
+
+def fai_path(filename):
+    return f'{filename}.fai'
+
+
+def cached_fai_path(filename):
+    key = hashlib.sha1(os.path.realpath(filename).encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f'{key}-{os.path.basename(filename)}.fai')
+
+
+def _cache_header(filename):
+    st = os.stat(filename)
+    return f'{CACHE_HEADER}\t{st.st_size}\t{st.st_mtime_ns}\t{st.st_ino}\n'
+
+
+def _is_private_cache():
+    """
+        Whether CACHE_DIR is a directory of this user, which no one else can
+        write to, so that no one else can plant an index in it
+    """
+    try:
+        st = os.lstat(CACHE_DIR)
+    except OSError:
+        return False
+
+    if not stat.S_ISDIR(st.st_mode):
+        return False
+
+    if hasattr(os, 'getuid'):
+        return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+    return True
+
+
+def _index_record(view, header, start, end):
+    """
+        Indexes the sequence held in view[start:end]. Returns None when the
+        lines are not all the same length (except the last one), which a
+        `.fai` index cannot describe.
+    """
+    sequence = np.frombuffer(view[start:end], dtype=np.uint8)
+
+    # Ignore the line break(s) at the end of the record
+    length = len(sequence)
+    while length > 0 and sequence[length - 1] in (NEWLINE, CARRIAGE_RETURN):
+        length -= 1
+    sequence = sequence[:length]
+
+    name = header.split()[0] if header.split() else ''
+    if name == '':
+        return None
+
+    line_ends = np.flatnonzero(sequence == NEWLINE)
+    if len(line_ends) == 0:
+        # A single line
+        if np.count_nonzero(np.isin(sequence, np.frombuffer(LINE_BREAKS, dtype=np.uint8))):
+            return None
+        return FastaIndexEntry(name, length, start, length, length + 1, header)
+
+    line_width = int(line_ends[0]) + 1
+    crlf = line_width > 1 and sequence[line_width - 2] == CARRIAGE_RETURN
+    line_bases = line_width - (2 if crlf else 1)
+
+    full_lines, last_line = divmod(length, line_width)
+
+    if (
+        line_bases == 0 or
+        last_line > line_bases or
+        len(line_ends) != full_lines or
+        not np.array_equal(line_ends, np.arange(line_width - 1, full_lines * line_width, line_width)) or
+        np.count_nonzero(sequence == CARRIAGE_RETURN) != (full_lines if crlf else 0) or
+        np.count_nonzero((sequence == ord(' ')) | (sequence == ord('\t')))
+    ):
+        return None
+
+    return FastaIndexEntry(name, full_lines * line_bases + last_line, start, line_bases, line_width, header)
+
+
+def build_fasta_index(filename):
+    """
+        Indexes an uncompressed FASTA file. Returns a list of FastaIndexEntry,
+        in file order, or None if the file cannot be indexed.
+    """
+    if is_gzip_file(filename) or os.path.getsize(filename) == 0:
+        return None
+
+    entries = []
+
+    with open(filename, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        view = memoryview(buffer)
+        try:
+            length = len(buffer)
+            pos = 0
+
+            # Skip blank lines before the first header
+            while pos < length and buffer[pos:pos + 1] in (b'\n', b'\r'):
+                pos += 1
+
+            while pos < length:
+                # Every record must have a header
+                if buffer[pos:pos + 1] != b'>':
+                    return None
+
+                eol = buffer.find(b'\n', pos)
+                if eol == -1:
+                    eol = length
+                header = bytes(buffer[pos + 1:eol]).strip().decode()
+
+                start = min(eol + 1, length)
+                end = buffer.find(b'\n>', eol)
+                end = length if end == -1 else end + 1
+
+                entry = _index_record(view, header, start, end)
+                if entry is None:
+                    return None
+                entries.append(entry)
+
+                pos = end
+        finally:
+            view.release()
+
+    return entries
+
+
+def _read_header(file, offset):
+    """
+        Reads the header line which ends just before `offset`
+    """
+    size = 4096
+    while True:
+        start = max(0, offset - size)
+        file.seek(start)
+        data = file.read(offset - start)
+
+        line_start = data.rfind(b'\n', 0, len(data) - 1) + 1
+        if line_start > 0 or start == 0:
+            return data[line_start:].lstrip(b'>').strip().decode()
+
+        size *= 2
+
+
+def _read_entries(index_file, file, size):
+    """
+        Reads the entries of a `.fai` index. Returns None if one does not
+        describe a record of the FASTA file, of `size` bytes.
+    """
+    entries = []
+    for line in index_file:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 5:
+            return None
+        name, length, offset, line_bases, line_width = fields[0], *map(int, fields[1:5])
+
+        # The sequence must be within the file, just after a header line
+        entry = FastaIndexEntry(name, length, offset, line_bases, line_width, None)
+        if length < 0 or offset <= 0 or offset + length > size:
+            return None
+        if length > 0 and (
+            line_bases <= 0 or
+            line_width <= line_bases or
+            _base_offset(entry, length - 1) >= size
+        ):
+            return None
+
+        file.seek(offset - 1)
+        if file.read(1) != b'\n':
+            return None
+
+        header = _read_header(file, offset)
+        if header.split()[:1] != [name]:
+            return None
+
+        entries.append(entry._replace(header=header))
+
+    return entries
+
+
+def load_fasta_index(filename):
+    """
+        Loads the `.fai` index of a FASTA file, next to the file (e.g. from
+        `samtools faidx`) if it is not older than the file, or cached by
+        `write_fasta_index` if the file has not changed since. Returns None
+        otherwise, or if the index does not describe the file.
+    """
+    size = os.path.getsize(filename)
+
+    try:
+        index_filename = fai_path(filename)
+        if os.path.exists(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+            with open(index_filename, 'r') as index_file, open(filename, 'rb') as file:
+                return _read_entries(index_file, file, size)
+
+        index_filename = cached_fai_path(filename)
+        if _is_private_cache() and os.path.exists(index_filename):
+            with open(index_filename, 'r') as index_file, open(filename, 'rb') as file:
+                if index_file.readline() != _cache_header(filename):
+                    return None
+                return _read_entries(index_file, file, size)
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def write_fasta_index(filename, entries):
+    """
+        Writes `entries` as the `.fai` index of a FASTA file, in CACHE_DIR.
+        The index is only a cache, failing to write it is not an error.
+    """
+    index_filename = cached_fai_path(filename)
+    try:
+        os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+        if not _is_private_cache():
+            return
+
+        # Written in full before it replaces an older index
+        with tempfile.NamedTemporaryFile('w', dir=CACHE_DIR, delete=False) as index_file:
+            index_file.write(_cache_header(filename))
+            for entry in entries:
+                index_file.write(f'{entry.name}\t{entry.length}\t{entry.offset}\t{entry.line_bases}\t{entry.line_width}\n')
+        os.replace(index_file.name, index_filename)
+    except OSError:
+        pass
+
+
+def get_fasta_index(filename):
+    """
+        Returns the index of a FASTA file, reusing a `.fai` file or building
+        (and caching) one. Returns None if the file cannot be indexed, e.g.
+        because it is compressed or its lines are not all the same length.
+    """
+    if is_gzip_file(filename):
+        return None
+
+    entries = load_fasta_index(filename)
+    if entries is None:
+        entries = build_fasta_index(filename)
+        if entries is not None:
+            write_fasta_index(filename, entries)
+
+    return entries
+
+
+def _base_offset(entry, position):
+    """
+        Returns the file offset of a base of the record
+    """
+    line, column = divmod(position, entry.line_bases)
+    return entry.offset + line * entry.line_width + column
+
+
+def read_region(file, entry, start, end):
+    """
+        Reads bases [start, end) of an indexed record from a binary file,
+        without line breaks
+    """
+    end = min(end, entry.length)
+    if end <= start:
+        return b''
+
+    file_start = _base_offset(entry, start)
+    file_end = _base_offset(entry, end - 1) + 1
+
+    file.seek(file_start)
+    return file.read(file_end - file_start).translate(None, LINE_BREAKS)
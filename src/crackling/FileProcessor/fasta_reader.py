@@ -0,0 +1,150 @@
+import gzip
+import mmap
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Bytes removed from sequence lines
+LINE_BREAKS = b'\r\n\t '
+
+# How many (decompressed) bytes to read per block from a gzip stream
+# Default: 16 MiB
+READ_SIZE = 1 << 24
+
+
+def is_gzip_file(filename):
+    """
+        Returns True if the file starts with the gzip magic number (this
+        includes BGZF files, which are gzip files made of many members)
+    """
+    with open(filename, 'rb') as file:
+        return file.read(2) == GZIP_MAGIC
+
+
+def _decode_header(line):
+    return bytes(line).strip().decode()
+
+
+def _iter_buffer_records(buffer):
+    """
+        Yields (header, sequence) for every record of a FASTA file held in
+        `buffer` (e.g. a mmap). Each sequence is one bytes object with the
+        line breaks removed.
+    """
+    length = len(buffer)
+    pos = 0
+
+    while pos < length:
+        header = None
+
+        if buffer[pos:pos + 1] == b'>':
+            eol = buffer.find(b'\n', pos)
+            if eol == -1:
+                eol = length
+            header = _decode_header(buffer[pos + 1:eol])
+            pos = eol + 1
+
+        end = buffer.find(b'\n>', max(pos - 1, 0))
+        if end == -1:
+            end = length
+
+        sequence = buffer[pos:end].translate(None, LINE_BREAKS)
+
+        # Blank lines before the first header are not a record
+        if header is not None or sequence:
+            yield header, sequence
+
+        pos = end + 1
+
+
+def _iter_stream_records(stream):
+    """
+        Yields (header, sequence) for every record of a FASTA file read from a
+        binary stream, one block at a time. Lines may span blocks.
+    """
+    header = None
+    sequence = bytearray()
+    have_record = False
+
+    leftover = b''
+    # Whether `leftover` (or, when it is empty, the next block) starts a line
+    line_start = True
+
+    while True:
+        block = stream.read(READ_SIZE)
+        eof = not block
+
+        data = leftover + block
+
+        # Only complete lines are parsed, unless this is the end of the stream
+        cut = len(data) if eof else data.rfind(b'\n') + 1
+        complete, leftover = data[:cut], data[cut:]
+
+        pos = 0
+        while pos < len(complete):
+            if complete[pos:pos + 1] == b'>' and (pos > 0 or line_start):
+                if have_record:
+                    yield header, bytes(sequence)
+                    sequence = bytearray()
+
+                eol = complete.find(b'\n', pos)
+                if eol == -1:
+                    eol = len(complete)
+                header = _decode_header(complete[pos + 1:eol])
+                have_record = True
+                pos = eol + 1
+                continue
+
+            end = complete.find(b'\n>', pos)
+            end = len(complete) if end == -1 else end + 1
+
+            sequence += complete[pos:end].translate(None, LINE_BREAKS)
+            have_record = have_record or len(sequence) > 0
+            pos = end
+
+        if eof:
+            break
+
+        leftover_line_start = cut > 0 or line_start
+
+        # Only a (short) header line is carried over to the next block. A long
+        # sequence line without a line break would otherwise be copied again
+        # for every block.
+        if leftover and not (leftover_line_start and leftover[:1] == b'>'):
+            sequence += leftover.translate(None, LINE_BREAKS)
+            have_record = have_record or len(sequence) > 0
+            leftover = b''
+            line_start = False
+        else:
+            line_start = leftover_line_start
+
+    if have_record:
+        yield header, bytes(sequence)
+
+
+def read_fasta_records(filename):
+    """
+        Yields (header, sequence) for every record of a FASTA, or multi-FASTA,
+        file. The sequence is given as bytes, without line breaks.
+
+        Plain files are memory-mapped. Gzip (and BGZF) compressed files are
+        decompressed as a stream.
+    """
+    if is_gzip_file(filename):
+        with gzip.open(filename, 'rb') as stream:
+            yield from _iter_stream_records(stream)
+        return
+
+    with open(filename, 'rb') as file:
+        try:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # mmap cannot map an empty file
+            return
+
+        try:
+            if hasattr(buffer, 'madvise'):
+                buffer.madvise(mmap.MADV_SEQUENTIAL)
+            yield from _iter_buffer_records(buffer)
+        finally:
+            buffer.close()
@@ -1,98 +1,224 @@
-import re
+import os
 import joblib
+import numpy as np
 
 from crackling.Helpers import printer
+from crackling.FileProcessor.guide_encoding import decode_guides, GUIDE_LENGTH, SIGNATURE_DTYPE
+from crackling.FileProcessor.pam_scanner import scan_pam_sites
+from crackling.FileProcessor.fasta_reader import read_fasta_records
+from crackling.FileProcessor.fasta_index import get_fasta_index, read_region
 
 
+# Long sequences are split into chunks of this many guide start positions,
+# which are processed in parallel. Consecutive chunks overlap by 22 bases so
+# that every guide is found in exactly one chunk.
+# Default: 8 Mbp
+CHUNK_SIZE = 1 << 23
+CHUNK_OVERLAP = GUIDE_LENGTH - 1
+
 COMPLIMENTS = str.maketrans('acgtrymkbdhvACGTRYMKBDHV', 'tgcayrkmvhdbTGCAYRKMVHDB')
+COMPLIMENTS_BYTES = bytes.maketrans(b'acgtrymkbdhvACGTRYMKBDHV', b'tgcayrkmvhdbTGCAYRKMVHDB')
 
 def reverse_complement(sequence):
     """
-        Returns the reverse-complement of a given sequence
+        Returns the reverse-complement of a given sequence (str or bytes)
     """
+    if isinstance(sequence, (bytes, bytearray)):
+        return sequence.translate(COMPLIMENTS_BYTES)[::-1]
     return sequence.translate(COMPLIMENTS)[::-1]
 
 
 def process_sequence(sequence, sequence_header):
-    # Patterns for guide matching
-    pattern_forward = r'(?=([ATCG]{21}GG))'
-    pattern_reverse = r'(?=(CC[ACGT]{21}))'
-
-    # New sequence deteced, process sequence
-    # once for forward, once for reverse
-    for pattern, strand, sequence_modifier in [
-        [pattern_forward, '+', lambda x : x], 
-        [pattern_reverse, '-', lambda x : reverse_complement(x)]
-    ]:
-        p = re.compile(pattern)
-        for m in p.finditer(sequence):
-            target23 = sequence_modifier(sequence[m.start() : m.start() + 23])
-            yield [target23, sequence_header,  m.start(),  m.start() + 23, strand]
+    """
+        Yields [target23, header, start, end, strand] for every guide of a
+        sequence, see `scan_pam_sites`. target23 has the type of `sequence`.
+    """
+    signatures, starts, ends, strands = scan_pam_sites(sequence)
+    targets = decode_guides(signatures)
+
+    if isinstance(sequence, str):
+        targets = targets.astype(f'U{GUIDE_LENGTH}')
+
+    for target23, start, end, strand in zip(targets.tolist(), starts.tolist(), ends.tolist(), strands.tolist()):
+        yield [target23, sequence_header, start, end, strand]
 
 
 def find_guides(sequence_header, sequence):
-    guides = {}
+    """
+        Returns the distinct guides of a sequence as sorted signatures, with
+        how often each occurs and the position of its first occurrence
+    """
+    signatures, starts, _, strands = scan_pam_sites(sequence)
 
-    for guide in process_sequence(sequence, sequence_header):
-        if guide[0] in guides.keys():
-            guides[guide[0]] += 1
-        else:
-            guides[guide[0]] = 1
+    signatures, first, counts = np.unique(signatures, return_index=True, return_counts=True)
 
-    return (sequence_header, guides)
+    return (sequence_header, signatures, counts, starts[first], strands[first].tolist())
 
 
-def load_fasta_sequence_file(filename):
-    sequence_header = None
-    sequence = []
+def find_guides_in_region(filename, entry, start, end):
+    """
+        Returns the distinct guides which start in [start, end) of an indexed
+        record, read by offset from `filename`, as sorted signatures with how
+        often each occurs and the position and strand of its first occurrence
+    """
+    with open(filename, 'rb') as file:
+        sequence = read_region(file, entry, start, end + CHUNK_OVERLAP)
 
-    with open(filename, 'r') as file:
-        for line in file:
-            # Clean line
-            line = line.strip()
+    signatures, starts, _, strands = scan_pam_sites(sequence)
 
-            # Sequence Header
-            if (line[0] == '>'):
-                if (sequence_header is not None):
-                    yield sequence_header, ''.join(sequence)
+    signatures, first, counts = np.unique(signatures, return_index=True, return_counts=True)
 
-                sequence_header = line[1:]
-                sequence = []
+    return (signatures, counts, starts[first] + start, strands[first])
 
-            # Regular line
-            else:
-                sequence.append(line)
-        
-        # Return last line
-        yield sequence_header, ''.join(sequence)
 
+def merge_guides(sequence_header, chunk_results):
+    """
+        Merges the results of `find_guides_in_region` for the chunks of one
+        record into the result `find_guides` gives for the whole record
+    """
+    signatures = np.concatenate([r[0] for r in chunk_results])
+    counts = np.concatenate([r[1] for r in chunk_results])
+    starts = np.concatenate([r[2] for r in chunk_results])
+    strands = np.concatenate([r[3] for r in chunk_results])
 
-def find_candidates_in_file(guide_batchinator, target_file, candidate_guides, duplicate_guides, recorded_sequences):
-    assert isinstance(candidate_guides, set)
-    assert isinstance(duplicate_guides, set)
-    assert isinstance(recorded_sequences, set)
+    # The first occurrence of a guide is its first forward strand occurrence,
+    # otherwise its first reverse strand occurrence, as in `scan_pam_sites`
+    order = np.lexsort((starts, strands == '-', signatures))
+    counts, starts, strands = counts[order], starts[order], strands[order]
 
-    duplicate_guide_count = 0
-    identified_guide_count = 0
+    signatures, first = np.unique(signatures[order], return_index=True)
+    counts = np.add.reduceat(counts, first) if len(first) else counts
+
+    return (sequence_header, signatures, counts, starts[first], strands[first].tolist())
+
+
+def find_guides_in_file(target_file):
+    """
+        Returns the result of `find_guides` for every record of a FASTA file,
+        in file order.
+
+        If the file can be indexed (see `get_fasta_index`), long records are
+        split into overlapping chunks, which the workers read from the file by
+        offset. Otherwise each record is read and sent to a worker whole.
+    """
+    index = get_fasta_index(target_file)
+
+    if index is None:
+        return joblib.Parallel(n_jobs=-1)(joblib.delayed(find_guides)(sequence_header, sequence) for sequence_header, sequence in load_fasta_sequence_file(target_file))
+
+    chunks = [
+        (record, start, min(start + CHUNK_SIZE, entry.length))
+            for record, entry in enumerate(index)
+                for start in range(0, max(entry.length, 1), CHUNK_SIZE)
+    ]
+
+    chunk_results = joblib.Parallel(n_jobs=-1)(joblib.delayed(find_guides_in_region)(target_file, index[record], start, end) for record, start, end in chunks)
+
+    record_results = [[] for _ in index]
+    for (record, _, _), result in zip(chunks, chunk_results):
+        record_results[record].append(result)
+
+    return [merge_guides(entry.header, results) for entry, results in zip(index, record_results)]
+
+
+def load_fasta_sequence_file(filename):
+    """
+        Yields (header, sequence) for each record of a FASTA file, which may be
+        gzip compressed. Sequences are bytes, see `read_fasta_records`.
+    """
+    yield from read_fasta_records(filename)
+
+
+def find_candidates_in_file(guide_batchinator, target_file, candidate_guides, duplicate_guides, recorded_sequences, results=None):
+    """
+        Extracts the guides of `target_file` and records the ones seen for the
+        first time to `guide_batchinator`.
+
+        `candidate_guides` and `duplicate_guides` are sorted arrays of guide
+        signatures (see guide_encoding) seen in previous files. Updated copies
+        are returned.
+
+        `results`, the result of `find_guides_in_file`, is passed when it is
+        already known (see IncrementalRun).
+    """
+    assert isinstance(candidate_guides, np.ndarray)
+    assert isinstance(duplicate_guides, np.ndarray)
+    assert isinstance(recorded_sequences, set)
 
     target_file_size = os.path.getsize(target_file)
 
-    printer(f'Identifying possible target sites in: {target_file}')
-    results = joblib.Parallel(n_jobs=-1)(joblib.delayed(find_guides)(sequence_header, sequence) for sequence_header, sequence in load_fasta_sequence_file(target_file))
+    if results is None:
+        printer(f'Identifying possible target sites in: {target_file}')
+        results = find_guides_in_file(target_file)
 
     printer(f'Combining results from {len(results)} sequence headers')
+
+    if len(results) == 0:
+        return candidate_guides, duplicate_guides, recorded_sequences, target_file_size, 0, 0
+
     # Combine Results
-    for (sequence_header, guides) in results:
+    # Each (sequence, guide) pair is assessed in the order the sequences appear
+    # in the file. A pair is a duplicate when the guide occurs more than once in
+    # the sequence or has already been seen in a previous sequence or file.
+    signatures = np.concatenate([r[1] for r in results])
+    counts = np.concatenate([r[2] for r in results])
+
+    for (sequence_header, _, _, _, _) in results:
         recorded_sequences.add(sequence_header)
 
-        for guide, guide_count in guides.items():
-            identified_guide_count += 1
-            if (guide_count > 1) or (guide in candidate_guides):
-                duplicate_guides.add(guide)
-                duplicate_guide_count += 1
-            else:
-                guide_batchinator.recordEntry(guide)
+    order = np.argsort(signatures, kind='stable')
+    sorted_signatures = signatures[order]
+    first_in_file = np.ones(len(signatures), dtype=bool)
+    first_in_file[order[1:]] = sorted_signatures[1:] != sorted_signatures[:-1]
+
+    seen_before = np.isin(signatures, candidate_guides, assume_unique=False)
+
+    is_duplicate = (counts > 1) | ~first_in_file | seen_before
+
+    identified_guide_count = len(signatures)
+    duplicate_guide_count = int(np.count_nonzero(is_duplicate))
+
+    # Record the guides which are not duplicates (yet)
+    offset = 0
+    for (sequence_header, sequence_signatures, _, starts, strands) in results:
+        record = np.flatnonzero(~is_duplicate[offset:offset + len(sequence_signatures)])
+        guide_batchinator.recordEntries(
+            sequence_signatures[record],
+            [sequence_header] * len(record),
+            starts[record],
+            starts[record] + 23,
+            [strands[i] for i in record]
+        )
+        offset += len(sequence_signatures)
 
-            candidate_guides.add(guide)
+    candidate_guides = np.union1d(candidate_guides, signatures).astype(SIGNATURE_DTYPE)
+    duplicate_guides = np.union1d(duplicate_guides, signatures[is_duplicate]).astype(SIGNATURE_DTYPE)
+
+    return candidate_guides, duplicate_guides, recorded_sequences, target_file_size, identified_guide_count, duplicate_guide_count
+
+
+def partition_candidates_in_file(guide_partitioner, target_file, recorded_sequences, results=None):
+    """
+        Extracts the guides of `target_file` and spills them to
+        `guide_partitioner` (see GuidePartitioner). Duplicates are resolved
+        later, one partition at a time.
+
+        `results` is as for `find_candidates_in_file`.
+    """
+    assert isinstance(recorded_sequences, set)
+
+    target_file_size = os.path.getsize(target_file)
+
+    if results is None:
+        printer(f'Identifying possible target sites in: {target_file}')
+        results = find_guides_in_file(target_file)
+
+    printer(f'Spilling results from {len(results)} sequence headers')
+
+    identified_guide_count = 0
+    for (sequence_header, signatures, counts, starts, strands) in results:
+        recorded_sequences.add(sequence_header)
+        guide_partitioner.recordGuides(sequence_header, signatures, counts, starts, strands)
+        identified_guide_count += len(signatures)
 
-    return candidate_guides, duplicate_guides, recorded_sequences, target_file_size, duplicate_guide_count, identified_guide_count
+    return recorded_sequences, target_file_size, identified_guide_count
@@ -0,0 +1,63 @@
+import numpy as np
+
+
+GUIDE_LENGTH = 23
+
+# Same scheme as `sequenceToSignature` in ISSL: A=0, C=1, G=2, T=3, with the
+# first base in the two least-significant bits.
+NUCLEOTIDE_INDEX = np.full(256, 255, dtype=np.uint8)
+for code, base in enumerate(b'ACGT'):
+    NUCLEOTIDE_INDEX[base] = code
+
+SIGNATURE_INDEX = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+SIGNATURE_DTYPE = np.uint64
+
+
+def _shifts(length):
+    return np.arange(0, 2 * length, 2, dtype=np.uint64)
+
+
+def encode_matrix(matrix):
+    """
+        Binary encodes an (n, length) uint8 matrix of ACGT characters
+        into n 64-bit signatures (2 bits per base)
+    """
+    codes = NUCLEOTIDE_INDEX[matrix]
+
+    if codes.size and codes.max() > 3:
+        raise ValueError('Guides may only contain the characters A, C, G and T')
+
+    return (codes.astype(np.uint64) << _shifts(matrix.shape[1])).sum(axis=1, dtype=np.uint64)
+
+
+def encode_guides(guides, length=GUIDE_LENGTH):
+    """
+        Binary encodes a list of guide sequences (str or bytes) into signatures
+    """
+    if len(guides) == 0:
+        return np.zeros(0, dtype=SIGNATURE_DTYPE)
+
+    if isinstance(guides[0], (bytes, bytearray)):
+        joined = b''.join(guides)
+    else:
+        joined = ''.join(guides).encode('ascii')
+
+    matrix = np.frombuffer(joined, dtype=np.uint8).reshape(-1, length)
+    return encode_matrix(matrix)
+
+
+def decode_matrix(signatures, length=GUIDE_LENGTH):
+    """
+        Decodes signatures into an (n, length) uint8 matrix of ACGT characters
+    """
+    signatures = np.asarray(signatures, dtype=SIGNATURE_DTYPE)
+    codes = (signatures[:, None] >> _shifts(length)) & np.uint64(0x3)
+    return SIGNATURE_INDEX[codes]
+
+
+def decode_guides(signatures, length=GUIDE_LENGTH):
+    """
+        Decodes signatures into a fixed-width bytes array (dtype S<length>)
+    """
+    return np.ascontiguousarray(decode_matrix(signatures, length)).view(f'S{length}').reshape(-1)
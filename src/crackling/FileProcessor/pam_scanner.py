@@ -0,0 +1,99 @@
+import numpy as np
+
+from crackling.FileProcessor.guide_encoding import NUCLEOTIDE_INDEX, GUIDE_LENGTH, SIGNATURE_DTYPE
+
+
+# Number of bases before the PAM (NGG) that must be A, C, G or T
+WINDOW_LENGTH = GUIDE_LENGTH - 2
+
+_G = NUCLEOTIDE_INDEX[ord('G')]
+_C = NUCLEOTIDE_INDEX[ord('C')]
+
+
+def sequence_to_codes(sequence):
+    """
+        Maps a sequence (str or bytes) to a uint8 array of 2-bit codes. Any
+        character other than (upper case) A, C, G and T is mapped to 255.
+    """
+    if isinstance(sequence, str):
+        # Each character becomes one byte, non-ASCII characters become '?'
+        sequence = sequence.encode('ascii', 'replace')
+
+    return NUCLEOTIDE_INDEX[np.frombuffer(sequence, dtype=np.uint8)]
+
+
+def _valid_windows(codes, length):
+    """
+        Returns a mask of the positions `i` for which codes[i:i+length] only
+        holds A, C, G or T, using a rolling count of the invalid bases
+    """
+    count_dtype = np.int32 if len(codes) < np.iinfo(np.int32).max else np.int64
+
+    invalid = np.zeros(len(codes) + 1, dtype=count_dtype)
+    np.cumsum(codes > 3, dtype=count_dtype, out=invalid[1:])
+
+    return (invalid[length:] - invalid[:-length]) == 0
+
+
+def _signatures(codes, starts, reverse):
+    """
+        Encodes the 23-mers at `starts`, or their reverse-complement
+    """
+    signatures = np.zeros(len(starts), dtype=SIGNATURE_DTYPE)
+
+    for k in range(GUIDE_LENGTH):
+        if reverse:
+            # Complement of a 2-bit code: A <-> T, C <-> G
+            base = 3 - codes[starts + (GUIDE_LENGTH - 1 - k)]
+        else:
+            base = codes[starts + k]
+        signatures |= base.astype(SIGNATURE_DTYPE) << SIGNATURE_DTYPE(2 * k)
+
+    return signatures
+
+
+def scan_pam_sites(sequence):
+    """
+        Finds every guide of a sequence, i.e. the 23-mers matching
+        `[ACGT]{21}GG` (forward strand) or `CC[ACGT]{21}` (reverse strand)
+
+        Returns (signatures, starts, ends, strands): the 2-bit encoded guides
+        (reverse strand guides are reverse-complemented), their [start, end)
+        positions in the sequence and their strand as '+' or '-'. Forward
+        strand guides come first, each strand is ordered by position, which
+        is the order given by the regular expressions.
+    """
+    codes = sequence_to_codes(sequence)
+
+    site_count = len(codes) - GUIDE_LENGTH + 1
+    if site_count <= 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return np.zeros(0, dtype=SIGNATURE_DTYPE), empty, empty.copy(), np.zeros(0, dtype='U1')
+
+    valid = _valid_windows(codes, WINDOW_LENGTH)
+
+    # [ACGT]{21}GG starting at i
+    forward = (
+        (codes[WINDOW_LENGTH:WINDOW_LENGTH + site_count] == _G) &
+        (codes[WINDOW_LENGTH + 1:WINDOW_LENGTH + 1 + site_count] == _G) &
+        valid[:site_count]
+    )
+
+    # CC[ACGT]{21} starting at i
+    reverse = (
+        (codes[:site_count] == _C) &
+        (codes[1:1 + site_count] == _C) &
+        valid[2:2 + site_count]
+    )
+
+    forward_starts = np.flatnonzero(forward)
+    reverse_starts = np.flatnonzero(reverse)
+
+    signatures = np.concatenate([
+        _signatures(codes, forward_starts, reverse=False),
+        _signatures(codes, reverse_starts, reverse=True),
+    ])
+    starts = np.concatenate([forward_starts, reverse_starts]).astype(np.int64)
+    strands = np.repeat(np.array(['+', '-']), [len(forward_starts), len(reverse_starts)])
+
+    return signatures, starts, starts + GUIDE_LENGTH, strands
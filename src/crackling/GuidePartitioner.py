@@ -0,0 +1,146 @@
+'''
+GuidePartitioner
+
+- Disk-backed duplicate detection, an alternative to keeping every distinct
+  guide of every input file in memory
+- The guides of each sequence are appended to one of N spill files, chosen by
+  a hash of the guide signature, so every occurrence of a guide ends up in the
+  same partition
+- Partitions are then resolved one at a time. Each partition is returned as a
+  batch (a GuideTable) with its uniqueness already resolved.
+- Peak memory is proportional to the size of a partition, not of the genome
+- A guide is recorded, at its first occurrence, when that occurrence is the
+  only one in its sequence. It is unique when it occurs once in the whole
+  input. This is the same result as `find_candidates_in_file`.
+- `resolveSpillFile` resolves a spill file by name, so that a partition can
+  also be resolved after a restart (see RunCheckpoint)
+'''
+
+import os, tempfile
+
+import numpy as np
+
+from crackling.GuideTable import GuideTable
+from crackling.FileProcessor.guide_encoding import SIGNATURE_DTYPE
+
+# One spilled (sequence, guide) pair. `sequence` is the position of the
+# sequence in input order, `count` how often the guide occurs in it and
+# `start`/`strand` describe its first occurrence.
+SPILL_DTYPE = np.dtype([
+    ('signature',   '<u8'),
+    ('sequence',    '<u4'),
+    ('count',       '<u4'),
+    ('start',       '<i8'),
+    ('strand',      'S1'),
+])
+
+# Fibonacci hashing, spreads similar signatures over the partitions
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+
+def partitionOf(signatures, partitionCount:int):
+    '''Returns the partition of each signature'''
+    hashed = np.asarray(signatures, dtype=SIGNATURE_DTYPE) * HASH_MULTIPLIER
+    return (hashed >> np.uint64(32)) % np.uint64(partitionCount)
+
+
+def resolveSpillFile(filename, headers, remove:bool=True):
+    '''
+    Counts the occurrences of each guide of a spill file, whose sequences are
+    positions in `headers`. Returns (table, distinct guide count, duplicate
+    guide count), see `GuidePartitioner.resolvePartition`.
+    '''
+    entries = np.fromfile(filename, dtype=SPILL_DTYPE)
+    if remove:
+        os.unlink(filename)
+
+    if len(entries) == 0:
+        return GuideTable(0), 0, 0
+
+    # Group the occurrences of each guide, in input order
+    entries = entries[np.lexsort((entries['sequence'], entries['signature']))]
+
+    first = np.flatnonzero(np.concatenate([[True], entries['signature'][1:] != entries['signature'][:-1]]))
+    totals = np.add.reduceat(entries['count'].astype(np.int64), first)
+
+    firstEntries = entries[first]
+    duplicateGuides = firstEntries['signature'][totals > 1]
+
+    # Record guides in the order `find_candidates_in_file` would have
+    recorded = firstEntries[firstEntries['count'] == 1]
+    recorded = recorded[np.lexsort((recorded['signature'], recorded['sequence']))]
+
+    table = GuideTable.fromColumns(
+        recorded['signature'],
+        np.array(headers, dtype=object)[recorded['sequence']],
+        recorded['start'],
+        recorded['start'] + 23,
+        recorded['strand'].astype('U1'),
+        duplicateGuides
+    )
+
+    return table, len(first), len(duplicateGuides)
+
+
+class GuidePartitioner:
+    def __init__(self, partitionCount:int, dir:str=None):
+        self.workingDir = tempfile.TemporaryDirectory(dir=dir)
+        self.partitionCount = partitionCount
+        self.partitionFiles = [
+            open(os.path.join(self.workingDir.name, f'partition-{p}.bin'), 'wb')
+                for p in range(partitionCount)
+        ]
+        self.headers = []
+        self.currentBatch = 0
+
+        # Totals, known once every partition has been resolved
+        self.distinctGuideCount = 0
+        self.duplicateGuideCount = 0
+
+    def __len__(self):
+        return self.partitionCount
+
+    def recordGuides(self, sequenceHeader, signatures, counts, starts, strands):
+        '''Spills the distinct guides of one sequence, as returned by `find_guides`'''
+        sequence = len(self.headers)
+        self.headers.append(sequenceHeader)
+
+        entries = np.zeros(len(signatures), dtype=SPILL_DTYPE)
+        entries['signature'] = signatures
+        entries['sequence'] = sequence
+        entries['count'] = counts
+        entries['start'] = starts
+        entries['strand'] = np.asarray(strands, dtype='S1')
+
+        partitions = partitionOf(entries['signature'], self.partitionCount)
+        order = np.argsort(partitions, kind='stable')
+        bounds = np.searchsorted(partitions[order], np.arange(self.partitionCount + 1, dtype=np.uint64))
+
+        entries = entries[order]
+        for p in range(self.partitionCount):
+            if bounds[p] < bounds[p + 1]:
+                entries[bounds[p]:bounds[p + 1]].tofile(self.partitionFiles[p])
+
+    def resolvePartition(self, partition:int):
+        '''Counts the occurrences of each guide of a partition and returns the partition as a GuideTable'''
+        table, distinctCount, duplicateCount = resolveSpillFile(self.partitionFiles[partition].name, self.headers)
+
+        self.distinctGuideCount += distinctCount
+        self.duplicateGuideCount += duplicateCount
+
+        return table
+
+    def close(self):
+        '''Finishes writing and returns the name of every spill file, in partition order'''
+        for file in self.partitionFiles:
+            file.close()
+        return [file.name for file in self.partitionFiles]
+
+    def __iter__(self):
+        # Finish writing the spill files
+        self.close()
+
+        # yield one batch per partition
+        for partition in range(self.partitionCount):
+            self.currentBatch += 1
+            yield self.resolvePartition(partition)
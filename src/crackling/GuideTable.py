@@ -0,0 +1,248 @@
+'''
+GuideTable
+
+- Column-oriented storage for the candidate guides of one batch
+- Replaces the dict-of-dicts (one `DEFAULT_GUIDE_PROPERTIES` copy per guide)
+- Guides are addressed by their row index, stages read and write whole columns
+- Guides are kept as 2-bit signatures (see FileProcessor.guide_encoding) and
+  as decoded fixed-width bytes for the stages that work on characters
+- Status columns (e.g. `passedTTTT`) hold compact int8 codes (STATUS_*)
+- Value columns (e.g. `AT`) hold a NumPy value array plus an int8 state array,
+  the state is STATUS_VALUE once a value has been written
+- Text columns (e.g. `ssStructure`) are object arrays
+- `rows()` renders the table using `DEFAULT_GUIDE_PROPERTIES_ORDER`, giving the
+  same output as the dict-of-dicts did
+'''
+
+import numpy as np
+
+from crackling.Constants import *
+from crackling.FileProcessor.guide_encoding import decode_guides, SIGNATURE_DTYPE
+
+SEQ_LENGTH = 23
+
+# name : default status
+STATUS_COLUMNS = {
+    'isUnique'                  : STATUS_ACCEPTED,
+    'passedTTTT'                : STATUS_UNTESTED,
+    'passedATPercent'           : STATUS_UNTESTED,
+    'passedG20'                 : STATUS_UNTESTED,
+    'passedSecondaryStructure'  : STATUS_UNTESTED,
+    'acceptedByMm10db'          : STATUS_UNTESTED,
+    'acceptedBySgRnaScorer'     : STATUS_UNTESTED,
+    'passedBowtie'              : STATUS_UNTESTED,
+    'passedOffTargetScore'      : STATUS_UNTESTED,
+    'passedAvoidLeadingT'       : STATUS_UNTESTED,
+}
+
+# name : dtype. Every value column starts as STATUS_UNTESTED.
+VALUE_COLUMNS = {
+    'start'                     : np.int64,
+    'end'                       : np.int64,
+    'consensusCount'            : np.int8,
+    'sgrnascorer2score'         : np.float64,
+    'AT'                        : np.float64,
+    'bowtieStart'               : np.int64,
+    'bowtieEnd'                 : np.int64,
+    'mitOfftargetscore'         : np.float64,
+    'cfdOfftargetscore'         : np.float64,
+}
+
+# name : default value
+TEXT_COLUMNS = {
+    'header'                    : "",
+    'strand'                    : CODE_UNTESTED,
+    'ssL1'                      : CODE_UNTESTED,
+    'ssStructure'               : CODE_UNTESTED,
+    'ssEnergy'                  : CODE_UNTESTED,
+    'bowtieChr'                 : CODE_UNTESTED,
+}
+
+# Maps a status (offset by 3) back to the code written in the output file
+_STATUS_TO_CODE = np.array(
+    [CODE_ERROR, CODE_AMBIGUOUS, CODE_UNTESTED, CODE_REJECTED, CODE_ACCEPTED],
+    dtype=object
+)
+
+def statusToCode(statuses):
+    '''Returns the output codes (object array) for an array of statuses'''
+    return _STATUS_TO_CODE[np.asarray(statuses, dtype=np.int64) + 3]
+
+
+class GuideTable:
+    def __init__(self, size:int):
+        self.size = size
+
+        self.signature = np.zeros(size, dtype=SIGNATURE_DTYPE)
+        self.seq = np.zeros(size, dtype=f'S{SEQ_LENGTH}')
+
+        self.status = {
+            name : np.full(size, default, dtype=np.int8)
+                for name, default in STATUS_COLUMNS.items()
+        }
+
+        self.values = {
+            name : np.zeros(size, dtype=dtype)
+                for name, dtype in VALUE_COLUMNS.items()
+        }
+
+        self.state = {
+            name : np.full(size, STATUS_UNTESTED, dtype=np.int8)
+                for name in VALUE_COLUMNS
+        }
+
+        self.text = {
+            name : np.full(size, default, dtype=object)
+                for name, default in TEXT_COLUMNS.items()
+        }
+
+    @classmethod
+    def fromBatchRows(cls, rows, duplicateGuides):
+        '''
+        Builds a table from rows of [signature, header, start, end, strand].
+        Guides that are in
+        `duplicateGuides` (sorted signatures) are marked as not unique, with an
+        ambiguous position.
+        '''
+        if len(rows) == 0:
+            return cls(0)
+
+        signatures, headers, starts, ends, strands = zip(*rows)
+
+        return cls.fromColumns(
+            np.array(signatures, dtype=np.uint64),
+            headers,
+            np.array(starts, dtype=np.int64),
+            np.array(ends, dtype=np.int64),
+            strands,
+            duplicateGuides
+        )
+
+    @classmethod
+    def fromColumns(cls, signatures, headers, starts, ends, strands, duplicateGuides):
+        '''
+        Builds a table from the columns of a batch, e.g. a batch file mapped
+        by the Batchinator, see `fromBatchRows`
+        '''
+        table = cls(len(signatures))
+
+        if table.size == 0:
+            return table
+
+        table.signature[:] = signatures
+        table.seq[:] = decode_guides(table.signature)
+        table.text['header'][:] = headers
+        table.text['strand'][:] = strands
+        table.setValues('start', slice(None), starts)
+        table.setValues('end', slice(None), ends)
+
+        table.markAmbiguous(np.isin(table.signature, duplicateGuides))
+
+        return table
+
+    def save(self, file):
+        '''Writes every column of the table to `file` (a path or a binary file), see `load`'''
+        arrays = {'signature' : self.signature, 'seq' : self.seq}
+        for prefix, columns in [('status', self.status), ('values', self.values), ('state', self.state), ('text', self.text)]:
+            for name, column in columns.items():
+                arrays[f'{prefix}/{name}'] = column
+        np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, file):
+        '''Reads a table written by `save`'''
+        with np.load(file, allow_pickle=True) as arrays:
+            table = cls(len(arrays['signature']))
+            table.signature[:] = arrays['signature']
+            table.seq[:] = arrays['seq']
+            for prefix, columns in [('status', table.status), ('values', table.values), ('state', table.state), ('text', table.text)]:
+                for name in columns:
+                    columns[name][:] = arrays[f'{prefix}/{name}']
+        return table
+
+    def __len__(self):
+        return self.size
+
+    def take(self, idx):
+        '''Returns a new table holding the guides at `idx`'''
+        table = GuideTable(len(idx))
+        table.signature[:] = self.signature[idx]
+        table.seq[:] = self.seq[idx]
+        for name in self.status:
+            table.status[name][:] = self.status[name][idx]
+        for name in self.values:
+            table.values[name][:] = self.values[name][idx]
+            table.state[name][:] = self.state[name][idx]
+        for name in self.text:
+            table.text[name][:] = self.text[name][idx]
+        return table
+
+    def nbytes(self):
+        '''Approximate memory held by the table, not counting the strings of text columns'''
+        arrays = [self.signature, self.seq]
+        for columns in [self.status, self.values, self.state, self.text]:
+            arrays.extend(columns.values())
+        return sum(array.nbytes for array in arrays)
+
+    def __getitem__(self, name):
+        if name == 'seq':
+            return self.seq
+        if name in self.status:
+            return self.status[name]
+        if name in self.values:
+            return self.values[name]
+        return self.text[name]
+
+    def isValueColumn(self, name):
+        return name in self.values
+
+    def setValues(self, name, idx, values):
+        '''Writes `values` to the guides at `idx` of a value column'''
+        self.values[name][idx] = values
+        self.state[name][idx] = STATUS_VALUE
+
+    def setState(self, name, idx, status):
+        '''Replaces the values of a value column with a code, e.g. STATUS_AMBIGUOUS'''
+        self.state[name][idx] = status
+
+    def hasValue(self, name):
+        '''Boolean mask of the guides that hold a value for a value column'''
+        return self.state[name] == STATUS_VALUE
+
+    def markAmbiguous(self, mask):
+        '''Marks guides as seen multiple times in the input'''
+        self.status['isUnique'][mask] = STATUS_REJECTED
+        self.text['header'][mask] = CODE_AMBIGUOUS
+        self.text['strand'][mask] = CODE_AMBIGUOUS
+        self.setState('start', mask, STATUS_AMBIGUOUS)
+        self.setState('end', mask, STATUS_AMBIGUOUS)
+
+    def sequences(self, idx=None):
+        '''Returns the sequences at `idx` (default: all) as a list of str'''
+        seqs = self.seq if idx is None else self.seq[idx]
+        return seqs.astype(f'U{SEQ_LENGTH}').tolist()
+
+    def seqMatrix(self, idx=None):
+        '''Returns the sequences at `idx` (default: all) as an (n, 23) uint8 matrix'''
+        seqs = self.seq if idx is None else self.seq[idx]
+        return np.ascontiguousarray(seqs).view(np.uint8).reshape(-1, SEQ_LENGTH)
+
+    def column(self, name):
+        '''Renders a column as a list of output values'''
+        if name == 'seq':
+            return self.sequences()
+
+        if name in self.status:
+            return statusToCode(self.status[name]).tolist()
+
+        if name in self.values:
+            rendered = self.values[name].astype(object)
+            noValue = self.state[name] != STATUS_VALUE
+            rendered[noValue] = statusToCode(self.state[name][noValue])
+            return rendered.tolist()
+
+        return self.text[name].tolist()
+
+    def rows(self, order=DEFAULT_GUIDE_PROPERTIES_ORDER):
+        '''Iterates the guides as output rows, with columns ordered by `order`'''
+        return zip(*[self.column(name) for name in order])
@@ -19,11 +19,8 @@ def transToDNA(rna):
 
 # Function that calculates the AT% of a given sequence
 def AT_percentage(seq):
-    total = 0.0
+    total = float(seq.count('A') + seq.count('T'))
     length = float(len(seq))
-    for c in seq:
-        if c in "AT":
-            total += 1
     return 100.0*total/length
 
 
@@ -0,0 +1,354 @@
+'''
+IncrementalRun
+
+- Lets a run reuse the work of the previous run, so that when a few input
+  files change, only the guides they affect are extracted and scored
+- The state is kept in an incremental directory (<output dir>/<name>-incremental):
+    - manifest.json, the SHA-256 of the content of each input file, a hash of
+      the settings that the results depend on (see CONFIG_SECTIONS) and of the
+      files they refer to (the ISSL index, the sgRNAScorer2 model and the
+      Bowtie2 index), and the size of the stored results
+    - guides-<SHA-256>.npz, the guides found in an input file (see
+      `findGuides`), named by the hash of its content so that an unchanged
+      file is not scanned again
+    - guides.txt, the results file of the last completed run, and index.npy,
+      the guide, position and size of each of its rows
+- Duplicates are resolved across every input file, as in a full run. The row
+  of a guide only depends on its sequence, its position, whether it is unique
+  and the settings, so the row of the previous results with the same guide,
+  position and uniqueness is written as is. The other guides, e.g. those of a
+  changed file, or whose uniqueness was changed by another file, go through
+  the stages. The results file is the same as that of a full run.
+- Results are only reused when the settings, and the files they refer to, are
+  the same as those of the previous run
+- The state is replaced once the run completes (`commit`). The results file is
+  linked into the incremental directory, so it can be replaced by the next
+  run without losing the stored results.
+- File hashes are recorded with the size and modification time of the file,
+  and a file is only read again once either changes
+'''
+
+import csv, glob, hashlib, io, json, locale, mmap, os, shutil
+
+import numpy as np
+
+from crackling.Constants import DEFAULT_GUIDE_PROPERTIES_ORDER
+from crackling.FileProcessor.file_processor import find_guides_in_file
+from crackling.FileProcessor.guide_encoding import encode_guides, SIGNATURE_DTYPE
+from crackling.Helpers import printer
+
+MANIFEST_VERSION = 1
+
+# The settings that the row of a guide depends on, by section (None: every
+# key). Keys that only change how the work is done are left out.
+CONFIG_SECTIONS = {
+    'general'           : ['optimisation'],
+    'consensus'         : None,
+    'input'             : ['offtarget-sites', 'bowtie2-index'],
+    'output'            : ['delimiter'],
+    'offtargetscore'    : None,
+    'sgrnascorer2'      : None,
+    'bowtie2'           : None,
+    'rnafold'           : None,
+}
+IGNORED_KEYS = ['threads', 'processes', 'page-length', 'block-size', 'library', 'input', 'output']
+
+# The columns that, with `seq`, identify the row of a guide
+IDENTITY_COLUMNS = ['header', 'start', 'end', 'strand', 'isUnique']
+IDENTITY_FIELDS = [DEFAULT_GUIDE_PROPERTIES_ORDER.index(name) for name in IDENTITY_COLUMNS]
+
+# One row of the stored results
+INDEX_DTYPE = np.dtype([
+    ('signature',   '<u8'),
+    ('identity',    '<u8'),
+    ('offset',      '<u8'),
+    ('length',      '<u4'),
+])
+
+# Rows are indexed this many at a time
+INDEX_CHUNK_SIZE = 1 << 20
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# The encoding of the results file, as written by `open`
+ENCODING = locale.getpreferredencoding(False)
+
+
+def rowIdentities(fields):
+    '''Hashes the identity columns (IDENTITY_COLUMNS) of rows, given as columns of str'''
+    return np.array([
+        int.from_bytes(hashlib.blake2b('\0'.join(row).encode(), digest_size=8).digest(), 'little')
+            for row in zip(*fields)
+    ], dtype=np.uint64)
+
+
+def hashFile(path):
+    '''The SHA-256 of the content of a file'''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ReusedRows:
+    '''The rows of a batch that are reused from the previous results, see `IncrementalRun.reusedRows`'''
+    def __init__(self, mask, rows):
+        # For each guide of the batch, whether its row is reused
+        self.mask = mask
+        # The reused rows (bytes), in batch order
+        self.rows = rows
+
+    def newIdx(self):
+        '''The guides of the batch that go through the stages'''
+        return np.flatnonzero(~self.mask)
+
+
+class IncrementalRun:
+    def __init__(self, stateDir:str, configMngr, pipeline:str):
+        self.stateDir = stateDir
+        self.manifestPath = os.path.join(stateDir, 'manifest.json')
+        self.resultsPath = os.path.join(stateDir, 'guides.txt')
+        self.indexPath = os.path.join(stateDir, 'index.npy')
+
+        os.makedirs(stateDir, exist_ok=True)
+
+        self.manifest = {'version' : MANIFEST_VERSION, 'config' : None, 'resultsSize' : 0, 'hashes' : {}, 'files' : []}
+        if os.path.exists(self.manifestPath):
+            with open(self.manifestPath, 'r') as file:
+                manifest = json.load(file)
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.manifest = manifest
+
+        # path : {size, mtime, sha256}, of every file hashed by this run
+        self.hashes = {}
+
+        printer(f'Hashing the input files and the settings, see: {stateDir}')
+        self.inputHashes = {path : self._hash(path) for path in configMngr.getIterFilesToProcess()}
+        self.configHash = self._configHash(configMngr, pipeline)
+
+        # The results of the previous run, when they can be reused
+        self.index = None
+        self.results = None
+        self.resultsFile = None
+
+        if self.manifest['config'] != self.configHash:
+            if self.manifest['config'] is not None:
+                printer('The settings have changed since the previous run, every guide will be scored.')
+        elif not os.path.exists(self.resultsPath) or os.path.getsize(self.resultsPath) != self.manifest['resultsSize']:
+            printer(f'The results of the previous run are missing or changed, every guide will be scored: {self.resultsPath}')
+        else:
+            self.index = np.load(self.indexPath)
+            self.resultsFile = open(self.resultsPath, 'rb')
+            if len(self.index) > 0:
+                self.results = mmap.mmap(self.resultsFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+            changed = sum(
+                path not in self.manifest['files'] or self.manifest['hashes'].get(path, {}).get('sha256') != sha
+                    for path, sha in self.inputHashes.items()
+            )
+            printer(f'Reusing the {len(self.index):,} results of the previous run. {changed:,} of {len(self.inputHashes):,} input files are new or changed.')
+
+    def _path(self, name):
+        return os.path.join(self.stateDir, name)
+
+    def _hash(self, path):
+        '''The SHA-256 of a file, read again only if its size or modification time changed'''
+        stat = os.stat(path)
+        recorded = self.manifest['hashes'].get(path)
+        if recorded is not None and recorded['size'] == stat.st_size and recorded['mtime'] == stat.st_mtime_ns:
+            self.hashes[path] = recorded
+        else:
+            self.hashes[path] = {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns, 'sha256' : hashFile(path)}
+        return self.hashes[path]['sha256']
+
+    def _configHash(self, configMngr, pipeline):
+        settings = {'pipeline' : pipeline}
+        for section, keys in CONFIG_SECTIONS.items():
+            settings[section] = {
+                key : value for key, value in configMngr[section].items()
+                    if (keys is None or key in keys) and key not in IGNORED_KEYS
+            }
+
+        # The files that the settings refer to
+        files = []
+        if configMngr['offtargetscore'].getboolean('enabled'):
+            files.append(configMngr['input']['offtarget-sites'])
+            files.extend(sorted(glob.glob(f"{configMngr['input']['bowtie2-index']}.*bt2*")))
+        if configMngr['consensus'].getboolean('sgrnascorer2'):
+            files.append(configMngr['sgrnascorer2']['model'])
+        settings['files'] = {path : self._hash(path) for path in files if os.path.isfile(path)}
+
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+    ####################################
+    ###     Extraction                ##
+    ####################################
+    def findGuides(self, path):
+        '''
+        Returns the result of `find_guides_in_file` for an input file. It is
+        read from the incremental directory when the file is unchanged, and
+        recorded there otherwise.
+        '''
+        name = f'guides-{self.inputHashes[path]}.npz'
+
+        if os.path.exists(self._path(name)):
+            printer(f'Reading the possible target sites of an unchanged file: {path}')
+            with np.load(self._path(name)) as arrays:
+                bounds = np.concatenate([[0], np.cumsum(arrays['lengths'])])
+                return [
+                    (
+                        header,
+                        arrays['signatures'][start:end],
+                        arrays['counts'][start:end],
+                        arrays['starts'][start:end],
+                        arrays['strands'][start:end].astype('U1').tolist(),
+                    ) for header, start, end in zip(arrays['headers'].tolist(), bounds[:-1], bounds[1:])
+                ]
+
+        printer(f'Identifying possible target sites in: {path}')
+        results = find_guides_in_file(path)
+
+        with open(self._path(f'{name}.tmp'), 'wb') as file:
+            np.savez(
+                file,
+                headers=np.array([r[0] for r in results], dtype=str),
+                lengths=np.array([len(r[1]) for r in results], dtype=np.int64),
+                signatures=np.concatenate([r[1] for r in results] + [np.zeros(0, dtype=SIGNATURE_DTYPE)]),
+                counts=np.concatenate([r[2] for r in results] + [np.zeros(0, dtype=np.int64)]),
+                starts=np.concatenate([r[3] for r in results] + [np.zeros(0, dtype=np.int64)]),
+                strands=np.array([strand for r in results for strand in r[4]], dtype='S1'),
+            )
+        os.replace(self._path(f'{name}.tmp'), self._path(name))
+
+        return results
+
+    ####################################
+    ###     Results                   ##
+    ####################################
+    def releaseOutput(self, outputFile:str):
+        '''Removes the results file of the previous run, which is kept in the incremental directory'''
+        if os.path.exists(outputFile) and os.path.exists(self.resultsPath) and os.path.samefile(outputFile, self.resultsPath):
+            printer(f'Replacing the results of the previous run: {outputFile}')
+            os.remove(outputFile)
+
+    def reusedRows(self, candidateGuides):
+        '''Finds the guides of a batch (a GuideTable) whose rows can be reused from the previous results'''
+        mask = np.zeros(len(candidateGuides), dtype=bool)
+        if self.results is None or len(candidateGuides) == 0:
+            return ReusedRows(mask, [])
+
+        pos = np.minimum(np.searchsorted(self.index['signature'], candidateGuides.signature), len(self.index) - 1)
+        found = np.flatnonzero(self.index['signature'][pos] == candidateGuides.signature)
+
+        identities = rowIdentities([
+            [str(value) for value in np.array(candidateGuides.column(name), dtype=object)[found]]
+                for name in IDENTITY_COLUMNS
+        ])
+        found = found[self.index['identity'][pos[found]] == identities]
+
+        mask[found] = True
+        rows = [
+            self.results[offset:offset + length]
+                for offset, length in zip(self.index['offset'][pos[found]].tolist(), self.index['length'][pos[found]].tolist())
+        ]
+
+        printer(f'\t{len(found):,} of {len(candidateGuides):,} guides are unchanged since the previous run, their results are reused.')
+
+        return ReusedRows(mask, rows)
+
+    def writeRows(self, fOpen, csvWriter, rows, reused:ReusedRows):
+        '''
+        Writes the rows of a batch, in batch order: the reused rows, and `rows`
+        (those of the guides that went through the stages)
+        '''
+        # Alternate between runs of new and of reused rows
+        bounds = np.flatnonzero(np.diff(reused.mask.astype(np.int8))) + 1
+        reusedRow = 0
+        for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(reused.mask)]])):
+            count = int(end - start)
+            if reused.mask[start]:
+                fOpen.write(b''.join(reused.rows[reusedRow:reusedRow + count]).decode(ENCODING))
+                reusedRow += count
+            else:
+                csvWriter.writerows(row for _, row in zip(range(count), rows))
+
+    def _indexResults(self, outputFile:str, delimiter:str):
+        '''Indexes the rows of a results file, see INDEX_DTYPE'''
+        chunks = []
+        with open(outputFile, 'rb') as file:
+            offset = len(file.readline())
+
+            while True:
+                lines = [line for _, line in zip(range(INDEX_CHUNK_SIZE), file)]
+                if len(lines) == 0:
+                    break
+
+                fields = list(zip(*csv.reader(
+                    io.StringIO(b''.join(lines).decode(ENCODING)),
+                    delimiter=delimiter, quotechar='"', dialect='unix'
+                )))
+
+                lengths = np.array([len(line) for line in lines], dtype=np.uint64)
+
+                chunk = np.zeros(len(lines), dtype=INDEX_DTYPE)
+                chunk['signature'] = encode_guides(fields[0])
+                chunk['identity'] = rowIdentities([fields[field] for field in IDENTITY_FIELDS])
+                chunk['offset'] = offset + np.cumsum(lengths) - lengths
+                chunk['length'] = lengths
+                chunks.append(chunk)
+
+                offset += int(lengths.sum())
+
+        index = np.concatenate(chunks + [np.zeros(0, dtype=INDEX_DTYPE)])
+        return index[np.argsort(index['signature'], kind='stable')]
+
+    def commit(self, outputFile:str, delimiter:str):
+        '''Records the results file of the completed run, and the input files it was made from'''
+        printer(f'Recording the results for the next run in: {self.stateDir}')
+
+        index = self._indexResults(outputFile, delimiter)
+
+        self.close()
+
+        # The manifest is removed first, so that an interrupted commit leaves
+        # no results to reuse (rather than mismatched ones)
+        if os.path.exists(self.manifestPath):
+            os.remove(self.manifestPath)
+
+        with open(self._path('index.npy.tmp'), 'wb') as file:
+            np.save(file, index)
+        os.replace(self._path('index.npy.tmp'), self.indexPath)
+
+        if os.path.exists(self._path('guides.txt.tmp')):
+            os.remove(self._path('guides.txt.tmp'))
+        try:
+            os.link(outputFile, self._path('guides.txt.tmp'))
+        except OSError:
+            shutil.copyfile(outputFile, self._path('guides.txt.tmp'))
+        os.replace(self._path('guides.txt.tmp'), self.resultsPath)
+
+        self.manifest = {
+            'version'       : MANIFEST_VERSION,
+            'config'        : self.configHash,
+            'resultsSize'   : os.path.getsize(self.resultsPath),
+            'hashes'        : self.hashes,
+            'files'         : list(self.inputHashes),
+        }
+        with open(f'{self.manifestPath}.tmp', 'w') as file:
+            json.dump(self.manifest, file, indent=1)
+        os.replace(f'{self.manifestPath}.tmp', self.manifestPath)
+
+        # Forget the guides of files that are no longer input
+        keep = {f'guides-{sha}.npz' for sha in self.inputHashes.values()}
+        for path in glob.glob(self._path('guides-*.npz')):
+            if os.path.basename(path) not in keep:
+                os.remove(path)
+
+    def close(self):
+        if self.results is not None:
+            self.results.close()
+            self.results = None
+        if self.resultsFile is not None:
+            self.resultsFile.close()
+            self.resultsFile = None
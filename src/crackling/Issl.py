@@ -0,0 +1,133 @@
+'''
+Issl
+
+- In-process off-target scoring through the ISSL shared library (`libissl.so`,
+  see the Makefile), using ctypes
+- `load_index(path, library)` loads an ISSL index once and returns an IsslIndex
+- `IsslIndex.score(signatures, method, threshold, max_dist, block_size)`
+  returns the MIT and CFD scores of each query as two NumPy arrays. With a
+  block size, queries are scored in blocks which share slice list scans (see
+  `scoreQueriesBlocked`), with the same scores.
+- Queries are binary encoded 20-mers (A=0, C=1, G=2, T=3, first base in the
+  least-significant bits), i.e. the lower 40 bits of a guide signature (see
+  FileProcessor.guide_encoding). The query and score arrays are passed to the
+  library by pointer, without being copied.
+- Scores which the method does not need are -1, and scores are rounded to 6
+  decimals, as isslScoreOfftargets prints them (`%f`). Both give the same
+  results file, and the same pass or fail at the score threshold.
+'''
+
+import ctypes
+
+import numpy as np
+
+from crackling.FileProcessor.guide_encoding import SIGNATURE_DTYPE
+
+SCORE_METHODS = ['and', 'or', 'avg', 'mit', 'cfd']
+
+# library path : ctypes library
+_libraries = {}
+
+
+def roundScores(scores):
+    '''Rounds scores to 6 decimals, as printf's `%f` does'''
+    rounded = np.round(scores, 6)
+
+    # np.round scales the scores by 10^6 first, which can round a score that
+    # is (nearly) halfway between two decimals the other way
+    scaled = scores * 1e6
+    halfway = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-3)
+    rounded[halfway] = [float(f'{score:.6f}') for score in scores[halfway].tolist()]
+
+    return rounded
+
+
+def loadLibrary(library):
+    '''Returns the ISSL library at `library`, loading it only the first time'''
+    if library not in _libraries:
+        lib = ctypes.CDLL(library)
+
+        lib.issl_load_index.argtypes = [ctypes.c_char_p]
+        lib.issl_load_index.restype = ctypes.c_void_p
+
+        lib.issl_seq_length.argtypes = [ctypes.c_void_p]
+        lib.issl_seq_length.restype = ctypes.c_size_t
+
+        lib.issl_free_index.argtypes = [ctypes.c_void_p]
+        lib.issl_free_index.restype = None
+
+        lib.issl_score_blocked.argtypes = [
+            ctypes.c_void_p,
+            np.ctypeslib.ndpointer(dtype=SIGNATURE_DTYPE, flags='C_CONTIGUOUS'),
+            ctypes.c_size_t,
+            ctypes.c_char_p,
+            ctypes.c_double,
+            ctypes.c_int,
+            np.ctypeslib.ndpointer(dtype=np.float64, flags='C_CONTIGUOUS,WRITEABLE'),
+            np.ctypeslib.ndpointer(dtype=np.float64, flags='C_CONTIGUOUS,WRITEABLE'),
+            ctypes.c_size_t,
+        ]
+        lib.issl_score_blocked.restype = ctypes.c_int
+
+        _libraries[library] = lib
+    return _libraries[library]
+
+
+class IsslIndex:
+    def __init__(self, lib, handle, path):
+        self.lib = lib
+        self.handle = handle
+        self.path = path
+        self.seqLength = lib.issl_seq_length(handle)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def score(self, signatures, method, threshold, max_dist, block_size=0):
+        '''Returns (mit, cfd), the scores of each binary encoded query, see roundScores'''
+        if self.handle is None:
+            raise ValueError(f'The ISSL index has been closed: {self.path}')
+
+        method = str(method).strip().lower()
+        if method not in SCORE_METHODS:
+            raise ValueError(f'Unknown off-target scoring method: {method}')
+
+        signatures = np.ascontiguousarray(signatures, dtype=SIGNATURE_DTYPE)
+
+        mit = np.full(len(signatures), -1.0, dtype=np.float64)
+        cfd = np.full(len(signatures), -1.0, dtype=np.float64)
+
+        if len(signatures) > 0:
+            returnCode = self.lib.issl_score_blocked(
+                self.handle, signatures, len(signatures), method.encode(),
+                float(threshold), int(max_dist), mit, cfd, int(block_size)
+            )
+            if returnCode != 0:
+                raise RuntimeError(f'ISSL scoring failed ({returnCode}): {self.path}')
+
+        return roundScores(mit), roundScores(cfd)
+
+    def close(self):
+        if self.handle is not None:
+            self.lib.issl_free_index(self.handle)
+            self.handle = None
+
+
+def load_index(path, library):
+    '''Loads the ISSL index at `path` with the library at `library`'''
+    lib = loadLibrary(library)
+
+    handle = lib.issl_load_index(str(path).encode())
+    if not handle:
+        raise IOError(f'Could not load the ISSL index: {path}')
+
+    return IsslIndex(lib, handle, path)
+
+
+def targetSignatures(signatures, length=20):
+    '''Returns the signatures of the first `length` bases of guide signatures'''
+    mask = SIGNATURE_DTYPE((1 << (2 * length)) - 1)
+    return np.asarray(signatures, dtype=SIGNATURE_DTYPE) & mask
@@ -0,0 +1,68 @@
+'''
+IsslServer
+
+- Runs `isslScoreOfftargets` in server mode (query file `-`), so that the ISSL
+  index is loaded once and reused for every page of every batch
+- Queries are sent over stdin as a batch: a line with the number of queries,
+  then one query per line
+- The scores of a batch are read from stdout, one line per query in the same
+  format as when scoring a query file: <query>\t<MIT>\t<CFD>
+- The server is stopped by `close()`, which closes stdin
+- With a block size, the queries of a batch are scored in blocks which share
+  slice list scans (see isslScoreOfftargets)
+'''
+
+import subprocess
+
+from crackling.Helpers import printer
+
+
+class IsslServer:
+    def __init__(self, binary:str, index:str, maxDistance, scoreThreshold, scoreMethod:str, blockSize=0):
+        self.args = [binary, index, '-', str(maxDistance), str(scoreThreshold), str(scoreMethod), str(blockSize)]
+
+        printer(f'| Starting ISSL server: {self.args}')
+        self.process = subprocess.Popen(
+            self.args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def score(self, targets:list):
+        '''Returns (MIT, CFD) for each target, as a list in the order of `targets`'''
+        if len(targets) == 0:
+            return []
+
+        # The whole batch is read by the server before it writes any scores
+        self.process.stdin.write(f'{len(targets)}\n')
+        self.process.stdin.write(''.join(f'{target}\n' for target in targets))
+        self.process.stdin.flush()
+
+        scores = []
+        for target in targets:
+            line = self.process.stdout.readline()
+            if not line:
+                raise RuntimeError(f'The ISSL server stopped unexpectedly: {self.args}')
+
+            scored = line.rstrip('\n').split('\t')
+            if len(scored) != 3 or scored[0] != target:
+                raise RuntimeError(f'Unexpected output from the ISSL server: {line!r}')
+
+            scores.append((float(scored[1]), float(scored[2])))
+
+        return scores
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process.stdout.close()
+            printer('| ISSL server stopped')
+            self.process = None
@@ -2,9 +2,9 @@ import sys
 
 ## This class displays, and writes to file, every `print` command    
 class Logger(object):
-    def __init__(self, outputFile):
+    def __init__(self, outputFile, mode="w+"):
         self.terminal = sys.stdout
-        self.log = open(outputFile, "w+")
+        self.log = open(outputFile, mode)
 
     def __del__(self):
         self.log.close()
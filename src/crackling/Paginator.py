@@ -6,11 +6,15 @@ Author: Jake Bradford
 - Useful for partitioning iterators containing many items
 - Can be used on any object that it is iterable
 - Page length and start page can be specified
+- NumPy arrays (e.g. of guide indices) are paged by slicing, so each page is
+  an array
 
 With thanks to RobertB (8 September 2017) for the inspiration:
     https://stackoverflow.com/a/46107096
 '''
 
+import numpy as np
+
 #import random
 #import string
 #random.seed(20210209)
@@ -28,6 +32,12 @@ class Paginator:
         
         if self.page_len == 0:
             yield 1, self.iterable
+        elif isinstance(self.iterable, np.ndarray):
+            for start in range(self.desired_page * self.page_len, len(self.iterable), self.page_len):
+                self.current_page = start // self.page_len
+                self.current_item = min(start + self.page_len, len(self.iterable))
+                yield self.current_page, self.iterable[start:start + self.page_len]
+                self.current_page += 1
         else:
             for i in self.iterable:
                 self.current_item += 1
@@ -0,0 +1,101 @@
+'''
+RnaFoldPool
+
+- Runs a pool of `RNAfold --noPS` processes which read sequences from stdin and
+  write their structures to stdout, so that no input or output file is written
+- The processes are started once and reused by every page of every batch
+- `fold(sequences)` splits the sequences into chunks, which are sent to the
+  processes in turn by one writer thread per process
+- RNAfold writes two lines per sequence, in the order it read them: the
+  sequence (as RNA) and `<structure> (<energy>)`. The records are read back
+  chunk by chunk and yielded as (L1, L2) pairs in the order of `sequences`,
+  while the remaining chunks are still being folded.
+- `fold` must be consumed entirely before it is called again
+- The processes are stopped by `close()`, which closes their stdin
+'''
+
+import subprocess, threading
+
+from crackling.Helpers import printer
+
+# How many sequences to send to a process at a time. Smaller chunks return the
+# first records sooner, larger chunks cost fewer writes and thread switches.
+# Default: 10000
+RNAFOLD_CHUNK_SIZE = 10000
+
+
+class RnaFoldPool:
+    def __init__(self, binary:str, processes:int=1, threads:int=1, chunkSize:int=RNAFOLD_CHUNK_SIZE):
+        self.args = [binary, '--noPS', f'-j{max(1, int(threads))}']
+        self.chunkSize = max(1, int(chunkSize))
+
+        printer(f'| Starting {processes} RNAfold process(es): {self.args}')
+        self.processes = [
+            subprocess.Popen(
+                self.args,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                universal_newlines=True,
+            ) for _ in range(max(1, int(processes)))
+        ]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _feed(self, process, chunks, errors):
+        '''Writes `chunks` (lists of sequences) to the stdin of `process`'''
+        try:
+            for chunk in chunks:
+                process.stdin.write(''.join(f'{sequence}\n' for sequence in chunk))
+                process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            # The process has stopped, which the reader will find out
+            errors.append(e)
+
+    def fold(self, sequences):
+        '''Yields (L1, L2), the RNAfold output of each sequence, in order'''
+        sequences = list(sequences)
+
+        chunks = [
+            sequences[start:start + self.chunkSize]
+                for start in range(0, len(sequences), self.chunkSize)
+        ]
+
+        # Chunk i is folded by process i % len(self.processes)
+        errors = []
+        feeders = [
+            threading.Thread(
+                target=self._feed,
+                args=(process, chunks[processIdx::len(self.processes)], errors),
+                daemon=True,
+            ) for processIdx, process in enumerate(self.processes)
+        ]
+        for feeder in feeders:
+            feeder.start()
+
+        for chunkIdx, chunk in enumerate(chunks):
+            process = self.processes[chunkIdx % len(self.processes)]
+
+            for _ in chunk:
+                L1 = process.stdout.readline()
+                L2 = process.stdout.readline()
+                if not L2:
+                    raise RuntimeError(f'RNAfold stopped unexpectedly: {self.args} {errors}')
+
+                yield L1.rstrip(), L2.rstrip()
+
+        for feeder in feeders:
+            feeder.join()
+
+    def close(self):
+        if self.processes is not None:
+            for process in self.processes:
+                process.stdin.close()
+            for process in self.processes:
+                process.wait()
+                process.stdout.close()
+            printer('| RNAfold stopped')
+            self.processes = None
@@ -0,0 +1,196 @@
+'''
+RunCheckpoint
+
+- Records the progress of a run in a run directory, so that an interrupted run
+  can be resumed (`Crackling -c <config> --resume`)
+- The run directory holds:
+    - manifest.json, the progress of the run
+    - extraction/, where the guides are extracted to (see Batchinator and
+      GuidePartitioner). Once extraction is complete, the source of each
+      batch (a batch file or a spill file), the sequence headers and the
+      duplicate guides are moved to the run directory.
+    - batch-<id>.npz, the guide table of a batch after its last completed
+      stage (see GuideTable.save)
+- Files are written under a temporary name, synced and renamed into place.
+  The manifest is rewritten, in the same way, after the files it refers to, so
+  a crash at any point leaves the last recorded state intact.
+- The output file is appended to batch by batch. Its size is recorded after
+  each batch, and when resuming it is truncated to that size, so partially
+  written rows are discarded and the output is the same as that of an
+  uninterrupted run.
+- Stages record their completion from the threads of the StagePipeline, so the
+  manifest is updated under a lock
+'''
+
+import json, os, shutil, threading
+
+import numpy as np
+
+from crackling.GuideTable import GuideTable
+from crackling.Helpers import printer
+
+MANIFEST_VERSION = 1
+
+
+def _sync(path):
+    with open(path, 'rb+') as file:
+        os.fsync(file.fileno())
+
+
+class RunCheckpoint:
+    def __init__(self, runDir:str, resume:bool=False):
+        self.runDir = runDir
+        self.manifestPath = os.path.join(runDir, 'manifest.json')
+        self.lock = threading.Lock()
+
+        os.makedirs(runDir, exist_ok=True)
+
+        self.manifest = None
+        if resume and os.path.exists(self.manifestPath):
+            with open(self.manifestPath, 'r') as file:
+                self.manifest = json.load(file)
+
+            if self.manifest.get('version') != MANIFEST_VERSION:
+                raise ValueError(f'Cannot resume from a version {self.manifest.get("version")} run directory: {runDir}')
+
+            printer(f'Resuming the run recorded in: {runDir}')
+        else:
+            if resume:
+                printer(f'There is no run to resume in {runDir}, starting a new run.')
+
+            self.manifest = {
+                'version'       : MANIFEST_VERSION,
+                'extraction'    : None,
+                'outputSize'    : 0,
+                'batches'       : {},
+            }
+            self._saveManifest()
+
+    def _path(self, name):
+        return os.path.join(self.runDir, name)
+
+    def _saveManifest(self):
+        temp = f'{self.manifestPath}.tmp'
+        with open(temp, 'w') as file:
+            json.dump(self.manifest, file, indent=1)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp, self.manifestPath)
+
+    def _batch(self, batchFileId):
+        return self.manifest['batches'].setdefault(str(batchFileId), {'stages' : [], 'output' : False})
+
+    ####################################
+    ###     Extraction                ##
+    ####################################
+    def isExtracted(self):
+        return self.manifest['extraction'] is not None
+
+    def extractionDir(self):
+        '''Returns an empty directory to extract into, removing what an interrupted extraction left'''
+        path = self._path('extraction')
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        return path
+
+    def saveExtraction(self, mode:str, sources:list, headers:list, duplicateGuides):
+        '''
+        Moves the source of each batch into the run directory and records that
+        extraction is complete. Returns the new paths of the sources.
+        '''
+        names = []
+        for batchFileId, source in enumerate(sources):
+            name = f'source-{batchFileId}.bin'
+            _sync(source)
+            os.replace(source, self._path(name))
+            names.append(name)
+
+        for name, array in [
+            ('headers.npy', np.array(headers, dtype=object)),
+            ('duplicates.npy', np.asarray(duplicateGuides)),
+        ]:
+            with open(self._path(f'{name}.tmp'), 'wb') as file:
+                np.save(file, array, allow_pickle=True)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(self._path(f'{name}.tmp'), self._path(name))
+
+        with self.lock:
+            self.manifest['extraction'] = {'mode' : mode, 'sources' : names}
+            self._saveManifest()
+
+        shutil.rmtree(self._path('extraction'), ignore_errors=True)
+
+        return self.sources()
+
+    def extractionMode(self):
+        return self.manifest['extraction']['mode']
+
+    def sources(self):
+        return [self._path(name) for name in self.manifest['extraction']['sources']]
+
+    def headers(self):
+        return np.load(self._path('headers.npy'), allow_pickle=True).tolist()
+
+    def duplicateGuides(self):
+        return np.load(self._path('duplicates.npy'))
+
+    ####################################
+    ###     Batches                   ##
+    ####################################
+    def isOutput(self, batchFileId):
+        with self.lock:
+            return self._batch(batchFileId)['output']
+
+    def completedStages(self, batchFileId):
+        with self.lock:
+            return list(self._batch(batchFileId)['stages'])
+
+    def loadBatch(self, batchFileId):
+        '''Returns the guide table of a batch after its last completed stage, or None'''
+        if len(self.completedStages(batchFileId)) == 0:
+            return None
+        return GuideTable.load(self._path(f'batch-{batchFileId}.npz'))
+
+    def saveStage(self, batchFileId, stage:str, candidateGuides):
+        '''Records that a stage of a batch is complete, with the guide table it left'''
+        name = f'batch-{batchFileId}.npz'
+        with open(self._path(f'{name}.tmp'), 'wb') as file:
+            candidateGuides.save(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(self._path(f'{name}.tmp'), self._path(name))
+
+        with self.lock:
+            self._batch(batchFileId)['stages'].append(stage)
+            self._saveManifest()
+
+    ####################################
+    ###     Output                    ##
+    ####################################
+    def outputSize(self):
+        return self.manifest['outputSize']
+
+    def truncateOutput(self, outputFile:str):
+        '''Discards what was written to the output file after the last recorded batch'''
+        if os.path.exists(outputFile) and os.path.getsize(outputFile) > self.outputSize():
+            printer(f'Discarding {os.path.getsize(outputFile) - self.outputSize():,} bytes written to the output file after the last completed batch.')
+            os.truncate(outputFile, self.outputSize())
+
+    def saveOutput(self, outputFile:str, batchFileId=None, source:str=None):
+        '''
+        Records the size of the output file, once the header, or a batch, has
+        been written to it. The files of the batch are then removed.
+        '''
+        _sync(outputFile)
+
+        with self.lock:
+            self.manifest['outputSize'] = os.path.getsize(outputFile)
+            if batchFileId is not None:
+                self._batch(batchFileId)['output'] = True
+            self._saveManifest()
+
+        if batchFileId is not None:
+            for path in [self._path(f'batch-{batchFileId}.npz'), source]:
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,79 @@
+'''
+SgRNAScorer2
+
+- Batch scoring of guides with the sgRNAScorer 2.0 model
+- The model is loaded once per process and cached by its path
+- A batch is one-hot encoded into an (n, 80) matrix, then scored with a single
+  `decision_function` call. This gives the same values as scoring one guide at
+  a time.
+- Guides can be given as a list of str or an (n, >=20) uint8 character matrix,
+  as returned by GuideTable.seqMatrix(..)
+'''
+
+import joblib
+import numpy as np
+
+from crackling.Constants import *
+
+SPACER_LENGTH = 20
+
+# binary encoding
+ENCODING = {
+    'A' : '0001',    'C' : '0010',    'T' : '0100',    'G' : '1000',
+    'K' : '1100',    'M' : '0011',    'R' : '1001',    'Y' : '0110',
+    'S' : '1010',    'W' : '0101',    'B' : '1110',    'V' : '1011',
+    'H' : '0111',    'D' : '1101',    'N' : '1111'
+}
+
+# Character (as uint8) to encoding lookup. Upper and lower case are accepted.
+_ENCODING_LOOKUP = np.zeros((256, 4), dtype=np.float64)
+_ENCODING_KNOWN = np.zeros(256, dtype=bool)
+for base, bits in ENCODING.items():
+    for c in (base, base.lower()):
+        _ENCODING_LOOKUP[ord(c)] = [int(b) for b in bits]
+        _ENCODING_KNOWN[ord(c)] = True
+
+# model path : model
+_models = {}
+
+
+def loadModel(modelPath):
+    '''Returns the model at `modelPath`, loading it only the first time'''
+    if modelPath not in _models:
+        _models[modelPath] = joblib.load(modelPath)
+    return _models[modelPath]
+
+
+def encodeGuides(guides):
+    '''One-hot encodes the first 20 bases of each guide into an (n, 80) matrix'''
+    if isinstance(guides, np.ndarray):
+        matrix = guides[:, 0:SPACER_LENGTH]
+    elif len(guides) == 0:
+        matrix = np.zeros((0, SPACER_LENGTH), dtype=np.uint8)
+    else:
+        matrix = np.frombuffer(
+            ''.join(guide[0:SPACER_LENGTH] for guide in guides).encode('ascii'),
+            dtype=np.uint8
+        ).reshape(-1, SPACER_LENGTH)
+
+    if not _ENCODING_KNOWN[matrix].all():
+        raise ValueError('sgRNAScorer2: guides contain characters which cannot be encoded')
+
+    return _ENCODING_LOOKUP[matrix].reshape(len(matrix), SPACER_LENGTH * 4)
+
+
+def scoreGuides(guides, modelPath):
+    '''Returns the sgRNAScorer 2.0 decision value of every guide'''
+    clfLinear = loadModel(modelPath)
+
+    entries = encodeGuides(guides)
+
+    if len(entries) == 0:
+        return np.zeros(0, dtype=np.float64)
+
+    return np.asarray(clfLinear.decision_function(entries), dtype=np.float64)
+
+
+def acceptGuides(scores, scoreThreshold):
+    '''Returns STATUS_ACCEPTED for scores at or above the threshold, else STATUS_REJECTED'''
+    return np.where(np.asarray(scores) < float(scoreThreshold), STATUS_REJECTED, STATUS_ACCEPTED).astype(np.int8)
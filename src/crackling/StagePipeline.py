@@ -0,0 +1,147 @@
+'''
+StagePipeline
+
+- Runs batches through a chain of stages (e.g. efficiency filters, RNAfold,
+  Bowtie2, off-target scoring, output) so that different batches are in
+  different stages at the same time
+- `run(batches)` reads the batches in the calling thread and sends them to the
+  first stage. Each stage runs in its own thread and handles one batch at a
+  time, in the order the batches arrive, so they leave the last stage in order.
+- Stages are connected by bounded queues, limited to a number of batches and,
+  optionally, to a number of bytes (as measured by `sizeOf(batch)`). A batch
+  larger than the byte limit is still let into an empty queue. At most one
+  batch per stage, plus those in the queues, is held at a time.
+- Threads suffice because the stages wait on external processes (RNAfold,
+  Bowtie2), the worker pool or the ISSL library, which do not hold the GIL
+- If a stage fails, the other stages are stopped and `run` raises its error
+'''
+
+import collections, threading, time
+
+from crackling.Helpers import printer
+
+
+class PipelineStopped(Exception):
+    '''Raised in the stages, and the reader, once another stage has failed'''
+
+
+class BoundedQueue:
+    def __init__(self, maxItems:int=1, maxBytes:int=0):
+        self.maxItems = max(1, int(maxItems))
+        self.maxBytes = max(0, int(maxBytes))
+        self.items = collections.deque()
+        self.bytes = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+
+    def _isFull(self, size):
+        if len(self.items) == 0:
+            return False
+        if len(self.items) >= self.maxItems:
+            return True
+        return self.maxBytes > 0 and self.bytes + size > self.maxBytes
+
+    def put(self, item, size:int=0):
+        '''Adds `item`, waiting while the queue is full'''
+        with self.condition:
+            while not self.stopped and self._isFull(size):
+                self.condition.wait()
+            if self.stopped:
+                raise PipelineStopped()
+
+            self.items.append((item, size))
+            self.bytes += size
+            self.condition.notify_all()
+
+    def get(self):
+        '''Removes and returns the oldest item, waiting while the queue is empty'''
+        with self.condition:
+            while not self.stopped and len(self.items) == 0:
+                self.condition.wait()
+            if self.stopped:
+                raise PipelineStopped()
+
+            item, size = self.items.popleft()
+            self.bytes -= size
+            self.condition.notify_all()
+            return item
+
+    def stop(self):
+        '''Wakes, and fails, every current and later `put` and `get`'''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+# Sent after the last batch
+_END = object()
+
+
+class StagePipeline:
+    def __init__(self, stages:list, maxItems:int=1, maxBytes:int=0, sizeOf=None):
+        '''`stages` is a list of (name, func), `func(batch)` updates a batch in place'''
+        self.stages = stages
+        self.sizeOf = sizeOf or (lambda batch: 0)
+        self.queues = [BoundedQueue(maxItems, maxBytes) for _ in stages]
+        self.error = None
+        self.busySec = {name : 0.0 for name, _ in stages}
+
+    def _stop(self, error):
+        if self.error is None:
+            self.error = error
+        for queue in self.queues:
+            queue.stop()
+
+    def _runStage(self, stageIdx):
+        name, func = self.stages[stageIdx]
+        inQueue = self.queues[stageIdx]
+        outQueue = self.queues[stageIdx + 1] if stageIdx + 1 < len(self.queues) else None
+
+        try:
+            batchIdx = 0
+            while True:
+                batch = inQueue.get()
+                if batch is not _END:
+                    printer(f'| Stage {name}: starting batch {(batchIdx+1):,}')
+                    stageStart = time.time()
+                    func(batch)
+                    self.busySec[name] += time.time() - stageStart
+                    batchIdx += 1
+
+                if outQueue is not None:
+                    outQueue.put(batch, 0 if batch is _END else self.sizeOf(batch))
+
+                if batch is _END:
+                    return
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            # e.g. SystemExit, from a stage calling quit()
+            self._stop(e)
+
+    def run(self, batches):
+        '''Sends every batch through every stage, then returns once the last stage is done'''
+        threads = [
+            threading.Thread(target=self._runStage, args=(stageIdx,), name=f'stage-{name}', daemon=True)
+                for stageIdx, (name, _) in enumerate(self.stages)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for batch in batches:
+                self.queues[0].put(batch, self.sizeOf(batch))
+            self.queues[0].put(_END)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self._stop(e)
+
+        for thread in threads:
+            thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+        for name, busySec in self.busySec.items():
+            printer(f'| Stage {name} was busy for {busySec:.2f} seconds')
@@ -0,0 +1,119 @@
+'''
+WorkerPool
+
+- A long-lived process pool, created once and reused by every batch
+- `map(func, data, *args)` copies `data` (a NumPy array) into shared memory
+  once, then splits it into contiguous chunks along the first axis
+- Each worker attaches to the shared memory, calls `func(chunk, *args)` on a
+  view of its chunk and returns the result for the whole chunk
+- Results are concatenated in chunk order. If `func` returns a tuple of arrays,
+  a tuple of concatenated arrays is returned.
+- `func` must be defined at module level so that it can be sent to the workers
+'''
+
+import multiprocessing as mp
+import sys
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+# How many chunks to create per process. More chunks balance the load better
+# when some chunks are slower than others.
+# Default: 4
+CHUNKS_PER_PROCESS = 4
+
+
+def _attach(shmName):
+    # The shared memory belongs to the parent, which unlinks it once the map is
+    # done, so the worker must not track it: a resource tracker of its own would
+    # unlink it again (and warn) when the worker exits, and a tracker shared
+    # with the parent would have it unregistered twice.
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=shmName, track=False)
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=shmName)
+    finally:
+        resource_tracker.register = register
+
+
+def _runChunk(func, shmName, shape, dtype, start, end, args):
+    shm = _attach(shmName)
+    try:
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        chunk = data[start:end]
+        result = func(chunk, *args)
+
+        # Results must not refer to the shared memory once it is closed
+        if isinstance(result, tuple):
+            result = tuple(_detach(r, data) for r in result)
+        else:
+            result = _detach(result, data)
+
+        del data, chunk
+        return result
+    finally:
+        shm.close()
+
+
+def _detach(result, data):
+    result = np.asarray(result)
+    if np.shares_memory(result, data):
+        result = result.copy()
+    return result
+
+
+def _concatenate(results):
+    if len(results) > 0 and isinstance(results[0], tuple):
+        return tuple(np.concatenate(r) for r in zip(*results))
+    return np.concatenate(results)
+
+
+class WorkerPool:
+    def __init__(self, processes:int=None, chunksPerProcess:int=CHUNKS_PER_PROCESS):
+        self.processes = processes or mp.cpu_count()
+        self.chunksPerProcess = chunksPerProcess
+        self.pool = mp.Pool(self.processes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunkBounds(self, length:int):
+        '''Returns the [start, end) bounds of the contiguous chunks of `length` items'''
+        chunkCount = max(1, min(length, self.processes * self.chunksPerProcess))
+        bounds = np.linspace(0, length, chunkCount + 1).astype(np.int64)
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    def map(self, func, data, *args):
+        '''Applies `func(chunk, *args)` to contiguous chunks of `data` in the workers'''
+        data = np.ascontiguousarray(data)
+
+        if len(data) == 0:
+            return func(data, *args)
+
+        shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        try:
+            shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            shared[:] = data
+            del shared
+
+            results = self.pool.starmap(_runChunk, [
+                (func, shm.name, data.shape, data.dtype.str, start, end, args)
+                    for start, end in self.chunkBounds(len(data))
+            ])
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return _concatenate(results)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -8,10 +8,11 @@ import argparse
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='The config file for Crackling', default=None, required=True)
+    parser.add_argument('--resume', help='Resume an interrupted run, from its checkpoints', action='store_true', default=False)
 
     args = parser.parse_args()
 
-    cm = ConfigManager(Path(args.config), lambda x : print(f'configMngr says: {x}'))
+    cm = ConfigManager(Path(args.config), lambda x : print(f'configMngr says: {x}'), args.resume)
     if not cm.isConfigured():
         print('Something went wrong with reading the configuration.')
         exit()
@@ -0,0 +1,160 @@
+'''
+Faster and better CRISPR guide RNA design with the Crackling method.
+Jacob Bradford, Timothy Chappell, Dimitri Perrin
+bioRxiv 2020.02.14.950261; doi: https://doi.org/10.1101/2020.02.14.950261
+
+
+Purpose:    build the ISSL index of a genome in one command
+
+Input:      FASTA, or multi-FASTA, formatted files (or a directory of them),
+            which may be gzip compressed
+
+Output:     the ISSL index and, optionally, the sorted off-target sites as
+            text (as written by extractOfftargets)
+
+The stages overlap, and no text file of every site is written:
+
+    - extraction: the off-target sites of each region of the records (see
+      extractOfftargets) are extracted, encoded and sorted into runs, in
+      parallel
+    - merging: the runs are merged, level by level (see extractOfftargets)
+    - indexing: the final runs are merged by ranges of sites, in parallel,
+      into distinct binary sites with their occurrences, which are streamed
+      to isslCreateIndex as each range completes
+
+To use:     buildIsslIndex -o <index> [-w <slice width>] <input-files>... | <input-dir>
+'''
+
+import argparse, glob, multiprocessing, os, subprocess, tempfile, time
+
+from crackling.Helpers import printer
+from crackling.utils.extractOfftargets import (
+    ISSL_SITES_MAGIC, ISSL_SITE_DTYPE, OFFTARGET_LENGTH, PROCESSES_COUNT,
+    SORT_COMPRESS_RUNS, appendPart, extractRuns, keyRanges, mergeRuns,
+    outputNodeArgs, printThroughput
+)
+
+def buildIsslIndex(fpInputs, fpOutput, sliceWidth, binary, mpPool, fpOfftargets = None, memoryBudget = None, compress = SORT_COMPRESS_RUNS):
+    if len(fpInputs) == 1 and os.path.isdir(fpInputs[0]):
+        fpInputs = glob.glob(
+            os.path.join(
+                fpInputs[0],
+                '*'
+            )
+        )
+
+    sortedTempDir = tempfile.TemporaryDirectory()
+    printer(f'Created a temporary directory for intermediate files: {sortedTempDir.name}')
+
+    ####################################
+    ###   Extraction                 ###
+    ####################################
+    stageStart = time.time()
+
+    runs, bases = extractRuns(fpInputs, sortedTempDir.name, mpPool, compress)
+
+    printThroughput('Extraction', bases, 'bases', time.time() - stageStart)
+    printer(f'Extracted {sum(count for _, count, _ in runs)} off-targets into {len(runs)} runs')
+
+    ####################################
+    ###   Merging                    ###
+    ####################################
+    stageStart = time.time()
+
+    runs = mergeRuns(runs, sortedTempDir.name, mpPool, compress)
+
+    printThroughput('Merging', sum(count for _, count, _ in runs), 'off-targets', time.time() - stageStart)
+
+    ####################################
+    ###   Indexing                   ###
+    ####################################
+    stageStart = time.time()
+
+    # isslCreateIndex needs the sites twice to keep within a memory budget, so
+    # they are written to a file first. Otherwise they are streamed to it.
+    args = [binary, '-', str(OFFTARGET_LENGTH), str(sliceWidth), fpOutput]
+    if memoryBudget is not None:
+        sitesFile = tempfile.NamedTemporaryFile(mode = 'wb', delete = False, dir = sortedTempDir.name)
+        args[1] = sitesFile.name
+        args.append(str(memoryBudget))
+        sites = sitesFile
+        process = None
+    else:
+        printer(f'Starting {args}')
+        process = subprocess.Popen(args, stdin = subprocess.PIPE)
+        sites = process.stdin
+
+    textFile = open(fpOfftargets, 'wb') if fpOfftargets is not None else None
+
+    distinctCount = 0
+    try:
+        sites.write(ISSL_SITES_MAGIC)
+
+        # The ranges are merged in parallel, and passed on in order
+        for textPart, sitesPart in mpPool.imap(
+            outputNodeArgs,
+            [
+                (
+                    runs,
+                    lo,
+                    hi,
+                    sortedTempDir.name,
+                    compress,
+                    textFile is not None,
+                    True
+                ) for lo, hi in keyRanges(runs)
+            ]
+        ):
+            if textFile is not None:
+                appendPart(textPart, textFile)
+            distinctCount += os.path.getsize(sitesPart) // ISSL_SITE_DTYPE.itemsize
+            appendPart(sitesPart, sites)
+    finally:
+        sites.close()
+        if textFile is not None:
+            textFile.close()
+
+    if process is None:
+        printer(f'Starting {args}')
+        process = subprocess.Popen(args)
+
+    if process.wait() != 0:
+        raise RuntimeError(f'isslCreateIndex failed ({process.returncode}): {args}')
+
+    printThroughput('Indexing', distinctCount, 'distinct off-targets', time.time() - stageStart)
+
+    sortedTempDir.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description='Builds the ISSL index of a genome')
+    parser.add_argument('-o', '--output', help='A filepath to save the ISSL index', required=True)
+    parser.add_argument('-w', '--slicewidth', help='The ISSL slice width in bits', type=int, default=8)
+    parser.add_argument('-b', '--binary', help='A filepath to the isslCreateIndex binary', default='isslCreateIndex')
+    parser.add_argument('-t', '--offtargets', help='A filepath to also save the sorted off-target sites, as text', default=None)
+    parser.add_argument('-m', '--memory', help='A memory budget for isslCreateIndex, in MiB', type=int, default=None)
+    parser.add_argument('--compress-runs', help='Compress the intermediate sorted runs', action='store_true', default=SORT_COMPRESS_RUNS)
+    parser.add_argument('inputs', help='FASTA files, or a directory of them', nargs='+')
+
+    args = parser.parse_args()
+
+    # Create multiprocessing pool
+    mpPool = multiprocessing.Pool(PROCESSES_COUNT)
+
+    buildIsslIndex(
+        args.inputs,
+        args.output,
+        args.slicewidth,
+        args.binary,
+        mpPool,
+        fpOfftargets = args.offtargets,
+        memoryBudget = args.memory,
+        compress = args.compress_runs
+    )
+
+    # Clean up. Close multiprocessing pool
+    mpPool.close()
+
+    printer('Goodbye.')
+
+if __name__ == '__main__':
+    main()
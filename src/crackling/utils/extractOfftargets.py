@@ -15,170 +15,477 @@ To use:     python3.7 ExtractOfftargets.py output-file  (input-files... | input-
 
 '''
 
-import glob, multiprocessing, os, re, shutil, string, sys, tempfile, heapq
+import glob, gzip, mmap, multiprocessing, os, shutil, string, sys, tempfile
+import numpy as np
 from crackling.Helpers import *
 from crackling.Paginator import Paginator
+from crackling.FileProcessor.fasta_reader import read_fasta_records
+from crackling.FileProcessor.fasta_index import get_fasta_index, read_region
 
-# Defining the patterns used to detect sequences
+# Defining the patterns used to detect sequences (see `findOfftargetKeys`)
 pattern_forward_offsite = r"(?=([ACG][ACGT]{19}[ACGT][AG]G))"
 pattern_reverse_offsite = r"(?=(C[CT][ACGT][ACGT]{19}[TGC]))"
 
 # The off-target sites need to be sorted so the ISSL index is space-optimised.
-# In some cases, there are many files to sort, we can paginate the files.
-# How many files should we sort per page?
-# This is dictated by the number of arguments that we can pass to `sort`
-# Default: 50
-SORT_PAGE_SIZE = 500
+# They are sorted externally: each intermediate file is cut into runs of at
+# most SORT_RUN_SIZE sites, which are sorted in parallel, then merged
+# SORT_MERGE_FAN_IN runs at a time, level by level, until few enough remain to
+# be merged (in parallel, by range of sites) into the output file.
+#
+# The sites are sorted as fixed-width keys, 2 bits per base with the first
+# base in the most-significant bits, so that memory use is bounded by these
+# sizes rather than by the size of a chromosome.
+OFFTARGET_LENGTH = 20
+OFFTARGET_LINE_LENGTH = OFFTARGET_LENGTH + 1 # '\n'
+
+# Sites per sorted run (about 120 MiB per process, while sorting)
+SORT_RUN_SIZE = 1 << 22
+
+# Runs merged at once, and sites read from each of them at a time
+SORT_MERGE_FAN_IN = 16
+SORT_BLOCK_SIZE = 1 << 16
+
+# Every SORT_SAMPLE_STRIDE-th site of a run is kept, to split the final merge
+SORT_SAMPLE_STRIDE = 1 << 16
+
+# Compress the runs (gzip, level 1), trading CPU time for temporary disk space
+SORT_COMPRESS_RUNS = False
+
+# Off-target sites are 23 bases long, including the PAM
+OFFTARGET_SITE_LENGTH = 23
+
+# Indexed records are extracted in regions of this many bases, which overlap
+# by OFFTARGET_SITE_LENGTH - 1 bases so that no site is missed
+EXTRACTION_REGION_SIZE = 1 << 23
 
 # Set the number of processes to generate.
-# This sets the --threads argument for `sort`, and
-# the process count for multiprocessing.Map(..)
+# This sets the process count for multiprocessing.Map(..), and the number of
+# ranges the final merge is split into.
 # Default: os.cpu_count()
 PROCESSES_COUNT = os.cpu_count()
 
-def explodeMultiFastaFile(fpInput, fpOutputTempDir):
-    newFilesPaths = []
-
-    with open(fpInput, 'r') as fRead:
-        fWrite = None
-
-        for line in fRead:
-            line = line.strip()
-            
-            # just found a new fasta segment. open a new file
-            if line[0] == '>':
-                fpTemp = tempfile.NamedTemporaryFile(
-                    mode = 'w+', 
-                    delete = False,
-                    dir = fpOutputTempDir
-                )
-                
-                # close the current file if necessary
-                if fWrite is not None:
-                    fWrite.write('\n')
-                    fWrite.close()
-                    
-                # open a new one
-                fWrite = open(fpTemp.name, 'w+')
-                newFilesPaths.append(fpTemp.name)
-                
-                fWrite.write(line)
-                fWrite.write('\n')
-
-            if line[0] != '>':
-                fWrite.write(line.upper().strip())
-        
-        # close the last file if necessary
-        if fWrite is not None:
-            fWrite.close()
-            
-    return newFilesPaths
-
-def processingNode(fpInputs, fpOutputTempDir = None):
-    # Create a temporary file
-    fpTemp = tempfile.NamedTemporaryFile(
-        mode = 'w+', 
-        delete = False,
-        dir = fpOutputTempDir
-    )
-    
-    with open(fpTemp.name, 'w+') as outFile:
-
-        for fpInput in fpInputs:
-        
-            # key: FASTA header, value: sequence
-            seqsByHeader = {}
-
-            with open(fpInput, 'r') as inFile:
-                header = fpInput
-                
-                for line in inFile:
-                    if line[0] == '>':
-                        header = line[1:]
-                        seqsByHeader[header] = []
-                    else:
-                        if header not in seqsByHeader:
-                            # it could be a plain text file, without a header
-                            seqsByHeader[header] = []
-                        seqsByHeader[header].append(line.rstrip().upper())
-
-            # For each FASTA sequence
-            lineNumber = 0
-            offtargets = [] 
-            for header in seqsByHeader:
-                seq = ''.join(seqsByHeader[header])
-                
-                for strand, pattern, seqModifier in [
-                    ['positive', pattern_forward_offsite, lambda x : x],
-                    ['negative', pattern_reverse_offsite, lambda x : rc(x)]
-                ]:
-                    match_chr = re.findall(pattern, seq)
-
-                    for i in range(0,len(match_chr)):
-                        offtargets.append(
-                            seqModifier(match_chr[i][0:20])
-                        )
-
-                lineNumber += 1
-                
-            outFile.write(''.join(f'{offTarget}\n' for offTarget in offtargets))
-
-# Node function that sorts a file for multiprocessing pool
-def sortingNode(fileToSort, sortedTempDir):
-    # Create a temporary file
-    sortedFile = tempfile.NamedTemporaryFile(
-        mode = 'w+', 
+# A, C, G, T to 0, 1, 2, 3, anything else to 255
+_baseCodes = np.full(256, 255, dtype=np.uint8)
+_baseCodes[np.frombuffer(b'ACGT', dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+_codeBases = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+# As _baseCodes, for sequences in either case
+_sequenceCodes = _baseCodes.copy()
+_sequenceCodes[np.frombuffer(b'acgt', dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+
+# A distinct off-target site and how often it occurs, as read by isslCreateIndex
+# (see ISSL/include/isslIndexFormat.h)
+ISSL_SITES_MAGIC = b'ISSLSITE'
+ISSL_SITE_DTYPE = np.dtype([
+    ('signature',   '<u8'),
+    ('occurrences', '<u8'),
+])
+
+def findOfftargetKeys(sequence, limit = None):
+    '''
+    Returns the off-target sites of a sequence (bytes), on both strands, as
+    unsorted keys (see `encodeOfftargets`). Only the sites starting before
+    `limit` are returned.
+
+    A forward site matches pattern_forward_offsite, and is its first 20 bases.
+    A reverse site matches pattern_reverse_offsite, and is the reverse
+    complement of its first 20 bases.
+    '''
+    codes = _sequenceCodes[np.frombuffer(sequence, dtype=np.uint8)]
+    windowCount = len(codes) - OFFTARGET_SITE_LENGTH + 1
+    if limit is not None:
+        windowCount = min(windowCount, limit)
+    if windowCount <= 0:
+        return np.zeros(0, dtype='<u8')
+
+    # invalid[i] is the number of invalid bases before position i
+    invalid = np.zeros(len(codes) + 1, dtype=np.int32)
+    np.cumsum(codes == 255, out=invalid[1:])
+
+    def validBetween(first, last):
+        '''Windows for which the bases [first, last) are all A, C, G or T'''
+        return invalid[last:last + windowCount] == invalid[first:first + windowCount]
+
+    def base(position):
+        return codes[position:position + windowCount]
+
+    # [ACG][ACGT]{19}[ACGT][AG]G
+    forward = validBetween(0, OFFTARGET_SITE_LENGTH)
+    forward &= base(0) != 3
+    forward &= (base(21) == 0) | (base(21) == 2)
+    forward &= base(22) == 2
+
+    # C[CT][ACGT][ACGT]{19}[TGC]
+    reverse = validBetween(0, OFFTARGET_SITE_LENGTH)
+    reverse &= base(0) == 1
+    reverse &= (base(1) == 1) | (base(1) == 3)
+    reverse &= base(22) != 0
+
+    keys = []
+    for starts, isReverse in ((np.flatnonzero(forward), False), (np.flatnonzero(reverse), True)):
+        strandKeys = np.zeros(len(starts), dtype='<u8')
+        for position in range(OFFTARGET_LENGTH):
+            if isReverse:
+                code = 3 - codes[starts + OFFTARGET_LENGTH - 1 - position]
+            else:
+                code = codes[starts + position]
+            strandKeys <<= np.uint64(2)
+            strandKeys |= code
+        keys.append(strandKeys)
+
+    return np.concatenate(keys)
+
+def encodeOfftargets(lines):
+    '''Encodes off-target sites, as fixed-width lines of text, to sortable keys'''
+    matrix = np.frombuffer(lines, dtype=np.uint8).reshape(-1, OFFTARGET_LINE_LENGTH)
+    codes = _baseCodes[matrix[:, :OFFTARGET_LENGTH]]
+    if (codes == 255).any():
+        raise ValueError('Off-target sites may only contain A, C, G and T')
+
+    keys = np.zeros(len(codes), dtype='<u8')
+    for position in range(OFFTARGET_LENGTH):
+        keys <<= np.uint64(2)
+        keys |= codes[:, position]
+    return keys
+
+def decodeOfftargets(keys):
+    '''Decodes keys to off-target sites, as lines of text'''
+    matrix = np.empty((len(keys), OFFTARGET_LINE_LENGTH), dtype=np.uint8)
+    matrix[:, OFFTARGET_LENGTH] = ord('\n')
+    for position in range(OFFTARGET_LENGTH):
+        shift = np.uint64(2 * (OFFTARGET_LENGTH - 1 - position))
+        matrix[:, position] = _codeBases[(keys >> shift) & np.uint64(3)]
+    return matrix.tobytes()
+
+def keysToSignatures(keys):
+    '''Converts keys to ISSL signatures, which hold the first base in the least-significant bits'''
+    signatures = np.zeros(len(keys), dtype='<u8')
+    for position in range(OFFTARGET_LENGTH):
+        code = (keys >> np.uint64(2 * (OFFTARGET_LENGTH - 1 - position))) & np.uint64(3)
+        signatures |= code << np.uint64(2 * position)
+    return signatures
+
+def distinctSites(blocks):
+    '''Yields the distinct keys of sorted blocks, and how often each occurs, per block'''
+    carryKeys = np.zeros(0, dtype='<u8')
+    carryCounts = np.zeros(0, dtype='<u8')
+    for block in blocks:
+        if len(block) == 0:
+            continue
+        starts = np.flatnonzero(np.concatenate(([True], block[1:] != block[:-1])))
+        keys = block[starts]
+        counts = np.diff(np.append(starts, len(block))).astype('<u8')
+
+        # the last key may continue in the next block
+        if len(carryKeys) > 0 and carryKeys[0] == keys[0]:
+            counts[0] += carryCounts[0]
+        else:
+            keys = np.concatenate((carryKeys, keys))
+            counts = np.concatenate((carryCounts, counts))
+
+        yield keys[:-1], counts[:-1]
+        carryKeys, carryCounts = keys[-1:], counts[-1:]
+
+    if len(carryKeys) > 0:
+        yield carryKeys, carryCounts
+
+def openRun(path, mode, compress):
+    if compress:
+        return gzip.open(path, mode, compresslevel=1)
+    return open(path, mode)
+
+def writeRun(blocks, sortedTempDir, compress):
+    '''
+    Writes sorted blocks of keys to a new run file
+
+    Returns (path, count, sample), where sample holds every
+    SORT_SAMPLE_STRIDE-th key of the run
+    '''
+    runFile = tempfile.NamedTemporaryFile(
+        mode = 'wb',
         delete = False,
         dir = sortedTempDir
     )
-    # Sort input file and store in new output dir
-    with open(fileToSort, 'r') as input:
-            # Read 'page'
-            page = input.readlines()
-            # Sort Page
-            page.sort()
-            # Write sorted page to file
-            sortedFile.writelines(page)
-            # Close sorted file
-            sortedFile.close()
-
-def paginatedSort(filesToSort, fpOutput, mpPool): 
+    runFile.close()
+
+    count = 0
+    sample = []
+    with openRun(runFile.name, 'wb', compress) as run:
+        for block in blocks:
+            run.write(block.astype('<u8', copy=False).tobytes())
+            sample.append(block[(-count) % SORT_SAMPLE_STRIDE::SORT_SAMPLE_STRIDE])
+            count += len(block)
+
+    return runFile.name, count, np.concatenate(sample + [np.zeros(0, dtype='<u8')])
+
+def readRun(path, compress, lo = None, hi = None):
+    '''Yields the keys of a run in [lo, hi), SORT_BLOCK_SIZE at a time'''
+    if not compress:
+        if os.path.getsize(path) == 0:
+            return
+        keys = np.memmap(path, dtype='<u8', mode='r')
+        start = 0 if lo is None else np.searchsorted(keys, np.uint64(lo))
+        end = len(keys) if hi is None else np.searchsorted(keys, np.uint64(hi))
+        for blockStart in range(start, end, SORT_BLOCK_SIZE):
+            yield np.array(keys[blockStart:min(blockStart + SORT_BLOCK_SIZE, end)])
+        return
+
+    with openRun(path, 'rb', compress) as run:
+        while True:
+            block = np.frombuffer(run.read(SORT_BLOCK_SIZE * 8), dtype='<u8')
+            if len(block) == 0:
+                return
+            if lo is not None:
+                block = block[np.searchsorted(block, np.uint64(lo)):]
+            if hi is not None and len(block) > 0 and block[-1] >= hi:
+                yield block[:np.searchsorted(block, np.uint64(hi))]
+                return
+            if len(block) > 0:
+                yield block
+
+def mergeBlocks(runs):
+    '''
+    Merges sorted runs (iterables of sorted blocks of keys), yielding sorted
+    blocks
+
+    Each step emits every buffered key up to the smallest last key of the
+    buffered blocks, which exhausts at least one block.
+    '''
+    iterators = [iter(run) for run in runs]
+    pending = [next(iterator, None) for iterator in iterators]
+
+    while True:
+        active = [i for i, block in enumerate(pending) if block is not None]
+        if not active:
+            return
+
+        cutoff = min(pending[i][-1] for i in active)
+        merged = []
+        for i in active:
+            split = np.searchsorted(pending[i], cutoff, side='right')
+            merged.append(pending[i][:split])
+            if split == len(pending[i]):
+                pending[i] = next(iterators[i], None)
+            else:
+                pending[i] = pending[i][split:]
+
+        # the pieces are sorted, which the stable sort takes advantage of
+        yield np.sort(np.concatenate(merged), kind='stable')
+
+# Node function that sorts one run of a file for multiprocessing pool
+def sortingNode(fileToSort, start, count, sortedTempDir, compress):
+    with open(fileToSort, 'rb') as input:
+        input.seek(start * OFFTARGET_LINE_LENGTH)
+        keys = encodeOfftargets(input.read(count * OFFTARGET_LINE_LENGTH))
+
+    keys.sort()
+    return writeRun([keys], sortedTempDir, compress)
+
+# Node function that merges runs into one for multiprocessing pool
+def mergingNode(runs, sortedTempDir, compress):
+    merged = writeRun(
+        mergeBlocks([readRun(path, compress) for path, _, _ in runs]),
+        sortedTempDir,
+        compress
+    )
+    for path, _, _ in runs:
+        os.remove(path)
+    return merged
+
+# Node function that merges one range of keys of the final runs, as text and,
+# or, as distinct binary sites for isslCreateIndex
+def outputNode(runs, lo, hi, sortedTempDir, compress, writeText = True, writeSites = False):
+    textPart = tempfile.NamedTemporaryFile(mode = 'wb', delete = False, dir = sortedTempDir) if writeText else None
+    sitesPart = tempfile.NamedTemporaryFile(mode = 'wb', delete = False, dir = sortedTempDir) if writeSites else None
+
+    blocks = mergeBlocks([readRun(path, compress, lo, hi) for path, _, _ in runs])
+    if writeText:
+        blocks = writeTextBlocks(blocks, textPart)
+    if writeSites:
+        for keys, counts in distinctSites(blocks):
+            sites = np.empty(len(keys), dtype=ISSL_SITE_DTYPE)
+            sites['signature'] = keysToSignatures(keys)
+            sites['occurrences'] = counts
+            sitesPart.write(sites.tobytes())
+    else:
+        for _ in blocks:
+            pass
+
+    for part in (textPart, sitesPart):
+        if part is not None:
+            part.close()
+
+    return (
+        textPart.name if writeText else None,
+        sitesPart.name if writeSites else None
+    )
+
+def writeTextBlocks(blocks, file):
+    '''Writes blocks of keys to `file` as text, passing them on'''
+    for block in blocks:
+        file.write(decodeOfftargets(block))
+        yield block
+
+def outputNodeArgs(args):
+    return outputNode(*args)
+
+def appendPart(part, file):
+    '''Appends a part written by `outputNode` to `file`, then removes it'''
+    with open(part, 'rb') as partFile:
+        shutil.copyfileobj(partFile, file, 1 << 20)
+    os.remove(part)
+
+def mergeRuns(runs, sortedTempDir, mpPool, compress):
+    '''Merges runs, level by level, until at most SORT_MERGE_FAN_IN remain'''
+    while len(runs) > SORT_MERGE_FAN_IN:
+        runs = mpPool.starmap(
+            mergingNode,
+            [
+                (
+                    runs[i:i + SORT_MERGE_FAN_IN],
+                    sortedTempDir,
+                    compress
+                ) for i in range(0, len(runs), SORT_MERGE_FAN_IN)
+            ]
+        )
+        printer(f'Merged into {len(runs)} runs')
+    return runs
+
+def keyRanges(runs):
+    '''Splits the keys of runs into PROCESSES_COUNT ranges of about the same size'''
+    sample = np.sort(np.concatenate([sample for _, _, sample in runs] + [np.zeros(0, dtype='<u8')]))
+    splitters = sorted(set(
+        int(sample[len(sample) * i // PROCESSES_COUNT])
+        for i in range(1, PROCESSES_COUNT)
+    )) if len(sample) > 0 else []
+    bounds = [None] + splitters + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def printThroughput(stage, count, unit, seconds):
+    rate = count / seconds if seconds > 0 else 0
+    printer(f'{stage}: {count} {unit} in {seconds:.1f}s ({rate:,.0f} {unit}/s)')
+
+def paginatedSort(filesToSort, fpOutput, mpPool, compress = SORT_COMPRESS_RUNS):
     # Create temp file directory
     sortedTempDir = tempfile.TemporaryDirectory()
     printer(f'Created temp directory {sortedTempDir.name} for sorting')
 
-    # Generate args for sorting 
-    args = [
-        (
-            file,
-            sortedTempDir.name 
-        ) for file in filesToSort
-    ]
+    # Generate args for sorting, cutting each file into runs
+    args = []
+    for file in filesToSort:
+        fileSize = os.path.getsize(file)
+        if fileSize % OFFTARGET_LINE_LENGTH != 0:
+            raise ValueError(f'Expected lines of {OFFTARGET_LENGTH} bases: {file}')
+
+        count = fileSize // OFFTARGET_LINE_LENGTH
+        for start in range(0, count, SORT_RUN_SIZE):
+            args.append((
+                file,
+                start,
+                min(SORT_RUN_SIZE, count - start),
+                sortedTempDir.name,
+                compress
+            ))
 
     # Submit job to multiprocessing pool
-    mpPool.starmap(
+    runs = mpPool.starmap(
         sortingNode,
         args
     )
-    
-    # Collect sorted files to merge
-    sortedFiles = glob.glob(
-        os.path.join(
-            sortedTempDir.name,
-            '*'
-        )
+    printer(f'Sorted {sum(count for _, count, _ in runs)} off-targets into {len(runs)} runs')
+
+    # Merge the runs, level by level
+    runs = mergeRuns(runs, sortedTempDir.name, mpPool, compress)
+
+    writeSortedText(runs, fpOutput, sortedTempDir.name, mpPool, compress)
+
+    sortedTempDir.cleanup()
+
+def extractionTasks(fpInputs):
+    '''
+    Returns (fpInput, entry, start, end) for each region of bases to extract
+    the off-targets of. Files which can be indexed (see `get_fasta_index`) are
+    split into regions of records; other files are one task, with no entry.
+    '''
+    tasks = []
+    for fpInput in fpInputs:
+        index = get_fasta_index(fpInput)
+        if index is None:
+            tasks.append((fpInput, None, 0, 0))
+            continue
+
+        for entry in index:
+            for start in range(0, entry.length, EXTRACTION_REGION_SIZE):
+                tasks.append((fpInput, entry, start, min(start + EXTRACTION_REGION_SIZE, entry.length)))
+    return tasks
+
+# Node function that extracts the off-targets of a region of a FASTA file (or
+# of the whole file, without an entry) for multiprocessing pool, straight into
+# sorted runs
+def extractionNode(fpInput, entry, start, end, sortedTempDir, compress):
+    if entry is not None:
+        # read the region, and the start of the next, from the mapped file
+        with open(fpInput, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            sequence = read_region(buffer, entry, start, end + OFFTARGET_SITE_LENGTH - 1)
+        sequences = [findOfftargetKeys(sequence, end - start)]
+        bases = end - start
+    else:
+        sequences = []
+        bases = 0
+        for header, sequence in read_fasta_records(fpInput):
+            sequences.append(findOfftargetKeys(sequence))
+            bases += len(sequence)
+
+    keys = np.concatenate(sequences + [np.zeros(0, dtype='<u8')])
+
+    runs = []
+    for runStart in range(0, len(keys), SORT_RUN_SIZE):
+        run = np.sort(keys[runStart:runStart + SORT_RUN_SIZE])
+        runs.append(writeRun([run], sortedTempDir, compress))
+
+    return runs, bases
+
+def extractRuns(fpInputs, sortedTempDir, mpPool, compress):
+    '''Extracts the off-targets of FASTA files into sorted runs, returning (runs, bases)'''
+    tasks = extractionTasks(fpInputs)
+    printer(f'Extracting off-targets from {len(fpInputs)} files, as {len(tasks)} regions')
+
+    results = mpPool.starmap(
+        extractionNode,
+        [
+            (
+                fpInput,
+                entry,
+                start,
+                end,
+                sortedTempDir,
+                compress
+            ) for fpInput, entry, start, end in tasks
+        ]
     )
-    
-    # Open all the sorted files to merge
-    sortedFilesPointers = [open(file, 'r') for file in sortedFiles]
 
-    # Merge all the sorted files 
-    with open(fpOutput, 'w') as f:
-        f.writelines(heapq.merge(*sortedFilesPointers))
-    
-    # Close all of the sorted files
-    for file in sortedFilesPointers:
-        file.close()
+    runs = [run for taskRuns, _ in results for run in taskRuns]
+    return runs, sum(bases for _, bases in results)
+
+def writeSortedText(runs, fpOutput, sortedTempDir, mpPool, compress):
+    '''Merges the final runs by ranges of keys, in parallel, into a text file'''
+    parts = mpPool.starmap(
+        outputNode,
+        [
+            (
+                runs,
+                lo,
+                hi,
+                sortedTempDir,
+                compress
+            ) for lo, hi in keyRanges(runs)
+        ]
+    )
+
+    # Concatenate the ranges into the output file
+    with open(fpOutput, 'wb') as f:
+        for textPart, _ in parts:
+            appendPart(textPart, f)
 
 def startMultiprocessing(fpInputs, fpOutput, mpPool):
     printer('Extracting off-targets using multiprocessing approach')
@@ -196,51 +503,18 @@ def startMultiprocessing(fpInputs, fpOutput, mpPool):
             )
         )
 
-    if len(fpInputs) == 1:
-        printer('Only one input file to process')
-        
-        fpExplodeTempDir = tempfile.TemporaryDirectory()
-        printer('Attempting to explode multi-FASTA file')
-        printer(f'Writing each file to a temporary directory: {fpExplodeTempDir.name}')
-        
-    
-        fpInputs = explodeMultiFastaFile(
-            fpInputs[0],
-            fpExplodeTempDir.name
-        )
-        
-        printer(f'Exploded into {len(fpInputs)} files')
-
-    args = [
-        (
-            [fpInput],
-            fpTempDir.name 
-        ) for fpInput in fpInputs
-    ]
+    # Records are read by offset, so multi-FASTA files need not be split up
+    runs, bases = extractRuns(fpInputs, fpTempDir.name, mpPool, SORT_COMPRESS_RUNS)
 
-    printer(f'Beginning to process {len(args)} files...')
-
-    mpPool.starmap(
-        processingNode,
-        args
-    )
-
-    printer('Processing completed')
+    printer(f'Processing completed: {sum(count for _, count, _ in runs)} off-targets in {bases} bases')
     
-    printer('Preparing for ISSL by sorting all intermediate files')
+    printer('Preparing for ISSL by sorting the off-targets')
     printer('Then, writing to user-specified output file')
     
-    # sort in batches
-    paginatedSort(
-        glob.glob(
-            os.path.join(
-                fpTempDir.name, 
-                '*'
-            )
-        ), 
-        fpOutput,
-        mpPool
-    )
+    runs = mergeRuns(runs, fpTempDir.name, mpPool, SORT_COMPRESS_RUNS)
+    writeSortedText(runs, fpOutput, fpTempDir.name, mpPool, SORT_COMPRESS_RUNS)
+
+    fpTempDir.cleanup()
 
 def main():
     if (len(sys.argv) < 3):
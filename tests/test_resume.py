@@ -0,0 +1,161 @@
+'''
+Resuming a run with checkpoints (see RunCheckpoint), which was interrupted
+once the guides had been extracted, part way through a batch, or while the
+results of a batch were being written.
+'''
+
+import configparser, importlib, json, os, random, sys
+
+import pytest
+
+from crackling.ConfigManager import ConfigManager
+from crackling.RunCheckpoint import RunCheckpoint
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PIPELINES = ['crackling.CracklingOriginal', 'crackling.Crackling']
+
+
+class Interrupted(Exception):
+    pass
+
+
+def writeConfig(tmp_path, name):
+    inputFile = tmp_path / 'input.fa'
+    if not inputFile.exists():
+        rng = random.Random(0)
+        with open(inputFile, 'w') as fp:
+            fp.write('>chr1\n')
+            fp.write(''.join(rng.choice('ACGT') for _ in range(20000)) + '\n')
+
+    os.mkdir(tmp_path / name)
+
+    # The sample configuration, without the tools which are not installed here
+    c = configparser.ConfigParser(interpolation=None)
+    c.read(os.path.join(ROOT, 'config.ini'))
+    c['general']['name'] = 'test'
+    c['consensus']['mm10db'] = 'False'
+    c['input']['exon-sequences'] = str(inputFile)
+    c['input']['batch-size'] = '500'
+    c['output']['dir'] = str(tmp_path / name)
+    c['output']['checkpoint'] = 'True'
+    c['offtargetscore']['enabled'] = 'False'
+    c['offtargetscore']['binary'] = sys.executable
+    c['offtargetscore']['library'] = ''
+    c['sgrnascorer2']['model'] = os.path.join(ROOT, 'src', 'crackling', 'utils', 'data', 'model-py3.txt')
+    c['bowtie2']['binary'] = sys.executable
+    c['rnafold']['binary'] = sys.executable
+    with open(tmp_path / name / 'config.ini', 'w') as fp:
+        c.write(fp)
+
+    return tmp_path / name / 'config.ini'
+
+
+def configure(configFile, resume=False):
+    cm = ConfigManager(str(configFile), print, resume)
+    assert cm.isConfigured()
+    return cm
+
+
+def readManifest(cm):
+    with open(os.path.join(cm.getRunDir(), 'manifest.json')) as fp:
+        return json.load(fp)
+
+
+####################################
+###     Interruptions             ##
+####################################
+def afterExtraction(saveExtraction):
+    def interrupt(self, *args, **kwargs):
+        saveExtraction(self, *args, **kwargs)
+        raise Interrupted()
+    return interrupt
+
+
+def afterStage(stage):
+    # Once `stage` of the second batch is recorded, before its later stages
+    def patch(saveStage):
+        def interrupt(self, batchFileId, name, candidateGuides):
+            saveStage(self, batchFileId, name, candidateGuides)
+            if batchFileId == 1 and name == stage:
+                raise Interrupted()
+        return interrupt
+    return patch
+
+
+def duringOutput(saveOutput):
+    # Once part of the rows of the second batch are written, before they are recorded
+    def interrupt(self, outputFile, batchFileId=None, source=None):
+        if batchFileId == 1:
+            os.truncate(outputFile, os.path.getsize(outputFile) - 100)
+            raise Interrupted()
+        saveOutput(self, outputFile, batchFileId, source)
+    return interrupt
+
+
+def runInterrupted(tmp_path, monkeypatch, pipeline, method, patch):
+    '''
+    Interrupts a run where `patch` raises Interrupted, in place of a RunCheckpoint
+    method, and resumes it. Asserts that the output is the same as that of an
+    uninterrupted run. Returns the manifest, and the size of the output file
+    (0 if there is none), that the interrupted run left.
+    '''
+    Crackling = importlib.import_module(pipeline).Crackling
+
+    # Crackling redirects stdout and stderr to its logs until it returns
+    monkeypatch.setattr(sys, 'stdout', sys.stdout)
+    monkeypatch.setattr(sys, 'stderr', sys.stderr)
+
+    cm = configure(writeConfig(tmp_path, 'reference'))
+    Crackling(cm)
+    with open(cm['output']['file'], 'rb') as fp:
+        expected = fp.read()
+
+    configFile = writeConfig(tmp_path, 'interrupted')
+
+    original = getattr(RunCheckpoint, method)
+    monkeypatch.setattr(RunCheckpoint, method, patch(original))
+    cm = configure(configFile)
+    with pytest.raises(Interrupted):
+        Crackling(cm)
+    monkeypatch.setattr(RunCheckpoint, method, original)
+
+    outputFile = cm['output']['file']
+    interrupted = readManifest(cm), os.path.getsize(outputFile) if os.path.exists(outputFile) else 0
+
+    cm = configure(configFile, resume=True)
+    Crackling(cm)
+    with open(cm['output']['file'], 'rb') as fp:
+        assert fp.read() == expected
+
+    return interrupted
+
+
+@pytest.mark.parametrize('pipeline', PIPELINES)
+def test_resume_after_extraction(tmp_path, monkeypatch, pipeline):
+    manifest, _ = runInterrupted(tmp_path, monkeypatch, pipeline, 'saveExtraction', afterExtraction)
+
+    assert manifest['extraction'] is not None
+    assert manifest['batches'] == {}
+
+
+@pytest.mark.parametrize('pipeline, stage', [
+    ('crackling.CracklingOriginal', 'efficiency'),
+    ('crackling.Crackling', 'sgrnascorer2'),
+])
+def test_resume_within_batch(tmp_path, monkeypatch, pipeline, stage):
+    manifest, _ = runInterrupted(tmp_path, monkeypatch, pipeline, 'saveStage', afterStage(stage))
+
+    # The second batch resumes from the guide table of its completed stages
+    assert stage in manifest['batches']['1']['stages']
+    assert not manifest['batches']['1']['output']
+
+
+@pytest.mark.parametrize('pipeline', PIPELINES)
+def test_resume_after_partial_output(tmp_path, monkeypatch, pipeline):
+    manifest, outputSize = runInterrupted(tmp_path, monkeypatch, pipeline, 'saveOutput', duringOutput)
+
+    # The rows written after the first batch are discarded, then written again
+    assert manifest['batches']['0']['output']
+    assert not manifest['batches']['1']['output']
+    assert outputSize > manifest['outputSize']